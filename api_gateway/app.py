@@ -1,14 +1,28 @@
 # api_gateway/app.py
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
 import paho.mqtt.client as mqtt
 import os
 from dotenv import load_dotenv
 import json
 import random
-import base64
-from io import BytesIO # Useful for StreamingResponse with bytes
+import asyncio
+import html
+from urllib.parse import quote
+import time
+from shared.frame_codec import decode_frame, FrameDecodeError
+from shared.topics import CAMERA_FEED_SUBSCRIPTION, LLM_STATUS_TOPIC, camera_id_from_topic
+from shared.service_status import decode_status
+from shared.insight_message import decode_insight, partial_subscription
+from frame_store import StoredFrame, frame_response
+from broadcast import Broadcaster
+from history import History, KIND_FRAME
+from mqtt_bridge import MqttBridge, PublishError
+from page_cache import CachedPage
+from shared.metrics import REGISTRY, CONTENT_TYPE, gauge, histogram
+from shared.mqtt_metrics import PublishTracker
+from shared import log
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,11 +35,60 @@ MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
 MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "camera/feed") # Topic to subscribe to and publish to
 MQTT_TOPIC_LLM = os.getenv("MQTT_TOPIC_LLM", "llm_response")
-
-# Store the latest received image data
-latest_image_payload: bytes | None = None
-latest_image_media_type: str = "image/jpeg" # Default media type, can be updated from message
+MQTT_TOPIC_LLM_PARTIAL = partial_subscription(MQTT_TOPIC_LLM) # Streamed tokens, <llm topic>/partial/<frame_id>
+MQTT_TOPIC_LLM_STATUS = os.getenv("MQTT_TOPIC_LLM_STATUS", LLM_STATUS_TOPIC) # Retained LLM readiness message
+# Per-camera frame topics (camera/<id>/feed), subscribed to in addition to MQTT_TOPIC
+MQTT_CAMERA_TOPICS = os.getenv("MQTT_CAMERA_TOPICS", CAMERA_FEED_SUBSCRIPTION)
+
+# Live feed settings
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 2)) # Events buffered per stream client before old ones are dropped
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15)) # Comment line sent to idle SSE clients
+
+# Frame and insight history settings
+HISTORY_MEMORY_BYTES = int(os.getenv("HISTORY_MEMORY_BYTES", 32 * 1024 * 1024)) # Payload bytes kept in memory
+HISTORY_DIR = os.getenv("HISTORY_DIR", "/tmp/gateway_history") # Segment files for older payloads; empty keeps memory only
+HISTORY_SEGMENT_BYTES = int(os.getenv("HISTORY_SEGMENT_BYTES", 128 * 1024 * 1024)) # Size of each of the two segment files
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", 50000)) # Upper bound on indexed frames and insights
+
+# MQTT ingest: incoming messages are queued per kind and decoded on a thread pool (see mqtt_bridge.py)
+INGEST_FRAME_QUEUE = int(os.getenv("INGEST_FRAME_QUEUE", 16)) # Frames waiting per worker before the oldest are dropped
+INGEST_LLM_QUEUE = int(os.getenv("INGEST_LLM_QUEUE", 1024)) # Insights, streamed tokens and status messages waiting
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2)) # Frames decoded concurrently; each camera's frames stay in order
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", 4)) # Thread pool for decoding, hashing and history writes
+# Publishing from HTTP
+PUBLISH_QOS = int(os.getenv("PUBLISH_QOS", 0)) # Default QoS of /send_data/ messages; 1 waits for the broker's ack
+PUBLISH_ACK_TIMEOUT = float(os.getenv("PUBLISH_ACK_TIMEOUT", 10)) # Seconds to wait for QoS 1 acks
+SEND_BATCH_MAX = int(os.getenv("SEND_BATCH_MAX", 1000)) # Messages accepted by one /send_data/batch call
+
+# Store the latest received frame. StoredFrame is immutable and replaced as a whole,
+# so request handlers always see a consistent image/ETag pair. All of the state below
+# is only written on the event loop (the bridge's `apply` steps).
+latest_frame: StoredFrame | None = None
 latest_llm_response: str | None = None # Store the latest LLM text response
+latest_insight: dict | None = None # The latest structured insight message (frame id, timings)
+llm_status: dict | None = None # The LLM service's readiness message (state, load-time breakdown)
+
+# Latest frame per camera id
+camera_frames: dict[str, StoredFrame] = {}
+
+# Pushes "frame" (StoredFrame), "insight" and "partial" (dict) events to MJPEG/SSE clients
+broadcaster = Broadcaster(queue_size=STREAM_QUEUE_SIZE)
+
+# Recent frames and insights, queryable by time and sequence
+history = History(
+    memory_bytes=HISTORY_MEMORY_BYTES,
+    segment_dir=HISTORY_DIR,
+    segment_bytes=HISTORY_SEGMENT_BYTES,
+    max_entries=HISTORY_MAX_ENTRIES,
+)
+
+# --- Metrics (served on GET /metrics) ---
+HTTP_REQUEST_SECONDS = histogram("http_request_seconds", "Seconds until the response started, by route and status",
+                                 ("method", "route", "status"))
+STREAM_SUBSCRIBERS = gauge("gateway_stream_subscribers", "Connected MJPEG/SSE clients")
+HISTORY_ENTRIES = gauge("gateway_history_entries", "Frames and insights in the history")
+STREAM_SUBSCRIBERS.set_function(lambda: broadcaster.stats()["subscribers"])
+HISTORY_ENTRIES.set_function(lambda: history.stats()["entries"])
 
 client_id = f'python-mqtt-{random.randint(0, 1000)}'
 
@@ -33,6 +96,13 @@ client_id = f'python-mqtt-{random.randint(0, 1000)}'
 # Use protocol version 5 for newer features if your broker supports it, otherwise use VERSION4
 mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
 
+# Paho's network thread hands messages to the event loop; decoding runs on a thread pool
+publish_tracker = PublishTracker() # MQTT bytes out and publish/ack latency
+# Streamed tokens are recorded under their wildcard, so frame ids don't add metric series
+mqtt_bridge = MqttBridge(mqtt_client, publish_tracker, decode_threads=INGEST_THREADS,
+                         topic_label=lambda topic: MQTT_TOPIC_LLM_PARTIAL
+                         if mqtt.topic_matches_sub(MQTT_TOPIC_LLM_PARTIAL, topic) else topic)
+
 # --- MQTT Callbacks ---
 
 # Callback when the client connects to the MQTT broker
@@ -42,92 +112,144 @@ def on_connect(client, userdata, flags, rc, properties):
         # Subscribe to the image topic after connecting
         client.subscribe(MQTT_TOPIC)
         print(f"Subscribed to topic: {MQTT_TOPIC}")
+        client.subscribe(MQTT_CAMERA_TOPICS)
+        print(f"Subscribed to per-camera topics: {MQTT_CAMERA_TOPICS}")
 
         # Subscribe to the LLM response topic
         client.subscribe(MQTT_TOPIC_LLM)
         print(f"Subscribed to LLM response topic: {MQTT_TOPIC_LLM}")
+        client.subscribe(MQTT_TOPIC_LLM_PARTIAL)
+        print(f"Subscribed to streamed LLM tokens: {MQTT_TOPIC_LLM_PARTIAL}")
+        client.subscribe(MQTT_TOPIC_LLM_STATUS)
+        print(f"Subscribed to LLM service status: {MQTT_TOPIC_LLM_STATUS}")
     else:
         print(f"Failed to connect, return code {rc}\n")
 
-# Callback when a message is received from the MQTT broker
-def on_message(client, userdata, msg):
-    # Handle messages from the image topic
-    if msg.topic == MQTT_TOPIC:
-        global latest_image_payload, latest_image_media_type
-        print(f"Received message on topic {msg.topic}")
-        try:
-            # Assuming the payload is a JSON string containing base64 image data
-            payload_str = msg.payload.decode('utf-8')
-            message_data = json.loads(payload_str)
-
-            if "image" in message_data:
-                # Decode the base64 image string
-                latest_image_payload = base64.b64decode(message_data["image"])
-                print("Decoded image data received.")
-
-                # Check if the message includes a media type
-                if "type" in message_data:
-                    latest_image_media_type = message_data["type"]
-                    print(f"Image media type: {latest_image_media_type}")
-                else:
-                    # Reset to default if type is not provided
-                    latest_image_media_type = "image/jpeg"
-                    print(f"Image media type not provided, defaulting to: {latest_image_media_type}")
-
-
-            else:
-                print("Received message but no 'image' key found in payload.")
-                # Optionally handle other types of messages here
-                pass # Or handle messages without image data
-
-        except json.JSONDecodeError:
-            print("Failed to decode JSON payload.")
-            # Handle non-JSON messages if necessary
-        except base64.binascii.Error:
-            print("Failed to decode base64 image data.")
-        except Exception as e:
-            print(f"An error occurred while processing message: {e}")
-    elif msg.topic == MQTT_TOPIC_LLM:
-        global latest_llm_response
-        try:
-            # Assuming the payload is a plain text string from the LLM service
-            latest_llm_response = msg.payload.decode('utf-8')
-            print("Received text response from LLM topic.")
-            # print(f"LLM Response: {latest_llm_response}") # Uncomment for verbose output
-
-        except Exception as e:
-            print(f"An error occurred while processing message from LLM topic: {e}")
-
-    # Handle messages from any other subscribed topics (optional)
-    else:
-        print(f"Received message on unhandled topic: {msg.topic}")
-
-# Callback when message is published
-def on_publish(client, userdata, mid):
-    print(f"Message published with mid: {mid}")
-
-# Set the callbacks
+# Frames: decoded, hashed and added to the history on the thread pool
+def process_frame_message(msg, received_at):
+    log.debug(f"Received message on topic {msg.topic}")
+    try:
+        # Binary frame envelope, or the legacy JSON with base64 image data
+        frame = decode_frame(msg.payload)
+    except FrameDecodeError as e:
+        log.sampled("decode-failed", f"Failed to decode frame payload: {e}")
+        return None
+
+    # Hash once here; requests only compare ETags
+    camera_id = frame.camera_id or camera_id_from_topic(msg.topic) or "default"
+    stored = StoredFrame.from_frame(frame, camera_id, received_at)
+    history.add_frame(stored)
+    log.debug(f"Decoded {'legacy JSON' if frame.legacy else 'binary'} frame "
+              f"#{frame.sequence} from '{frame.camera_id}' ({frame.media_type}).")
+    return stored
+
+def is_newer_frame(stored):
+    """True if `stored` is newer than the camera's current frame (a restarted camera has lower sequences)."""
+    current = camera_frames.get(stored.camera_id)
+    return current is None or stored.sequence > current.sequence or stored.timestamp > current.timestamp
+
+def apply_frame(stored):
+    global latest_frame
+    # Frames replayed after a broker outage only go to the history; live clients keep the current image
+    if stored.buffered or not is_newer_frame(stored):
+        return
+    latest_frame = stored
+    camera_frames[stored.camera_id] = stored  # Keep the latest frame of every camera
+    broadcaster.publish("frame", stored)
+
+# LLM messages share one lane, so a frame's streamed tokens are never applied after its insight
+def process_llm_message(msg, received_at):
+    if msg.topic == MQTT_TOPIC_LLM_STATUS:
+        return apply_llm_status, decode_status(msg.payload)
+    if msg.topic != MQTT_TOPIC_LLM:
+        # Streamed tokens are only relayed to live clients, not stored
+        return apply_partial, json.loads(msg.payload)
+
+    # Structured insight message (or plain text from older LLM services)
+    insight = decode_insight(msg.payload)
+    insight["gateway_received_at"] = received_at
+    history.add_insight(
+        insight["text"],
+        insight["gateway_received_at"],
+        camera_id=insight.get("camera_id", ""),
+        sequence=insight.get("sequence", 0),
+        frame_id=insight.get("frame_id", ""),
+        meta=insight,
+    )
+    log.debug(f"Received LLM insight for frame {insight.get('frame_id', '(unknown)')}.")
+    return apply_insight, insight
+
+def apply_llm_message(result):
+    apply, data = result
+    apply(data)
+
+def apply_insight(insight):
+    global latest_llm_response, latest_insight
+    latest_llm_response = insight["text"]
+    latest_insight = insight
+    broadcaster.publish("insight", insight)
+    # print(f"LLM Response: {latest_llm_response}") # Uncomment for verbose output
+
+def apply_partial(partial):
+    broadcaster.publish("partial", partial)
+
+def apply_llm_status(status):
+    global llm_status
+    llm_status = status
+    tier = (llm_status or {}).get("load_tier")
+    print(f"LLM service status: {llm_status['state'] if llm_status else 'unknown'}"
+          + (f" (load tier {tier['level']})" if tier else ""))
+
+# Handle messages from any other subscribed topics (optional)
+def on_unhandled_message(msg):
+    print(f"Received message on unhandled topic: {msg.topic}")
+
+mqtt_bridge.add_lane("frame", lambda topic: topic == MQTT_TOPIC or mqtt.topic_matches_sub(MQTT_CAMERA_TOPICS, topic),
+                     process_frame_message, apply_frame, queue_size=INGEST_FRAME_QUEUE, workers=INGEST_WORKERS)
+mqtt_bridge.add_lane("llm", lambda topic: topic in (MQTT_TOPIC_LLM, MQTT_TOPIC_LLM_STATUS)
+                     or mqtt.topic_matches_sub(MQTT_TOPIC_LLM_PARTIAL, topic),
+                     process_llm_message, apply_llm_message, queue_size=INGEST_LLM_QUEUE)
+mqtt_bridge.unhandled = on_unhandled_message
+
+# Set the callbacks (the bridge sets on_message and on_publish)
 mqtt_client.on_connect = on_connect
-mqtt_client.on_message = on_message
-mqtt_client.on_publish = on_publish
 
 # --- FastAPI Events ---
 
 @app.on_event("startup")
 async def startup_event():
-    # Connect to the MQTT Broker and start the loop
+    # Stream clients are served on this loop; the MQTT thread hands events over to it
+    broadcaster.attach(asyncio.get_running_loop())
+
+    # Connect to the MQTT Broker and start the ingest workers
     # The on_connect callback will handle the subscription after successful connection
     print(f"Connecting to MQTT Broker at {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}...")
-    mqtt_client.connect_async(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60) # Use connect_async to avoid blocking startup
-    mqtt_client.loop_start() # Start the network loop in a background thread
+    await mqtt_bridge.start(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     # Stop the MQTT client loop and disconnect during shutdown
     print("Shutting down. Disconnecting MQTT client.")
-    mqtt_client.loop_stop()
-    mqtt_client.disconnect()
+    await mqtt_bridge.stop()
     print("MQTT client disconnected.")
+    history.close()
+
+# --- FastAPI Middleware ---
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Records the latency of every request under its route template, so ids in paths don't add series."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Streaming responses are timed until their headers are sent
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=route.path if route is not None else "unmatched", status=status)
 
 # --- FastAPI Endpoints ---
 
@@ -135,23 +257,37 @@ async def shutdown_event():
 async def read_root():
     return {"message": "API Gateway is up and running!"}
 
-@app.post("/send_data/")
-async def send_data(data: dict):
-    """Send data to the MQTT broker (original functionality)"""
-
+async def publish_or_raise(coroutine):
+    """Awaits a bridge publish, turning failures into HTTP errors."""
     try:
-        # Convert the data dictionary to a JSON string
-        payload = json.dumps(data)
-
-        # Publish data to the MQTT broker
-        result = mqtt_client.publish(MQTT_TOPIC, payload)
-        if result.rc != mqtt.MQTT_ERR_SUCCESS:
-            raise HTTPException(status_code=500, detail="Failed to publish message to MQTT Broker")
+        return await coroutine
+    except PublishError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"No acknowledgement from the MQTT broker within {PUBLISH_ACK_TIMEOUT:.0f}s")
 
-        return {"message": "Data sent successfully", "data": data}
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@app.post("/send_data/")
+async def send_data(data: dict, qos: int = Query(PUBLISH_QOS, ge=0, le=1)):
+    """Send data to the MQTT broker (original functionality); with qos=1, returns once the broker has it"""
+    # Convert the data dictionary to a JSON string and publish it
+    await publish_or_raise(mqtt_bridge.publish(MQTT_TOPIC, json.dumps(data), qos=qos, timeout=PUBLISH_ACK_TIMEOUT))
+    return {"message": "Data sent successfully", "data": data}
+
+@app.post("/send_data/batch")
+async def send_data_batch(messages: list[dict], qos: int = Query(PUBLISH_QOS, ge=0, le=1)):
+    """Send several data messages in one request; with qos=1, returns once the broker has all of them"""
+    if len(messages) > SEND_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {SEND_BATCH_MAX} messages per batch.")
+    start = time.perf_counter()
+    sent = await publish_or_raise(mqtt_bridge.publish_many(
+        MQTT_TOPIC, [json.dumps(data) for data in messages], qos=qos, timeout=PUBLISH_ACK_TIMEOUT))
+    return {"message": "Data sent successfully", "count": sent, "qos": qos,
+            "seconds": round(time.perf_counter() - start, 4)}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics of the gateway in the Prometheus text format."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
 
 @app.get("/status/")
 async def get_status():
@@ -163,20 +299,49 @@ async def get_status():
         "mqtt_host": MQTT_BROKER_HOST,
         "mqtt_port": MQTT_BROKER_PORT,
         "mqtt_connection": mqtt_connection_status,
-        "subscribed_topics": [MQTT_TOPIC, MQTT_TOPIC_LLM]
+        "subscribed_topics": [MQTT_TOPIC, MQTT_CAMERA_TOPICS, MQTT_TOPIC_LLM, MQTT_TOPIC_LLM_PARTIAL,
+                              MQTT_TOPIC_LLM_STATUS],
+        "llm_service": llm_status,
+        "cameras": sorted(camera_frames),
+        "ingest": mqtt_bridge.stats(),
+        "live_feed": broadcaster.stats(),
+        "latest_page": latest_page.stats(),
+        "history": history.stats()
+    }
+
+@app.get("/cameras/")
+async def list_cameras():
+    """Endpoint listing every camera that has sent a frame, with its latest frame metadata"""
+    return {
+        camera_id: {
+            "sequence": stored.sequence,
+            "timestamp": stored.timestamp,
+            "received_at": stored.received_at,
+            "faces": len(stored.boxes),
+            "etag": stored.etag,
+        }
+        for camera_id, stored in sorted(camera_frames.items())
     }
 
+@app.get("/cameras/{camera_id}/latest_image")
+async def get_camera_latest_image(camera_id: str, request: Request):
+    """Endpoint to retrieve the latest image received from one camera (supports If-None-Match)"""
+    stored = camera_frames.get(camera_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"No image received from camera '{camera_id}' yet.")
+
+    return frame_response(request, stored)
+
 @app.get("/latest_image/")
-async def get_latest_image():
-    """Endpoint to retrieve and display the latest received image"""
-    global latest_image_payload, latest_image_media_type
+async def get_latest_image(request: Request):
+    """Endpoint to retrieve and display the latest received image (supports If-None-Match)"""
+    stored = latest_frame  # Read once; replaced as a whole when a new frame arrives
 
-    if latest_image_payload is None:
+    if stored is None:
         raise HTTPException(status_code=404, detail="No image received yet.")
 
-    # Return the image bytes using StreamingResponse
-    # Use BytesIO to wrap the bytes data for StreamingResponse
-    return StreamingResponse(BytesIO(latest_image_payload), media_type=latest_image_media_type)
+    # Serve the stored bytes directly, or 304 if the client already has this frame
+    return frame_response(request, stored)
 
 @app.get("/latest_llm_insight/")
 async def get_latest_llm_insight():
@@ -186,16 +351,198 @@ async def get_latest_llm_insight():
     if latest_llm_response is None:
         raise HTTPException(status_code=404, detail="No LLM insight received yet.")
 
-    # Return the text response, perhaps wrapped in JSON
-    return JSONResponse(content={"llm_insight": latest_llm_response})
+    # Return the text response with the frame it describes and its timings
+    return JSONResponse(content={**latest_insight, "llm_insight": latest_llm_response})
+
+# --- History ---
+
+def history_entry_response(entry):
+    """Returns a history entry's payload: the image for frames, JSON for insights."""
+    data = history.read(entry)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"History entry {entry.id} has expired.")
+    if entry.kind == KIND_FRAME:
+        # Frames never change, so clients may cache them
+        headers = {"ETag": entry.etag, "Cache-Control": "max-age=86400, immutable",
+                   "X-Frame-Sequence": str(entry.sequence)}
+        return Response(content=data, media_type=entry.media_type, headers=headers)
+    return JSONResponse(content={**entry.describe(), "llm_insight": data.decode("utf-8")})
+
+@app.get("/history")
+async def get_history(
+    start: float | None = Query(None, alias="from", description="Earliest receive time (epoch seconds)"),
+    end: float | None = Query(None, alias="to", description="Latest receive time (epoch seconds)"),
+    camera: str | None = None,
+    kind: str | None = Query(None, pattern="^(frame|insight)$"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """Endpoint listing recent frames and insights received in a time range, oldest first"""
+    entries = history.query(start, end, camera_id=camera, kind=kind, limit=limit)
+    return {
+        "count": len(entries),
+        "entries": [{**entry.describe(), "url": f"/history/{entry.id}"} for entry in entries],
+    }
+
+@app.get("/history/{entry_id}")
+async def get_history_entry(entry_id: int):
+    """Endpoint returning one history entry by id"""
+    entry = history.get(entry_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"No history entry {entry_id}.")
+    return history_entry_response(entry)
+
+@app.get("/history/cameras/{camera_id}/{sequence}")
+async def get_history_frame(camera_id: str, sequence: int):
+    """Endpoint returning a past frame by its camera sequence number"""
+    entry = history.find(camera_id, sequence)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Frame #{sequence} from camera '{camera_id}' is not in the history.")
+    return history_entry_response(entry)
+
+# --- Frames and latency breakdown ---
+
+def _elapsed_ms(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start) * 1000, 1)
+
+def latency_breakdown(frame_entry, insight):
+    """
+    Returns the stage timestamps of a frame and the latency between consecutive stages.
+
+    Stages: capture -> camera publish -> LLM receive -> LLM start -> first token -> LLM done -> gateway.
+    Timestamps come from each service's clock, so cross-service figures assume synced clocks.
 
-@app.get("/latest/", response_class=HTMLResponse) # Specify response class as HTML
-async def get_latest_combined_html_feed():
+    Args:
+        frame_entry: The frame's HistoryEntry, or None if it has expired.
+        insight: The structured insight message, or None if none arrived.
     """
-    Endpoint to generate an HTML page displaying the latest image and LLM insight.
+    insight = insight or {}
+    frame_meta = (frame_entry.meta if frame_entry else None) or {}
+    stages = {
+        "captured_at": frame_entry.timestamp if frame_entry else insight.get("captured_at"),
+        "published_at": frame_meta.get("published_at", insight.get("published_at")),
+        "gateway_frame_received_at": frame_entry.received_at if frame_entry else None,
+        "llm_received_at": insight.get("llm_received_at"),
+        "llm_started_at": insight.get("llm_started_at"),
+        "llm_first_token_at": insight.get("llm_first_token_at"),
+        "llm_finished_at": insight.get("llm_finished_at"),
+        "gateway_insight_received_at": insight.get("gateway_received_at"),
+    }
+    latency_ms = {
+        "capture_to_publish": _elapsed_ms(stages["captured_at"], stages["published_at"]),
+        "publish_to_gateway": _elapsed_ms(stages["published_at"], stages["gateway_frame_received_at"]),
+        "publish_to_llm": _elapsed_ms(stages["published_at"], stages["llm_received_at"]),
+        "llm_queue_wait": _elapsed_ms(stages["llm_received_at"], stages["llm_started_at"]),
+        "llm_ttft": _elapsed_ms(stages["llm_started_at"], stages["llm_first_token_at"]),
+        "llm_inference": _elapsed_ms(stages["llm_started_at"], stages["llm_finished_at"]),
+        "llm_to_gateway": _elapsed_ms(stages["llm_finished_at"], stages["gateway_insight_received_at"]),
+        "end_to_end": _elapsed_ms(stages["captured_at"], stages["gateway_insight_received_at"]),
+    }
+    return stages, latency_ms
+
+@app.get("/frames/{frame_id}")
+async def get_frame(frame_id: str):
+    """Endpoint returning a frame's metadata, its LLM insight and a per-stage latency breakdown"""
+    frame_entry, insight_entry = history.find_by_frame_id(frame_id)
+    if frame_entry is None and insight_entry is None:
+        raise HTTPException(status_code=404, detail=f"Frame '{frame_id}' is not in the history.")
+
+    insight = insight_entry.meta if insight_entry else None
+    stages, latency_ms = latency_breakdown(frame_entry, insight)
+    return {
+        "frame_id": frame_id,
+        "camera_id": (frame_entry or insight_entry).camera_id,
+        "sequence": (frame_entry or insight_entry).sequence,
+        "image_url": f"/frames/{frame_id}/image" if frame_entry else None,
+        "faces": frame_entry.faces if frame_entry else None,
+        "llm_insight": insight.get("text") if insight else None,
+        "cached": insight.get("cached") if insight else None,
+        "stages": stages,
+        "latency_ms": latency_ms,
+    }
+
+@app.get("/frames/{frame_id}/image")
+async def get_frame_image(frame_id: str):
+    """Endpoint returning the image of a frame by its id"""
+    frame_entry, _ = history.find_by_frame_id(frame_id)
+    if frame_entry is None:
+        raise HTTPException(status_code=404, detail=f"Frame '{frame_id}' is not in the history.")
+    return history_entry_response(frame_entry)
+
+# --- Live feed ---
+
+MJPEG_BOUNDARY = "frame"
+
+def frame_event(stored):
+    """Returns the metadata pushed to SSE clients for a frame (the image itself is on the MJPEG stream)."""
+    return {
+        "camera_id": stored.camera_id,
+        "sequence": stored.sequence,
+        "timestamp": stored.timestamp,
+        "received_at": stored.received_at,
+        "faces": len(stored.boxes),
+        "boxes": stored.boxes,
+        "etag": stored.etag,
+        "frame_id": stored.frame_id,
+    }
+
+def insight_event(insight):
+    """Returns the data pushed to SSE clients for an insight."""
+    return {**insight, "llm_insight": insight["text"]}
+
+async def mjpeg_parts(camera_id=None):
+    """Yields multipart/x-mixed-replace parts, starting with the current frame."""
+    with broadcaster.subscribe(kinds=("frame",)) as subscription:
+        stored = camera_frames.get(camera_id) if camera_id else latest_frame
+        while True:
+            if stored is not None and (camera_id is None or stored.camera_id == camera_id):
+                # Part header and image are sent as separate chunks so the stored bytes are not copied
+                yield (f"--{MJPEG_BOUNDARY}\r\nContent-Type: {stored.media_type}\r\n"
+                       f"Content-Length: {len(stored.image)}\r\n\r\n").encode("ascii")
+                yield stored.image
+                yield b"\r\n"
+            _, stored = await subscription.get()
+
+async def sse_events(camera_id=None):
+    """Yields Server-Sent Events for new frames and LLM insights."""
+    with broadcaster.subscribe() as subscription:
+        if latest_insight is not None:
+            yield f"event: insight\ndata: {json.dumps(insight_event(latest_insight))}\n\n"
+        while True:
+            event = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            kind, data = event
+            if kind == "frame":
+                if camera_id and data.camera_id != camera_id:
+                    continue
+                payload = frame_event(data)
+            elif kind == "partial":
+                payload = data
+            else:
+                payload = insight_event(data)
+            yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+@app.get("/stream/mjpeg")
+async def stream_mjpeg(camera: str | None = None):
+    """MJPEG stream of incoming frames (optionally one camera); slow clients skip frames"""
+    return StreamingResponse(mjpeg_parts(camera), media_type=f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.get("/stream/events")
+async def stream_events(camera: str | None = None):
+    """Server-Sent Events with frame metadata, streamed LLM tokens and LLM insights as they arrive on MQTT"""
+    return StreamingResponse(sse_events(camera), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def render_latest_page():
     """
-    global latest_image_payload, latest_image_media_type, latest_llm_response
+    Builds the HTML page displaying the live image stream and LLM insight.
 
+    Called only when the frame or insight shown changed (see latest_page below).
+    """
     # Start building the HTML response
     html_content = """
     <!DOCTYPE html>
@@ -203,48 +550,77 @@ async def get_latest_combined_html_feed():
     <head>
         <title>Latest Camera Feed and LLM Insight</title>
         <style>
-            body {{ font-family: sans-serif; margin: 20px; }}
-            img {{ max-width: 100%; height: auto; display: block; margin: 20px auto; border: 1px solid #ccc; }}
-            .insight {{ margin-top: 20px; padding: 15px; border: 1px solid #eee; background-color: #f9f9f9; }}
+            body { font-family: sans-serif; margin: 20px; }
+            img { max-width: 100%; height: auto; display: block; margin: 20px auto; border: 1px solid #ccc; }
+            .insight { margin-top: 20px; padding: 15px; border: 1px solid #eee; background-color: #f9f9f9; }
+            #insight { white-space: pre-wrap; }
         </style>
     </head>
     <body>
         <h1>Latest Camera Feed and LLM Insight</h1>
     """
 
-    if latest_image_payload is not None:
-        # Encode image bytes to base64 for embedding in HTML
-        try:
-            base64_image_string = base64.b64encode(latest_image_payload).decode('utf-8')
-            # Construct the image data URL
-            img_src = f"data:{latest_image_media_type};base64,{base64_image_string}"
-            html_content += f'<img src="{img_src}" alt="Latest Camera Image">'
-        except Exception as e:
-            print(f"Error encoding image to base64 for HTML: {e}")
-            html_content += "<p style='color: red;'>Error displaying image.</p>"
-    else:
-        html_content += "<p>No image received yet.</p>"
+    # The browser keeps the MJPEG stream open and swaps in each new frame
+    html_content += '<img src="/stream/mjpeg" alt="Live Camera Stream">'
+    stored = latest_frame
+    frame_info = (f"Camera {html.escape(stored.camera_id)} #{stored.sequence}, {len(stored.boxes)} face(s)"
+                  if stored is not None else "")
+    html_content += f"<p id='frame-info'>{frame_info}</p>"
 
-    # Add the LLM insight
+    # Add the LLM insight; updated in place from the event stream
     html_content += "<div class='insight'><h2>LLM Insight:</h2>"
     if latest_llm_response is not None:
         # Escape HTML special characters in the LLM response to prevent issues
-        # A simple way is replace < > & " '
-        import html # Import the html module
-        escaped_llm_response = html.escape(latest_llm_response)
-        # Replace newlines with <br> for basic formatting in HTML
-        formatted_llm_response = escaped_llm_response.replace('\n', '<br>')
-        html_content += f"<p>{formatted_llm_response}</p>"
+        html_content += f"<p id='insight'>{html.escape(latest_llm_response)}</p>"
     else:
-        html_content += "<p>No LLM insight received yet.</p>"
+        html_content += "<p id='insight'>No LLM insight received yet.</p>"
+    # The insight may describe an earlier frame than the one on screen; link to the one it belongs to
+    frame_id = (latest_insight or {}).get("frame_id")
+    frame_link = f"<a href='/frames/{html.escape(quote(frame_id))}'>frame {html.escape(frame_id)}</a>" if frame_id else ""
+    html_content += f"<p id='insight-frame'>{frame_link}</p>"
     html_content += "</div>" # Close insight div
 
-
     html_content += """
+    <script>
+        const events = new EventSource("/stream/events");
+        events.addEventListener("insight", (e) => {
+            const insight = JSON.parse(e.data);
+            document.getElementById("insight").textContent = insight.llm_insight;
+            const link = document.getElementById("insight-frame");
+            link.innerHTML = "";
+            if (insight.frame_id) {
+                const a = document.createElement("a");
+                a.href = "/frames/" + encodeURIComponent(insight.frame_id);
+                a.textContent = "frame " + insight.frame_id;
+                link.appendChild(a);
+            }
+        });
+        events.addEventListener("partial", (e) => {
+            // Text generated so far, while the LLM is still streaming
+            document.getElementById("insight").textContent = JSON.parse(e.data).text + " …";
+        });
+        events.addEventListener("frame", (e) => {
+            const frame = JSON.parse(e.data);
+            document.getElementById("frame-info").textContent =
+                `Camera ${frame.camera_id} #${frame.sequence}, ${frame.faces} face(s)`;
+        });
+    </script>
     </body>
     </html>
     """
 
-    # Return the complete HTML content with the correct media type
-    return HTMLResponse(content=html_content)
+    return html_content
+
+# Rendered once per frame/insight pair; compressed variants are cached alongside
+latest_page = CachedPage("latest", render_latest_page)
 
+@app.get("/latest/", response_class=HTMLResponse) # Specify response class as HTML
+async def get_latest_combined_html_feed(request: Request):
+    """
+    Endpoint serving the HTML page with the live image stream and LLM insight (gzip/br, If-None-Match).
+    """
+    stored = latest_frame
+    # The page shows the latest frame's sequence and the latest insight; re-render when either changes
+    frame_key = (stored.camera_id, stored.sequence, stored.timestamp) if stored is not None else None
+    insight_key = latest_insight.get("gateway_received_at") if latest_insight is not None else None
+    return latest_page.response(request, (frame_key, insight_key))
@@ -0,0 +1,121 @@
+# api_gateway/broadcast.py
+#
+# Fan-out of MQTT events to asyncio subscribers (MJPEG and SSE clients).
+#
+# The paho callback thread hands each event to the event loop once; the loop then
+# puts the same object into every subscriber's small queue, so the payload is never
+# copied per subscriber. A subscriber that falls behind loses its oldest queued
+# events instead of buffering without bound.
+
+import asyncio
+import threading
+
+
+class Subscription:
+    """A subscriber's bounded queue of (kind, data) events."""
+
+    def __init__(self, broadcaster, kinds, queue_size):
+        self._broadcaster = broadcaster
+        self.kinds = kinds
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.delivered = 0
+        self.dropped = 0
+
+    def offer(self, kind, data):
+        """Queues an event, dropping the oldest queued one if full. Runs on the event loop."""
+        if self.kinds is not None and kind not in self.kinds:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self._broadcaster.dropped += 1
+        self.queue.put_nowait((kind, data))
+        self.delivered += 1
+
+    async def get(self, timeout=None):
+        """
+        Waits for the next event.
+
+        Returns:
+            A (kind, data) tuple, or None if `timeout` seconds passed without an event.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Broadcaster:
+    """Thread-safe publisher, asyncio subscribers."""
+
+    def __init__(self, queue_size=2):
+        """
+        Args:
+            queue_size: Events buffered per subscriber before the oldest are dropped.
+        """
+        self.queue_size = max(1, queue_size)
+        self._loop = None
+        self._subscribers = set()
+        self._lock = threading.Lock()  # Guards the counters updated from the MQTT thread
+        self.published = 0
+        self.skipped = 0  # Published before the event loop was attached
+        self.dropped = 0  # Events discarded from full subscriber queues (slow clients)
+
+    def attach(self, loop):
+        """Binds the broadcaster to the event loop its subscribers run on."""
+        self._loop = loop
+
+    def publish(self, kind, data):
+        """
+        Publishes an event to all current subscribers. Safe to call from any thread.
+
+        Args:
+            kind: Event kind, e.g. "frame" or "insight".
+            data: The event object; shared by reference with every subscriber.
+        """
+        loop = self._loop
+        with self._lock:
+            if loop is None or loop.is_closed():
+                self.skipped += 1
+                return
+            self.published += 1
+        loop.call_soon_threadsafe(self._fan_out, kind, data)
+
+    def _fan_out(self, kind, data):
+        for subscription in list(self._subscribers):
+            subscription.offer(kind, data)
+
+    def subscribe(self, kinds=None):
+        """
+        Registers a new subscriber. Must be called on the event loop.
+
+        Args:
+            kinds: Event kinds to receive, or None for all.
+
+        Returns:
+            A Subscription, usable as a context manager that unsubscribes on exit.
+        """
+        subscription = Subscription(self, set(kinds) if kinds else None, self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def stats(self):
+        """Returns subscriber and drop counters."""
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+        }
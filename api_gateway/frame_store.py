@@ -0,0 +1,108 @@
+# api_gateway/frame_store.py
+#
+# Immutable snapshots of received frames and conditional-GET helpers.
+#
+# A frame is hashed once when it arrives from MQTT. Requests then only compare the
+# client's If-None-Match against the stored ETag and serve the existing bytes
+# object directly, without copying it into a stream.
+
+import hashlib
+import time
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Response
+
+
+@dataclass(frozen=True)
+class StoredFrame:
+    """The latest frame of a camera, as served by the gateway."""
+    image: bytes
+    media_type: str
+    camera_id: str
+    frame_id: str  # See shared.frame_codec.make_frame_id()
+    sequence: int
+    timestamp: float  # Capture time reported by the camera
+    published_at: float | None  # Time the camera published the frame, if reported
+    received_at: float  # Time the gateway received the frame
+    boxes: tuple
+    etag: str  # Quoted strong ETag, derived from the image bytes
+    last_modified: str  # HTTP date of received_at
+    buffered: bool = False  # Replayed from the camera's offline buffer after a broker outage
+
+    @classmethod
+    def from_frame(cls, frame, camera_id, received_at=None):
+        """
+        Builds a StoredFrame from a decoded shared.frame_codec.Frame, hashing the image once.
+
+        Args:
+            frame: The decoded frame.
+            camera_id: Camera id the frame is stored under.
+            received_at: Receive time (defaults to now).
+        """
+        received_at = time.time() if received_at is None else received_at
+        digest = hashlib.blake2b(frame.image, digest_size=16).hexdigest()
+        return cls(
+            image=frame.image,
+            media_type=frame.media_type,
+            camera_id=camera_id,
+            frame_id=frame.frame_id,
+            sequence=frame.sequence,
+            timestamp=frame.timestamp,
+            published_at=frame.published_at,
+            received_at=received_at,
+            boxes=tuple(frame.boxes),
+            etag=f'"{digest}"',
+            last_modified=formatdate(received_at, usegmt=True),
+            buffered=bool(frame.meta.get("buffered")),
+        )
+
+
+def is_not_modified(headers, stored):
+    """
+    Evaluates a conditional GET against a stored frame.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110.
+
+    Args:
+        headers: The request headers.
+        stored: The StoredFrame that would be served.
+
+    Returns:
+        True if the client's copy is current and a 304 should be sent.
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison: W/"x" matches "x"
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return stored.etag in tags
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have one-second resolution
+        return int(stored.received_at) <= since
+    return False
+
+
+def frame_response(request, stored):
+    """
+    Returns the stored frame as a Response over its existing bytes, or a 304.
+
+    Clients are told to revalidate every time (no-cache), so polling stays current
+    while unchanged frames cost only the headers.
+    """
+    headers = {
+        "ETag": stored.etag,
+        "Last-Modified": stored.last_modified,
+        "Cache-Control": "no-cache",
+        "X-Frame-Sequence": str(stored.sequence),
+    }
+    if is_not_modified(request.headers, stored):
+        return Response(status_code=304, headers=headers)
+    return Response(content=stored.image, media_type=stored.media_type, headers=headers)
@@ -0,0 +1,392 @@
+# api_gateway/history.py
+#
+# Bounded, time-indexed history of received frames and LLM insights.
+#
+# Recent payloads are kept in memory up to a byte budget. Older payloads are moved
+# ("spilled") to memory-mapped, append-only segment files on disk; only their small
+# index entries stay in memory. Two fixed-size segments are used in turn, and when
+# the writer wraps around to a segment, the entries stored in it are dropped from the
+# index. Memory and disk usage therefore stay flat however long the gateway runs.
+#
+# Entries get consecutive ids and non-decreasing receive times, so lookups by id are
+# direct and time-range queries use binary search. Frames a camera replays from its
+# offline buffer after a broker outage arrive long after they were captured. They are
+# time-indexed by capture time in a separate sorted index, which queries merge in.
+# History is not kept across restarts.
+
+import bisect
+import heapq
+import mmap
+import os
+import threading
+from dataclasses import dataclass
+
+KIND_FRAME = "frame"
+KIND_INSIGHT = "insight"
+
+SEGMENT_COUNT = 2
+
+
+@dataclass(slots=True)
+class HistoryEntry:
+    """Index entry for one frame or insight. The payload is in memory or in a segment."""
+    id: int
+    kind: str
+    camera_id: str
+    sequence: int
+    timestamp: float  # Capture time reported by the camera (frames)
+    received_at: float  # Gateway receive time; the time index
+    media_type: str
+    size: int
+    etag: str = ""
+    faces: int = 0
+    frame_id: str = ""
+    meta: dict | None = None  # Frames: {"published_at"}; insights: the structured insight message
+    data: bytes | None = None  # Payload while in memory
+    segment: int = -1  # Segment number once spilled
+    offset: int = 0
+    buffered: bool = False  # Frame replayed from the camera's offline buffer; time-indexed by capture time
+
+    def describe(self):
+        """Returns the entry's metadata as a JSON-serialisable dict."""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "frame_id": self.frame_id,
+            "camera_id": self.camera_id,
+            "sequence": self.sequence,
+            "timestamp": self.timestamp,
+            "received_at": self.received_at,
+            "media_type": self.media_type,
+            "size": self.size,
+            "faces": self.faces,
+            "on_disk": self.data is None,
+            "buffered": self.buffered,
+        }
+
+
+def _index_time(entry):
+    """The time an entry is found under in time-range queries."""
+    return entry.timestamp if entry.buffered else entry.received_at
+
+
+class _Segment:
+    """A preallocated, memory-mapped append-only file."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.used = 0
+        with open(path, "w+b") as f:
+            f.truncate(size)  # Sparse on most filesystems
+            self.mm = mmap.mmap(f.fileno(), size)
+
+    def append(self, data):
+        """Appends `data` and returns its offset, or None if it does not fit."""
+        if self.used + len(data) > self.size:
+            return None
+        offset = self.used
+        self.mm[offset:offset + len(data)] = data
+        self.used += len(data)
+        return offset
+
+    def read(self, offset, size):
+        return self.mm[offset:offset + size]
+
+    def reset(self):
+        self.used = 0
+
+    def close(self):
+        self.mm.close()
+
+
+class History:
+    """Ring buffer of frames and insights with a memory budget and disk spill."""
+
+    def __init__(self, memory_bytes=32 * 1024 * 1024, segment_dir=None, segment_bytes=128 * 1024 * 1024,
+                 max_entries=50000):
+        """
+        Args:
+            memory_bytes: Budget for payload bytes kept in memory.
+            segment_dir: Directory for the segment files; None or "" disables spilling.
+            segment_bytes: Size of each of the two segment files.
+            max_entries: Upper bound on index entries (including spilled ones).
+        """
+        self.memory_bytes = memory_bytes
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+
+        self._entries = []  # Ordered by id (and received_at); live entries start at _start
+        self._times = []  # received_at of each entry, parallel to _entries, for bisect
+        self._start = 0
+        self._spill_cursor = 0  # Index of the oldest entry still held in memory
+        self._next_id = 1
+        self._last_time = 0.0
+        self._by_camera = {}  # camera_id -> ([sequence, ...], [entry id, ...]), sorted by sequence
+        self._live_sequence = {}  # camera_id -> sequence of the camera's last live (not replayed) frame
+        self._replayed_times = []  # Capture times of replayed frames, sorted
+        self._replayed_ids = []  # Entry ids parallel to _replayed_times
+        self._by_frame_id = {}  # frame_id -> {"frame": entry id, "insight": entry id}
+
+        self._segments = []
+        self._current_segment = 0
+        if segment_dir:
+            os.makedirs(segment_dir, exist_ok=True)
+            self._segments = [
+                _Segment(os.path.join(segment_dir, f"history-{i}.seg"), segment_bytes)
+                for i in range(SEGMENT_COUNT)
+            ]
+
+        self.memory_used = 0
+        self.spilled = 0
+        self.evicted = 0
+
+    # --- Writing ---
+
+    def add_frame(self, stored):
+        """Records a api_gateway.frame_store.StoredFrame. Returns the entry id."""
+        return self._add(HistoryEntry(
+            id=0, kind=KIND_FRAME, camera_id=stored.camera_id, sequence=stored.sequence,
+            timestamp=stored.timestamp, received_at=stored.received_at, media_type=stored.media_type,
+            size=len(stored.image), etag=stored.etag, faces=len(stored.boxes), data=stored.image,
+            frame_id=stored.frame_id, meta={"published_at": stored.published_at}, buffered=stored.buffered,
+        ))
+
+    def add_insight(self, text, received_at, camera_id="", sequence=0, frame_id="", meta=None):
+        """
+        Records an LLM insight. Returns the entry id.
+
+        Args:
+            text: The insight text.
+            received_at: Gateway receive time.
+            camera_id, sequence, frame_id: The frame the insight describes, if known.
+            meta: The structured insight message (timings etc.).
+        """
+        data = text.encode("utf-8")
+        return self._add(HistoryEntry(
+            id=0, kind=KIND_INSIGHT, camera_id=camera_id, sequence=sequence, timestamp=received_at,
+            received_at=received_at, media_type="text/plain; charset=utf-8", size=len(data), data=data,
+            frame_id=frame_id, meta=meta,
+        ))
+
+    def _add(self, entry):
+        with self._lock:
+            entry.id = self._next_id
+            self._next_id += 1
+            # Keep the time index sorted even if the wall clock steps back
+            entry.received_at = max(entry.received_at, self._last_time)
+            self._last_time = entry.received_at
+
+            self._entries.append(entry)
+            self._times.append(entry.received_at)
+            self.memory_used += entry.size
+            if entry.kind == KIND_FRAME:
+                self._index_camera(entry)
+            if entry.buffered:
+                index = bisect.bisect_right(self._replayed_times, entry.timestamp)
+                self._replayed_times.insert(index, entry.timestamp)
+                self._replayed_ids.insert(index, entry.id)
+            if entry.frame_id:
+                self._by_frame_id.setdefault(entry.frame_id, {})[entry.kind] = entry.id
+
+            self._spill()
+            while len(self._entries) - self._start > self.max_entries:
+                self._evict_oldest()
+            self._compact()
+            return entry.id
+
+    def _index_camera(self, entry):
+        sequences, ids = self._by_camera.setdefault(entry.camera_id, ([], []))
+        if not entry.buffered:
+            last = self._live_sequence.get(entry.camera_id)
+            if last is not None and entry.sequence <= last:
+                # The camera restarted its sequence; older frames stay reachable by time and id
+                sequences.clear()
+                ids.clear()
+            self._live_sequence[entry.camera_id] = entry.sequence
+        # Replayed frames fall between live ones; live frames almost always go at the end
+        index = bisect.bisect_left(sequences, entry.sequence)
+        if index < len(sequences) and sequences[index] == entry.sequence:
+            ids[index] = entry.id  # Replayed twice (at-least-once delivery): the newest copy wins
+        else:
+            sequences.insert(index, entry.sequence)
+            ids.insert(index, entry.id)
+
+    def _spill(self):
+        """Moves the oldest in-memory payloads to disk (or drops them) until within budget."""
+        while self.memory_used > self.memory_bytes and self._spill_cursor < len(self._entries):
+            entry = self._entries[self._spill_cursor]
+            if entry.data is not None:
+                if self._segments and self._write_segment(entry):
+                    self.spilled += 1
+                else:
+                    self._evict_through(self._spill_cursor)
+                    continue
+                self.memory_used -= entry.size
+                entry.data = None
+            self._spill_cursor += 1
+
+    def _write_segment(self, entry):
+        if entry.size > self._segments[0].size:
+            return False
+        segment = self._segments[self._current_segment]
+        offset = segment.append(entry.data)
+        if offset is None:
+            # Wrap to the next segment, dropping whatever it still holds
+            self._current_segment = (self._current_segment + 1) % len(self._segments)
+            self._drop_segment(self._current_segment)
+            segment = self._segments[self._current_segment]
+            offset = segment.append(entry.data)
+        entry.segment = self._current_segment
+        entry.offset = offset
+        return True
+
+    def _drop_segment(self, number):
+        # Spilled entries are written in id order, so the reused segment's entries are the oldest
+        while self._start < len(self._entries) and self._entries[self._start].segment == number:
+            self._evict_oldest()
+        self._segments[number].reset()
+
+    def _evict_through(self, index):
+        while self._start <= index:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        entry = self._entries[self._start]
+        self._entries[self._start] = None
+        self._start += 1
+        self._spill_cursor = max(self._spill_cursor, self._start)
+        if entry.data is not None:
+            self.memory_used -= entry.size
+        self.evicted += 1
+
+    def _compact(self):
+        """Drops evicted slots from the front of the index lists once they make up half of them."""
+        if self._start < 1024 or self._start * 2 < len(self._entries):
+            return
+        del self._entries[:self._start]
+        del self._times[:self._start]
+        self._spill_cursor -= self._start
+        self._start = 0
+        first_id = self._entries[0].id if self._entries else self._next_id
+        # Replayed frames put ids out of order in these indexes, so they are filtered rather than cut
+        for camera_id, (sequences, ids) in list(self._by_camera.items()):
+            kept = [i for i, entry_id in enumerate(ids) if entry_id >= first_id]
+            if not kept:
+                del self._by_camera[camera_id]
+            elif len(kept) < len(ids):
+                sequences[:] = [sequences[i] for i in kept]
+                ids[:] = [ids[i] for i in kept]
+        kept = [i for i, entry_id in enumerate(self._replayed_ids) if entry_id >= first_id]
+        self._replayed_times = [self._replayed_times[i] for i in kept]
+        self._replayed_ids = [self._replayed_ids[i] for i in kept]
+        self._by_frame_id = {
+            frame_id: linked for frame_id, linked in self._by_frame_id.items()
+            if max(linked.values()) >= first_id
+        }
+
+    # --- Reading ---
+
+    def _get_locked(self, entry_id):
+        if not self._entries or self._start >= len(self._entries):
+            return None
+        index = entry_id - self._entries[self._start].id + self._start
+        if self._start <= index < len(self._entries):
+            return self._entries[index]
+        return None
+
+    def get(self, entry_id):
+        """Returns the HistoryEntry with `entry_id`, or None if unknown or evicted."""
+        with self._lock:
+            return self._get_locked(entry_id)
+
+    def find(self, camera_id, sequence):
+        """Returns the frame entry with the given camera sequence number, or None."""
+        with self._lock:
+            sequences, ids = self._by_camera.get(camera_id, ((), ()))
+            index = bisect.bisect_left(sequences, sequence)
+            if index < len(sequences) and sequences[index] == sequence:
+                return self._get_locked(ids[index])
+            return None
+
+    def find_by_frame_id(self, frame_id):
+        """
+        Returns the (frame entry, insight entry) recorded for a frame id.
+
+        Either may be None: the frame may have expired, or no insight has arrived (yet).
+        """
+        with self._lock:
+            linked = self._by_frame_id.get(frame_id, {})
+            frame = self._get_locked(linked[KIND_FRAME]) if KIND_FRAME in linked else None
+            insight = self._get_locked(linked[KIND_INSIGHT]) if KIND_INSIGHT in linked else None
+            return frame, insight
+
+    def query(self, start=None, end=None, camera_id=None, kind=None, limit=100):
+        """
+        Returns entries received in [start, end], oldest first. Replayed frames count
+        as received when they were captured.
+
+        Args:
+            start: Earliest receive time (epoch seconds), or None for the oldest entry.
+            end: Latest receive time, or None for the newest entry.
+            camera_id: Only entries from this camera.
+            kind: Only "frame" or "insight" entries.
+            limit: Maximum number of entries returned.
+        """
+        with self._lock:
+            low = self._start if start is None else bisect.bisect_left(self._times, start, lo=self._start)
+            high = len(self._entries) if end is None else bisect.bisect_right(self._times, end, lo=self._start)
+            def matches(entry):
+                return ((camera_id is None or entry.camera_id == camera_id)
+                        and (kind is None or entry.kind == kind))
+
+            results = []
+            for entry in self._entries[low:high]:
+                if entry.buffered or not matches(entry):
+                    continue
+                results.append(entry)
+                if len(results) >= limit:
+                    break
+
+            if not self._replayed_ids or kind == KIND_INSIGHT:
+                return results
+            low = 0 if start is None else bisect.bisect_left(self._replayed_times, start)
+            high = len(self._replayed_times) if end is None else bisect.bisect_right(self._replayed_times, end)
+            replayed = []
+            for entry_id in self._replayed_ids[low:high]:
+                entry = self._get_locked(entry_id)
+                if entry is None or not matches(entry):
+                    continue
+                replayed.append(entry)
+                if len(replayed) >= limit:
+                    break
+            return list(heapq.merge(results, replayed, key=_index_time))[:limit]
+
+    def read(self, entry):
+        """Returns the payload bytes of `entry`, or None if it has been evicted meanwhile."""
+        with self._lock:
+            if self._get_locked(entry.id) is not entry:
+                return None
+            if entry.data is not None:
+                return entry.data
+            return self._segments[entry.segment].read(entry.offset, entry.size)
+
+    def stats(self):
+        """Returns entry counts and memory/disk usage."""
+        with self._lock:
+            live = len(self._entries) - self._start
+            return {
+                "entries": live,
+                "in_memory": len(self._entries) - self._spill_cursor,
+                "memory_bytes": self.memory_used,
+                "memory_budget": self.memory_bytes,
+                "disk_bytes": sum(segment.used for segment in self._segments),
+                "oldest": self._times[self._start] if live else None,
+                "newest": self._times[-1] if live else None,
+                "spilled": self.spilled,
+                "evicted": self.evicted,
+            }
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
@@ -0,0 +1,295 @@
+# api_gateway/mqtt_bridge.py
+#
+# Hands MQTT traffic between paho's network thread and the FastAPI event loop.
+#
+# Incoming: paho's thread only records the message and hands it to the loop. There
+# it goes into the bounded queue of its lane (frames, insights, ...). Each lane's
+# workers run the lane's `process` step (decoding, hashing, history writes) on a
+# thread pool, so the loop never decodes. Then they run its `apply` step on the loop,
+# which is the only place gateway state is updated. A lane with several workers gives
+# each its own queue and sends all messages of a topic to the same one, so each
+# camera's frames stay in order. A full queue drops its oldest
+# message and counts it: a burst cannot build an unbounded backlog, and paho's reader
+# never blocks. Lanes whose messages must not be lost get a queue large enough for them.
+#
+# Outgoing: publish_nowait() returns once paho has queued the message. For QoS > 0 it
+# returns an asyncio future that resolves when the broker's PUBACK arrives; publish()
+# and publish_many() await those.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import paho.mqtt.client as mqtt
+
+from shared.metrics import counter, gauge, histogram
+from shared.mqtt_metrics import record_received
+
+INGEST_DROPPED = counter("gateway_ingest_dropped_total", "Incoming MQTT messages dropped from a full ingest queue", ("lane",))
+INGEST_PROCESSED = counter("gateway_ingest_processed_total", "Incoming MQTT messages processed", ("lane", "outcome"))
+INGEST_QUEUE_DEPTH = gauge("gateway_ingest_queue_depth", "Incoming MQTT messages waiting to be processed", ("lane",))
+INGEST_WAIT_SECONDS = histogram("gateway_ingest_wait_seconds", "Seconds a message waited in the ingest queue", ("lane",))
+INGEST_PROCESS_SECONDS = histogram("gateway_ingest_process_seconds", "Seconds spent processing a message", ("lane",))
+
+MAX_EARLY_ACKS = 1024  # Acks for mids published outside the bridge would otherwise pile up
+
+
+class PublishError(Exception):
+    """Raised when paho rejects a message or the broker refuses it."""
+
+
+@dataclass
+class Lane:
+    """Messages of one kind, with their own queue, workers and processing steps."""
+    name: str
+    matches: object  # Callable(topic) -> bool
+    process: object  # Callable(msg, received_at) -> result, run on the thread pool
+    apply: object = None  # Callable(result), run on the event loop; skipped (outcome "ignored") if result is None
+    queue_size: int = 64
+    workers: int = 1
+    queues: list = None  # One asyncio.Queue per worker
+    processed: int = 0
+    dropped: int = 0
+    failed: int = 0
+
+    def queued(self):
+        return sum(queue.qsize() for queue in self.queues or ())
+
+
+class MqttBridge:
+    """Connects a paho client to an asyncio event loop."""
+
+    def __init__(self, client, publish_tracker=None, decode_threads=2, topic_label=None):
+        """
+        Args:
+            client: The paho client; the bridge installs its on_message, on_publish and
+                on_disconnect callbacks.
+            publish_tracker: Optional shared.mqtt_metrics.PublishTracker for publish metrics.
+            decode_threads: Threads running the lanes' `process` steps.
+            topic_label: Optional callable(topic) -> topic recorded in the MQTT metrics, e.g. to
+                record per-message topics under their wildcard.
+        """
+        self.client = client
+        self.publish_tracker = publish_tracker
+        self.topic_label = topic_label or (lambda topic: topic)
+        self.decode_threads = max(1, decode_threads)
+        self.lanes = []
+        self.unhandled = None  # Callable(msg) for topics no lane matches, run on paho's thread
+        self.skipped = 0  # Received before the bridge was started
+        self._loop = None
+        self._executor = None
+        self._tasks = []
+        # Never held while calling into paho: its callbacks run under paho's own locks
+        self._lock = threading.Lock()
+        self._acks = {}  # mid -> future waiting for the broker's PUBACK (None for QoS 0)
+        self._early_acks = {}  # mid -> reason code, for messages sent before publish_nowait() registered them
+        client.on_message = self._on_message
+        client.on_publish = self._on_publish
+        client.on_disconnect = self._on_disconnect
+
+    def add_lane(self, name, matches, process, apply=None, queue_size=64, workers=1):
+        """
+        Routes the messages whose topic satisfies `matches` through a new lane.
+
+        Args:
+            name: Lane name used in the metrics and stats.
+            matches: Callable(topic) -> bool. Lanes are tried in the order they were added.
+            process: Callable(msg, received_at) run on the thread pool. `received_at` is the
+                wall-clock time the message arrived.
+            apply: Callable(result) run on the event loop, e.g. to update the latest state.
+            queue_size: Messages buffered per worker before the oldest are dropped.
+            workers: Messages of this lane processed concurrently. Messages on the same topic
+                always go to the same worker, so they are processed in order.
+        """
+        lane = Lane(name, matches, process, apply, max(1, queue_size), max(1, workers))
+        self.lanes.append(lane)
+        return lane
+
+    async def start(self, host, port, keepalive=60):
+        """Starts the lane workers on the running loop, then connects paho on its own thread."""
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.decode_threads, thread_name_prefix="mqtt-ingest")
+        for lane in self.lanes:
+            lane.queues = [asyncio.Queue(maxsize=lane.queue_size) for _ in range(lane.workers)]
+            INGEST_QUEUE_DEPTH.set_function(lane.queued, lane=lane.name)
+            self._tasks.extend(self._loop.create_task(self._worker(lane, queue)) for queue in lane.queues)
+        # connect_async so an unreachable broker doesn't block startup; paho keeps retrying
+        self.client.connect_async(host, port, keepalive)
+        self.client.loop_start()
+
+    async def stop(self):
+        """Disconnects paho and stops the workers; queued messages are discarded."""
+        self.client.disconnect()
+        self.client.loop_stop()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        with self._lock:
+            acks, self._acks = self._acks, {}
+        for future in acks.values():
+            if future is not None and not future.done():
+                future.cancel()
+
+    # --- Incoming ---
+
+    def _on_message(self, client, userdata, msg):
+        """Runs on paho's thread: records the message and hands it to the loop."""
+        received_at = time.time()
+        lane = next((lane for lane in self.lanes if lane.matches(msg.topic)), None)
+        if lane is None:
+            if self.unhandled is not None:
+                self.unhandled(msg)
+            return
+        record_received(self.topic_label(msg.topic), msg.payload)
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self.skipped += 1
+            return
+        loop.call_soon_threadsafe(self._enqueue, lane, msg, received_at)
+
+    def _enqueue(self, lane, msg, received_at):
+        queue = lane.queues[hash(msg.topic) % len(lane.queues)]
+        if queue.full():
+            queue.get_nowait()
+            lane.dropped += 1
+            INGEST_DROPPED.inc(lane=lane.name)
+        queue.put_nowait((msg, received_at, time.perf_counter()))
+
+    async def _worker(self, lane, queue):
+        while True:
+            msg, received_at, queued = await queue.get()
+            start = time.perf_counter()
+            INGEST_WAIT_SECONDS.observe(start - queued, lane=lane.name)
+            try:
+                result = await self._loop.run_in_executor(self._executor, lane.process, msg, received_at)
+                if result is None:
+                    outcome = "ignored"
+                else:
+                    outcome = "ok"
+                    if lane.apply is not None:
+                        lane.apply(result)
+                lane.processed += 1
+                INGEST_PROCESSED.inc(lane=lane.name, outcome=outcome)
+            except Exception as e:
+                lane.failed += 1
+                INGEST_PROCESSED.inc(lane=lane.name, outcome="failed")
+                print(f"An error occurred while processing a message on {msg.topic}: {e}")
+            INGEST_PROCESS_SECONDS.observe(time.perf_counter() - start, lane=lane.name)
+
+    # --- Outgoing ---
+
+    def publish_nowait(self, topic, payload, qos=0, retain=False):
+        """
+        Queues a message with paho. Must be called on the event loop.
+
+        Returns:
+            For QoS 0, None. For QoS > 0, a future resolved when the broker acknowledges it.
+
+        Raises:
+            PublishError: If paho rejects the message. While disconnected QoS > 0 messages
+                are queued and sent after reconnecting; QoS 0 messages are rejected.
+        """
+        if self.publish_tracker is not None:
+            info = self.publish_tracker.publish(self.client, topic, payload, qos=qos, retain=retain)
+        else:
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            raise PublishError(f"Failed to publish to {topic}: {mqtt.error_string(info.rc)}")
+
+        # QoS 0 messages are registered without a future, so their on_publish isn't taken for an early ack
+        future = self._loop.create_future() if qos > 0 else None
+        with self._lock:
+            # on_publish may already have run on paho's thread
+            acked = info.mid in self._early_acks
+            reason_code = self._early_acks.pop(info.mid, None)
+            if not acked:
+                self._acks[info.mid] = future
+        if acked and future is not None:
+            self._resolve(future, info.mid, reason_code)
+        return future
+
+    async def publish(self, topic, payload, qos=0, retain=False, timeout=None):
+        """
+        Publishes a message and, for QoS > 0, waits up to `timeout` seconds for the broker's ack.
+
+        Raises:
+            PublishError: If paho rejects the message or the broker refuses it.
+            asyncio.TimeoutError: If the ack did not arrive in time.
+        """
+        future = self.publish_nowait(topic, payload, qos, retain)
+        if future is not None:
+            await asyncio.wait_for(future, timeout)
+
+    async def publish_many(self, topic, payloads, qos=0, retain=False, timeout=None):
+        """
+        Publishes several messages in one go, then waits for all their acks (QoS > 0).
+
+        Returns:
+            The number of messages published (and, for QoS > 0, acknowledged).
+
+        Raises:
+            PublishError: If paho rejects a message; the ones before it have been published.
+            asyncio.TimeoutError: If the acks did not all arrive within `timeout` seconds.
+        """
+        futures = [self.publish_nowait(topic, payload, qos, retain) for payload in payloads]
+        futures = [future for future in futures if future is not None]
+        if futures:
+            await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        return len(payloads)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        """Runs on paho's thread when a message was sent (QoS 0) or acknowledged (QoS > 0)."""
+        if self.publish_tracker is not None:
+            self.publish_tracker.on_publish(mid)
+        with self._lock:
+            if mid not in self._acks:
+                # Sent before publish_nowait() registered it
+                if len(self._early_acks) >= MAX_EARLY_ACKS:
+                    self._early_acks.clear()
+                self._early_acks[mid] = reason_code
+                return
+            future = self._acks.pop(mid)
+        if future is not None:
+            self._loop.call_soon_threadsafe(self._resolve, future, mid, reason_code)
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        """Runs on paho's thread when the connection is lost or closed."""
+        if self.publish_tracker is not None:
+            self.publish_tracker.on_disconnect()
+        # Unsent QoS 0 messages are dropped by paho without an on_publish; QoS > 0 ones are resent
+        with self._lock:
+            for mid in [mid for mid, future in self._acks.items() if future is None]:
+                del self._acks[mid]
+
+    @staticmethod
+    def _resolve(future, mid, reason_code):
+        if future.done():
+            return
+        if reason_code is not None and reason_code.is_failure:
+            future.set_exception(PublishError(f"Broker refused message {mid}: {reason_code}"))
+        else:
+            future.set_result(mid)
+
+    # --- Stats ---
+
+    def stats(self):
+        """Returns queue depth and counters per lane, plus publishes not yet sent or acknowledged."""
+        return {
+            "lanes": {
+                lane.name: {
+                    "queued": lane.queued(),
+                    "queue_size": lane.queue_size * lane.workers,
+                    "processed": lane.processed,
+                    "dropped": lane.dropped,
+                    "failed": lane.failed,
+                }
+                for lane in self.lanes
+            },
+            "skipped": self.skipped,
+            "unsent": len(self._acks),
+        }
@@ -0,0 +1,120 @@
+# api_gateway/page_cache.py
+#
+# Rendered HTML pages, cached until the state they show changes.
+#
+# A page is rendered once per cache key, e.g. the frame and insight it shows. Its
+# gzip/Brotli variants are compressed the first time a client asks for them. Every
+# other request reuses the bytes, and clients holding the current ETag get a 304.
+
+import gzip
+import hashlib
+
+from fastapi import Response
+
+from shared.metrics import counter
+
+try:
+    import brotli  # Optional: "br" is offered only when the brotli package is installed
+except ImportError:
+    brotli = None
+
+PAGE_RENDERS = counter("gateway_page_renders_total", "HTML pages rendered", ("page",))
+PAGE_CACHE_HITS = counter("gateway_page_cache_hits_total", "HTML page requests served from the cache", ("page",))
+PAGE_NOT_MODIFIED = counter("gateway_page_not_modified_total", "HTML page requests answered with 304", ("page",))
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _accepted_encodings(accept_encoding):
+    """Returns the content codings the client accepts (q > 0), lowercased."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """Picks "br", "gzip" or "identity" for an Accept-Encoding header."""
+    accepted = _accepted_encodings(accept_encoding)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return "identity"
+
+
+class CachedPage:
+    """An HTML page rendered once per key, with its compressed variants."""
+
+    def __init__(self, name, render):
+        """
+        Args:
+            name: Page name used in the metrics.
+            render: Callable returning the page as a str; called when the key changes.
+        """
+        self.name = name
+        self.render = render
+        self.renders = 0
+        self.hits = 0
+        self.not_modified = 0
+        self._key = None
+        self._digest = None
+        self._variants = {}  # encoding -> body bytes
+
+    def response(self, request, key):
+        """
+        Returns the page for `key`, rendering it only if the key changed since the last call.
+
+        Args:
+            request: The incoming request (Accept-Encoding, If-None-Match).
+            key: Anything that changes whenever the page content would; compared with ==.
+        """
+        if self._variants and key == self._key:
+            self.hits += 1
+            PAGE_CACHE_HITS.inc(page=self.name)
+        else:
+            body = self.render().encode("utf-8")
+            self._key = key
+            self._digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+            self._variants = {"identity": body}
+            self.renders += 1
+            PAGE_RENDERS.inc(page=self.name)
+
+        encoding = choose_encoding(request.headers.get("accept-encoding"))
+        # Each encoding has its own ETag, as the bytes differ
+        etag = f'"{self._digest}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            self.not_modified += 1
+            PAGE_NOT_MODIFIED.inc(page=self.name)
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self._variant(encoding), media_type="text/html; charset=utf-8", headers=headers)
+
+    def _variant(self, encoding):
+        body = self._variants.get(encoding)
+        if body is None:
+            identity = self._variants["identity"]
+            if encoding == "br":
+                body = brotli.compress(identity, quality=BROTLI_QUALITY)
+            else:
+                body = gzip.compress(identity, compresslevel=GZIP_LEVEL, mtime=0)
+            self._variants[encoding] = body
+        return body
+
+    def stats(self):
+        """Returns render, cache-hit and 304 counts."""
+        return {"renders": self.renders, "hits": self.hits, "not_modified": self.not_modified}
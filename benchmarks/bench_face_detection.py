@@ -0,0 +1,124 @@
+# benchmarks/bench_face_detection.py
+#
+# Per-frame latency and recall of the face detection modes in
+# camera_service/face_detector.py on the sample images in images/.
+#
+# Each image is replayed as a short sequence of frames (so ROI tracking has
+# something to track) after the same 640x480 resize camera_service applies.
+# Recall is measured against the baseline (Haar, full frame, every frame) unless
+# an annotations file with ground-truth boxes is given:
+#   {"2.png": [[x, y, w, h], ...], ...}   (coordinates in the 640x480 frame)
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_face_detection.py [--frames 20]
+#   python benchmarks/bench_face_detection.py --dnn-model res10.caffemodel --dnn-config deploy.prototxt
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "camera_service"))
+
+from face_detector import FaceDetector  # noqa: E402
+
+
+def iou(box_a, box_b):
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    inter_w = min(ax + aw, bx + bw) - max(ax, bx)
+    inter_h = min(ay + ah, by + bh) - max(ay, by)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    intersection = inter_w * inter_h
+    return intersection / (aw * ah + bw * bh - intersection)
+
+
+def matched(reference, boxes, threshold=0.3):
+    """Number of reference boxes matched by some detected box with IoU >= threshold."""
+    return sum(1 for ref in reference if any(iou(ref, box) >= threshold for box in boxes))
+
+
+def load_frames(image_dir):
+    frames = {}
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            frames[os.path.basename(path)] = cv2.resize(image, (640, 480))
+    return frames
+
+
+def run_mode(name, detector_factory, frames, reference, repeats):
+    latencies = []
+    found = 0
+    expected = 0
+    full_scans = 0
+    for image_name, frame in frames.items():
+        detector = detector_factory()  # Fresh tracking state per sequence
+        for _ in range(repeats):
+            start = time.perf_counter()
+            boxes = detector.detect(frame)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found += matched(reference[image_name], boxes)
+            expected += len(reference[image_name])
+        full_scans += detector.full_scans
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * (len(latencies) - 1)))]
+    recall = f"{found / expected:.2f}" if expected else "n/a"
+    print(f"{name:<28} {statistics.mean(latencies):>9.2f} {p95:>9.2f} {recall:>7} {full_scans:>6}/{len(latencies)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face detection benchmark")
+    parser.add_argument("--images", default=os.path.join(REPO_ROOT, "images"))
+    parser.add_argument("--frames", type=int, default=20, help="Frames replayed per image")
+    parser.add_argument("--annotations", help="JSON file with ground-truth boxes per image")
+    parser.add_argument("--dnn-model", help="DNN face detector weights (enables the dnn modes)")
+    parser.add_argument("--dnn-config", help="DNN face detector config")
+    args = parser.parse_args()
+
+    frames = load_frames(args.images)
+    if not frames:
+        print(f"No images found in {args.images}")
+        return 1
+
+    if args.annotations:
+        with open(args.annotations, "r", encoding="utf-8") as f:
+            reference = {name: [tuple(b) for b in boxes] for name, boxes in json.load(f).items()}
+        reference = {name: reference.get(name, []) for name in frames}
+    else:
+        baseline = FaceDetector()
+        reference = {name: baseline.detect(frame) for name, frame in frames.items()}
+    print(f"Reference faces: { {name: len(boxes) for name, boxes in reference.items()} }")
+
+    modes = [
+        ("haar full frame", lambda: FaceDetector()),
+        ("haar scale 0.5", lambda: FaceDetector(detect_scale=0.5)),
+        ("haar roi (rescan 10)", lambda: FaceDetector(roi_tracking=True, full_scan_interval=10)),
+        ("haar scale 0.5 + roi", lambda: FaceDetector(detect_scale=0.5, roi_tracking=True)),
+    ]
+    if args.dnn_model:
+        dnn = dict(backend="dnn", dnn_model_path=args.dnn_model, dnn_config_path=args.dnn_config)
+        modes += [
+            ("dnn full frame", lambda: FaceDetector(**dnn)),
+            ("dnn roi (rescan 10)", lambda: FaceDetector(roi_tracking=True, **dnn)),
+        ]
+
+    # Full scans: frames not answered by an ROI scan (images without faces always need one)
+    header = f"{'mode':<28} {'mean ms':>9} {'p95 ms':>9} {'recall':>7} {'full scans':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, factory in modes:
+        run_mode(name, factory, frames, reference, args.frames)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
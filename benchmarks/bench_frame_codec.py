@@ -0,0 +1,76 @@
+# benchmarks/bench_frame_codec.py
+#
+# Compares the binary frame envelope (shared/frame_codec.py) with the legacy
+# base64-in-JSON format on the sample images in images/.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_frame_codec.py [--iterations 200]
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from shared.frame_codec import decode_frame, encode_frame, encode_frame_json  # noqa: E402
+
+
+def load_jpegs(image_dir):
+    """Loads every image in `image_dir` and re-encodes it the way camera_service does."""
+    jpegs = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            continue
+        frame = cv2.resize(frame, (640, 480))
+        success, img_encoded = cv2.imencode('.jpg', frame)
+        if success:
+            jpegs.append((os.path.basename(path), img_encoded.tobytes()))
+    return jpegs
+
+
+def time_per_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6  # microseconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame codec benchmark")
+    parser.add_argument("--images", default=os.path.join(REPO_ROOT, "images"))
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    jpegs = load_jpegs(args.images)
+    if not jpegs:
+        print(f"No images found in {args.images}")
+        return 1
+
+    boxes = [(120, 80, 96, 96), (400, 150, 64, 64)]
+    header = f"{'image':<10} {'format':<8} {'bytes':>9} {'overhead':>9} {'encode us':>10} {'decode us':>10}"
+    print(header)
+    print("-" * len(header))
+
+    for name, jpeg in jpegs:
+        payloads = {
+            "json": lambda: encode_frame_json(jpeg, "image/jpeg"),
+            "binary": lambda: encode_frame(jpeg, camera_id="cam0", sequence=1, boxes=boxes),
+        }
+        for fmt, encode in payloads.items():
+            payload = encode()
+            encode_us = time_per_call(encode, args.iterations)
+            decode_us = time_per_call(lambda: decode_frame(payload), args.iterations)
+            overhead = (len(payload) - len(jpeg)) / len(jpeg) * 100
+            print(f"{name:<10} {fmt:<8} {len(payload):>9} {overhead:>8.1f}% {encode_us:>10.1f} {decode_us:>10.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,468 @@
+# benchmarks/bench_pipeline.py
+#
+# End-to-end benchmark of the whole pipeline on one machine, without Docker, a
+# camera or a model file:
+#   - MQTT: an in-process broker (benchmarks/mqtt_broker.py), or --broker host:port
+#   - camera_service in continuous mode, replaying images/ or a video file (--source)
+#   - llm_service with the stub Llama in benchmarks/stubs (latency set by --prompt-ms,
+#     --token-ms and --tokens)
+#   - api_gateway under uvicorn, driven by concurrent HTTP clients
+#
+# The services run unchanged as subprocesses, configured through their environment
+# variables (--env KEY=VALUE overrides any of them). Per-frame stage latencies come
+# from the gateway's GET /frames/<frame_id> breakdown of the frames captured during
+# the measured window. HTTP latencies are measured by the load clients. Throughput
+# and p50/p95/p99 per stage are printed and written to a JSON file, so runs can be
+# compared between releases.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_pipeline.py [--duration 30] [--fps 5] [--cameras 2]
+#   python benchmarks/bench_pipeline.py --source clip.mp4 --token-ms 40 --env LLM_BATCH_SIZE=4
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(REPO_ROOT, "benchmarks")
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from mqtt_broker import Broker  # noqa: E402
+from shared.insight_message import decode_insight  # noqa: E402
+from shared.service_status import decode_status, STATE_READY, STATE_FAILED  # noqa: E402
+
+DEFAULT_HTTP_PATHS = ["/latest_image/", "/latest_llm_insight/", "/status/", "/cameras/", "/history?limit=20",
+                      "/latest/"]
+
+# Every frame goes through the whole pipeline unless overridden with --env
+BENCH_ENV = {
+    "SCENE_CHANGE_ENABLED": "false",
+    "LLM_GATE_ENABLED": "false",
+    "LLM_CACHE_SIZE": "0",
+    "LLM_PREFIX_STATE_PATH": "",
+    "LLM_USE_MLOCK": "false",
+    "HISTORY_DIR": "",
+    "STATS_INTERVAL": "3600",
+}
+
+# (name, key in the gateway's latency breakdown)
+FRAME_STAGES = [
+    ("camera capture->publish", "capture_to_publish"),
+    ("mqtt camera->gateway", "publish_to_gateway"),
+    ("mqtt camera->llm", "publish_to_llm"),
+    ("llm queue wait", "llm_queue_wait"),
+    ("llm first token", "llm_ttft"),
+    ("llm inference", "llm_inference"),
+    ("mqtt llm->gateway", "llm_to_gateway"),
+    ("end to end", "end_to_end"),
+]
+
+
+def percentile(values, pct):
+    """Returns the `pct` percentile (0-100) of `values` with linear interpolation, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = pct / 100.0 * (len(ordered) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values_ms, window_seconds):
+    """Count, throughput and latency percentiles (ms) of one stage."""
+    rounded = lambda value: round(value, 2) if value is not None else None
+    return {
+        "count": len(values_ms),
+        "throughput_per_s": round(len(values_ms) / window_seconds, 2) if window_seconds > 0 else 0.0,
+        "p50_ms": rounded(percentile(values_ms, 50)),
+        "p95_ms": rounded(percentile(values_ms, 95)),
+        "p99_ms": rounded(percentile(values_ms, 99)),
+        "mean_ms": rounded(sum(values_ms) / len(values_ms)) if values_ms else None,
+        "max_ms": rounded(max(values_ms, default=None)),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout, what, processes=()):
+    """Polls `condition()` until it is true. Fails early if one of `processes` exits."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        for process in processes:
+            process.check_running()
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out after {timeout:.0f}s waiting for {what}")
+
+
+class Service:
+    """A service running as a subprocess, logging to a file."""
+
+    def __init__(self, name, cwd, command, env, log_dir):
+        self.name = name
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self._log = open(self.log_path, "w", encoding="utf-8")
+        self.process = subprocess.Popen(command, cwd=cwd, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def check_running(self):
+        if self.process.poll() is not None:
+            raise RuntimeError(f"{self.name} exited with code {self.process.returncode}, see {self.log_path}")
+
+    def stop(self, timeout=10.0):
+        """Stops the service with Ctrl+C, like a user would, and kills it if that does not work."""
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log.close()
+
+
+class Observer:
+    """Watches the MQTT traffic: published frames, insights and the LLM service status."""
+
+    def __init__(self, host, port, camera_topics, llm_topic, status_topic):
+        self.frames = []  # receive times of camera frames
+        self.insights = {}  # frame_id -> insight
+        self.llm_status = None
+        self._camera_topics = camera_topics
+        self._llm_topic = llm_topic
+        self._status_topic = status_topic
+        self._lock = threading.Lock()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"bench-observer-{os.getpid()}")
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        client.subscribe([(topic, 0) for topic in self._camera_topics] + [(self._llm_topic, 0), (self._status_topic, 0)])
+
+    def _on_message(self, client, userdata, msg):
+        now = time.time()
+        if msg.topic == self._llm_topic:
+            insight = decode_insight(msg.payload)
+            if insight.get("frame_id"):
+                with self._lock:
+                    self.insights[insight["frame_id"]] = insight
+        elif msg.topic == self._status_topic:
+            self.llm_status = decode_status(msg.payload)
+        elif any(mqtt.topic_matches_sub(topic, msg.topic) for topic in self._camera_topics):
+            with self._lock:
+                self.frames.append(now)
+
+    def frames_between(self, start, end):
+        with self._lock:
+            return sum(1 for received_at in self.frames if start <= received_at < end)
+
+    def insights_between(self, start, end):
+        """Insights of the frames captured in [start, end)."""
+        with self._lock:
+            return [insight for insight in self.insights.values()
+                    if insight.get("captured_at") is not None and start <= insight["captured_at"] < end]
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class HttpLoad:
+    """Concurrent keep-alive HTTP clients requesting gateway endpoints in turn."""
+
+    def __init__(self, port, paths, clients):
+        self.port = port
+        self.paths = paths
+        self.clients = clients
+        self.latencies = {path: [] for path in paths}  # ms of successful requests
+        self.errors = {path: 0 for path in paths}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.clients):
+            thread = threading.Thread(target=self._run, args=(index,), name=f"http-client-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, index):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        turn = index  # Clients start on different endpoints
+        while not self._stop.is_set():
+            path = self.paths[turn % len(self.paths)]
+            turn += 1
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 500
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+                ok = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                if ok:
+                    self.latencies[path].append(elapsed_ms)
+                else:
+                    self.errors[path] += 1
+        connection.close()
+
+
+def http_get_json(port, path, timeout=10):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        body = response.read()
+        return json.loads(body) if response.status == 200 else None
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    finally:
+        connection.close()
+
+
+def histogram_means(port):
+    """Mean (ms) of every *_seconds histogram a service exposes on GET /metrics, over all label sets."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request("GET", "/metrics")
+        text = connection.getresponse().read().decode("utf-8")
+    except (OSError, http.client.HTTPException):
+        return {}
+    finally:
+        connection.close()
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        if line.startswith("#") or " " not in line:
+            continue
+        series, value = line.rsplit(" ", 1)
+        name = series.split("{", 1)[0]
+        if name.endswith("_seconds_sum"):
+            sums[name[:-4]] = sums.get(name[:-4], 0.0) + float(value)
+        elif name.endswith("_seconds_count"):
+            counts[name[:-6]] = counts.get(name[:-6], 0) + float(value)
+    return {name: {"count": int(counts[name]), "mean_ms": round(sums.get(name, 0.0) / counts[name] * 1000, 2)}
+            for name in sorted(counts) if counts[name]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(title, rows):
+    header = f"{title:<28} {'count':>7} {'per s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    format_ms = lambda value: f"{value:>9.1f}" if value is not None else f"{'-':>9}"
+    for name, stats in rows.items():
+        print(f"{name:<28} {stats['count']:>7} {stats['throughput_per_s']:>8.2f} "
+              f"{format_ms(stats['p50_ms'])} {format_ms(stats['p95_ms'])} {format_ms(stats['p99_ms'])}")
+    print()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark")
+    parser.add_argument("--source", default=os.path.join(REPO_ROOT, "images"),
+                        help="Image directory or video file replayed by every camera")
+    parser.add_argument("--cameras", type=int, default=1, help="Cameras replaying the source")
+    parser.add_argument("--fps", type=float, default=5, help="Target frames per second per camera")
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of traffic before measuring")
+    parser.add_argument("--drain", type=float, default=15, help="Seconds to wait for in-flight insights")
+    parser.add_argument("--prompt-ms", type=float, default=0.5, help="Stub Llama: ms per prompt token evaluated")
+    parser.add_argument("--token-ms", type=float, default=20, help="Stub Llama: ms per generated token")
+    parser.add_argument("--tokens", type=int, default=12, help="Stub Llama: tokens per answer")
+    parser.add_argument("--http-clients", type=int, default=8, help="Concurrent HTTP clients (0 disables)")
+    parser.add_argument("--http-path", action="append", dest="http_paths",
+                        help=f"Gateway path to request (repeatable; default {' '.join(DEFAULT_HTTP_PATHS)})")
+    parser.add_argument("--broker", help="Use this MQTT broker (host:port) instead of the in-process one")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Environment variable for all services (repeatable)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--logs", help="Directory for the service logs (default: a temporary directory)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    http_paths = args.http_paths or DEFAULT_HTTP_PATHS
+    overrides = dict(item.split("=", 1) for item in args.env)
+    log_dir = args.logs or tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.makedirs(log_dir, exist_ok=True)
+
+    broker = None
+    if args.broker:
+        mqtt_host, mqtt_port = args.broker.rsplit(":", 1)
+        mqtt_port = int(mqtt_port)
+    else:
+        broker = Broker()
+        mqtt_host, mqtt_port = "127.0.0.1", broker.start()
+    gateway_port, camera_metrics_port, llm_metrics_port = free_port(), free_port(), free_port()
+
+    env = dict(os.environ, PYTHONUNBUFFERED="1", PYTHONPATH=REPO_ROOT, **BENCH_ENV)
+    env.update(
+        # Each service has its own names for the broker address
+        MQTT_BROKER=mqtt_host, MQTT_HOST=mqtt_host, MQTT_BROKER_HOST=mqtt_host,
+        MQTT_PORT=str(mqtt_port), MQTT_BROKER_PORT=str(mqtt_port),
+    )
+    env.update(overrides)
+    llm_env = dict(
+        env,
+        PYTHONPATH=os.pathsep.join([os.path.join(BENCH_DIR, "stubs"), REPO_ROOT]),
+        MODEL_PATH=overrides.get("MODEL_PATH", "stub.gguf"),
+        METRICS_PORT=str(llm_metrics_port),
+        STUB_LLAMA_PROMPT_MS=str(args.prompt_ms),
+        STUB_LLAMA_TOKEN_MS=str(args.token_ms),
+        STUB_LLAMA_TOKENS=str(args.tokens),
+    )
+    camera_ids = [f"bench{index}" for index in range(args.cameras)]
+    camera_env = dict(
+        env,
+        CAPTURE_MODE="continuous",
+        CAMERAS=",".join(f"{camera_id}={os.path.abspath(args.source)}" for camera_id in camera_ids),
+        TARGET_FPS=str(args.fps),
+        SOURCE_FPS=str(args.fps),
+        STARTUP_DELAY="0",
+        METRICS_PORT=str(camera_metrics_port),
+    )
+    camera_topics = [env.get("MQTT_TOPIC", "camera/feed"), env.get("MQTT_CAMERA_TOPICS", "camera/+/feed")]
+    llm_topic = env.get("MQTT_TOPIC_LLM", "llm_response")
+    status_topic = env.get("MQTT_TOPIC_LLM_STATUS", "llm/status")
+
+    print(f"MQTT broker: {mqtt_host}:{mqtt_port}{' (in-process)' if broker else ''}. Service logs: {log_dir}")
+    observer = Observer(mqtt_host, mqtt_port, camera_topics, llm_topic, status_topic)
+    services = []
+    load = None
+    try:
+        llm = Service("llm_service", os.path.join(REPO_ROOT, "llm_service"), [sys.executable, "app.py"], llm_env, log_dir)
+        services.append(llm)
+        wait_for(lambda: observer.llm_status and observer.llm_status["state"] in (STATE_READY, STATE_FAILED),
+                 120, "llm_service to be ready", services)
+        if observer.llm_status["state"] == STATE_FAILED:
+            raise RuntimeError(f"llm_service failed to start: {observer.llm_status.get('error')}")
+
+        gateway = Service("api_gateway", os.path.join(REPO_ROOT, "api_gateway"),
+                          [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+                           "--port", str(gateway_port), "--log-level", "warning"], env, log_dir)
+        services.append(gateway)
+        wait_for(lambda: (http_get_json(gateway_port, "/status/", timeout=1) or {}).get("mqtt_connection") == "Connected",
+                 60, "api_gateway to connect to MQTT", services)
+
+        camera = Service("camera_service", os.path.join(REPO_ROOT, "camera_service"), [sys.executable, "app.py"],
+                         camera_env, log_dir)
+        services.append(camera)
+        wait_for(lambda: observer.frames, 60, "the first camera frame", services)
+        print(f"Pipeline running ({args.cameras} camera(s) at {args.fps:g} FPS). Warming up for {args.warmup:g}s...")
+        time.sleep(args.warmup)
+
+        if args.http_clients > 0:
+            load = HttpLoad(gateway_port, http_paths, args.http_clients)
+        window_start = time.time()
+        if load is not None:
+            load.start()
+        print(f"Measuring for {args.duration:g}s with {args.http_clients} HTTP client(s)...")
+        time.sleep(args.duration)
+        window_end = time.time()
+        if load is not None:
+            load.stop()
+        window = window_end - window_start
+
+        # Stop new frames, then give the LLM time to finish the ones captured in the window
+        service_metrics = {"camera_service": histogram_means(camera_metrics_port)}
+        camera.stop()
+        published = observer.frames_between(window_start, window_end)
+        deadline = time.monotonic() + args.drain
+        described = -1
+        while time.monotonic() < deadline:
+            current = len(observer.insights_between(window_start, window_end))
+            if current == described and current >= published:
+                break
+            described = current
+            time.sleep(1.0)
+        insights = observer.insights_between(window_start, window_end)
+
+        breakdowns = [http_get_json(gateway_port, f"/frames/{insight['frame_id']}") for insight in insights]
+        breakdowns = [breakdown["latency_ms"] for breakdown in breakdowns if breakdown]
+        service_metrics["llm_service"] = histogram_means(llm_metrics_port)
+    finally:
+        if load is not None:
+            load.stop()
+        for service in reversed(services):
+            service.stop()
+        observer.stop()
+        if broker is not None:
+            broker.stop()
+
+    stages = {}
+    for name, key in FRAME_STAGES:
+        values = [breakdown[key] for breakdown in breakdowns if breakdown.get(key) is not None]
+        if values:
+            stages[name] = summarize(values, window)
+    # Frames per second leaving the camera, whether or not the LLM got to them
+    if "camera capture->publish" in stages:
+        stages["camera capture->publish"]["throughput_per_s"] = round(published / window, 2)
+    http_results = {}
+    if load is not None:
+        for path in http_paths:
+            http_results[f"GET {path}"] = dict(summarize(load.latencies[path], window), errors=load.errors[path])
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "config": {**vars(args), "http_paths": http_paths, "env": overrides},
+        "window_seconds": round(window, 2),
+        "frames": {"published": published, "described": len(insights),
+                   "described_ratio": round(len(insights) / published, 3) if published else None},
+        "stages": stages,
+        "http": http_results,
+        "service_metrics": service_metrics,
+        "broker": broker.stats() if broker is not None else None,
+    }
+
+    print()
+    print(f"Frames: {published} published, {len(insights)} described in {window:.1f}s")
+    print()
+    print_table("stage", stages)
+    if http_results:
+        print_table("endpoint", http_results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+# benchmarks/mqtt_broker.py
+#
+# Minimal in-process MQTT 3.1.1 broker for the benchmarks.
+#
+# It implements what the services' paho clients use:
+#   - CONNECT, including the last will
+#   - SUBSCRIBE/UNSUBSCRIBE with + and # wildcards
+#   - PUBLISH at QoS 0 and 1 (QoS 2 is acknowledged and delivered as QoS 1)
+#   - retained messages and PINGREQ
+#
+# There is no authentication, persistence or session state. It stands in for
+# Mosquitto, so the pipeline can be measured without Docker. Run it on its own with
+#   python benchmarks/mqtt_broker.py [--port 1883]
+
+import argparse
+import asyncio
+import struct
+import threading
+
+import paho.mqtt.client as mqtt
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+MAX_BUFFERED_BYTES = 16 * 1024 * 1024  # QoS 0 messages to a client this far behind are dropped, like Mosquitto does
+
+
+def _packet(packet_type, flags, body=b""):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([(packet_type << 4) | flags]) + bytes(encoded) + body
+
+
+def _string(data):
+    return struct.pack("!H", len(data)) + data
+
+
+def _read_string(body, offset):
+    (length,) = struct.unpack_from("!H", body, offset)
+    offset += 2
+    return body[offset:offset + length], offset + length
+
+
+class _Session:
+    """One connected client."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = ""
+        self.subscriptions = {}  # topic filter -> granted QoS
+        self.will = None  # (topic, payload, qos, retain)
+        self._packet_id = 0
+
+    def next_packet_id(self):
+        self._packet_id = self._packet_id % 65535 + 1
+        return self._packet_id
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Broker:
+    """An MQTT broker running on its own thread and event loop."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        Args:
+            host: Interface to listen on.
+            port: TCP port; 0 picks a free one (see `port` after start()).
+        """
+        self.host = host
+        self.port = port
+        self.messages_in = 0
+        self.messages_out = 0
+        self.dropped = 0
+        self._sessions = set()
+        self._retained = {}  # topic -> (payload, qos)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        """Starts the broker and returns the port it listens on."""
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        return {"clients": len(self._sessions), "messages_in": self.messages_in,
+                "messages_out": self.messages_out, "dropped": self.dropped, "retained": len(self._retained)}
+
+    async def _shutdown(self):
+        # Let the connection handlers finish, so none is left pending when the loop stops.
+        # Closing the sockets ends them; cancelling would be logged as an error by asyncio.
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for session in list(self._sessions):
+            session.writer.close()
+        if tasks:
+            await asyncio.wait(tasks, timeout=2)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+    # --- Connections ---
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        session = _Session(writer)
+        clean = False
+        try:
+            packet_type, _, body = await self._read_packet(reader)
+            if packet_type != CONNECT or not self._connect(session, body):
+                return
+            self._sessions.add(session)
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == PUBLISH:
+                    self._publish(session, flags, body)
+                elif packet_type == PUBREL:
+                    session.send(_packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(_packet(PINGRESP, 0))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    return
+                # PUBACK/PUBREC/PUBCOMP for messages we sent need no action
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._sessions.discard(session)
+            if not clean and session.will is not None:
+                self._route(*session.will)
+            writer.close()
+
+    def _connect(self, session, body):
+        _, offset = _read_string(body, 0)  # Protocol name
+        level, flags = body[offset], body[offset + 1]
+        offset += 4  # level, flags, keepalive
+        if level != 4:
+            session.send(_packet(CONNACK, 0, b"\x00\x01"))  # Unacceptable protocol version
+            return False
+        client_id, offset = _read_string(body, offset)
+        session.client_id = client_id.decode("utf-8", "replace")
+        if flags & 0x04:
+            will_topic, offset = _read_string(body, offset)
+            will_payload, offset = _read_string(body, offset)
+            session.will = (will_topic.decode("utf-8"), will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+        session.send(_packet(CONNACK, 0, b"\x00\x00"))
+        return True
+
+    # --- Messages ---
+
+    def _publish(self, session, flags, body):
+        qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+        topic, offset = _read_string(body, 0)
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.send(_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+        self.messages_in += 1
+        self._route(topic.decode("utf-8"), body[offset:], qos, retain)
+
+    def _route(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self._retained[topic] = (payload, qos)
+            else:
+                self._retained.pop(topic, None)
+        for session in list(self._sessions):
+            granted = [sub_qos for topic_filter, sub_qos in session.subscriptions.items()
+                       if mqtt.topic_matches_sub(topic_filter, topic)]
+            if granted:
+                self._deliver(session, topic, payload, min(qos, max(granted)))
+
+    def _deliver(self, session, topic, payload, qos, retain=False):
+        if qos == 0 and session.writer.transport.get_write_buffer_size() > MAX_BUFFERED_BYTES:
+            self.dropped += 1
+            return
+        body = _string(topic.encode("utf-8"))
+        if qos:
+            body += struct.pack("!H", session.next_packet_id())
+        session.send(_packet(PUBLISH, (qos << 1) | int(retain), body + payload))
+        self.messages_out += 1
+
+    def _subscribe(self, session, body):
+        packet_id, offset = body[:2], 2
+        granted, filters = bytearray(), []
+        while offset < len(body):
+            topic_filter, offset = _read_string(body, offset)
+            qos = min(body[offset] & 0x03, 1)
+            offset += 1
+            topic_filter = topic_filter.decode("utf-8")
+            session.subscriptions[topic_filter] = qos
+            granted.append(qos)
+            filters.append((topic_filter, qos))
+        session.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        for topic, (payload, qos) in list(self._retained.items()):
+            for topic_filter, sub_qos in filters:
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    self._deliver(session, topic, payload, min(qos, sub_qos), retain=True)
+                    break
+
+    def _unsubscribe(self, session, body):
+        packet_id, offset = body[:2], 2
+        while offset < len(body):
+            topic_filter, offset = _read_string(body, offset)
+            session.subscriptions.pop(topic_filter.decode("utf-8"), None)
+        session.send(_packet(UNSUBACK, 0, packet_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal MQTT broker for local benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = Broker(args.host, args.port)
+    print(f"MQTT broker listening on {args.host}:{broker.start()}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
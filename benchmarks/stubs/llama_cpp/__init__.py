@@ -0,0 +1,135 @@
+# benchmarks/stubs/llama_cpp/__init__.py
+#
+# Stand-in for llama-cpp-python used by benchmarks/bench_pipeline.py.
+#
+# With this directory first on PYTHONPATH, llm_service imports it instead of the real
+# library. Llama accepts any model path and sleeps instead of running a model:
+#   STUB_LLAMA_LOAD_SECONDS  model load time (default 0)
+#   STUB_LLAMA_PROMPT_MS     per prompt token evaluated (default 0.5)
+#   STUB_LLAMA_TOKEN_MS      per generated token (default 20)
+#   STUB_LLAMA_TOKENS        tokens generated per answer, capped by max_tokens (default 12)
+#   STUB_LLAMA_IMAGE_MS      per image embedded by a chat handler (default 150)
+#   STUB_LLAMA_IMAGE_TOKENS  context positions an image embedding fills (default 576)
+#
+# Like the real class it keeps the evaluated tokens in input_ids/n_tokens and only
+# evaluates the part of a prompt that differs from them, so prefix reuse, batching and
+# streaming in llm_service behave as they do with a model. llama_chat_format has
+# LLaVA-style chat handlers that accept any projector path, for the vision path.
+
+import os
+import re
+import time
+
+import numpy as np
+
+__version__ = "stub"
+
+LOAD_SECONDS = float(os.getenv("STUB_LLAMA_LOAD_SECONDS", 0))
+PROMPT_MS = float(os.getenv("STUB_LLAMA_PROMPT_MS", 0.5))
+TOKEN_MS = float(os.getenv("STUB_LLAMA_TOKEN_MS", 20))
+TOKENS = int(os.getenv("STUB_LLAMA_TOKENS", 12))
+
+BOS = 1
+ANSWER_WORDS = (" One", " person", " is", " facing", " the", " camera", " near", " the", " center", " of", " the",
+                " frame", " and", " appears", " calm", ".")
+_BATCH_LINE = re.compile(r"^\d+\. Camera ", re.MULTILINE)
+
+
+class LlamaState:
+    def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+
+
+class Llama:
+    """Sleeps for the configured prompt-eval and generation time instead of running a model."""
+
+    _vocab = {}  # word -> token id, shared so tokens match across instances
+    _words = {BOS: b""}
+
+    def __init__(self, model_path=None, n_ctx=512, n_threads=None, use_mmap=True, use_mlock=False,
+                 verbose=True, chat_handler=None, **kwargs):
+        time.sleep(LOAD_SECONDS)
+        self.model_path = model_path
+        self.chat_handler = chat_handler
+        self._n_ctx = n_ctx
+        self.input_ids = []
+        self.n_tokens = 0
+        self.scores = np.zeros((n_ctx, 1), dtype=np.single)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [BOS] if add_bos else []
+        for word in re.findall(rb"\s*\S+|\s+", text):
+            token = self._vocab.get(word)
+            if token is None:
+                token = self._vocab[word] = len(self._words) + 1
+                self._words[token] = word
+            tokens.append(token)
+        return tokens
+
+    def detokenize(self, tokens):
+        return b"".join(self._words.get(token, b"") for token in tokens)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        tokens = list(tokens)
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+        time.sleep(len(tokens) * PROMPT_MS / 1000.0)
+        self.input_ids = self.input_ids[:self.n_tokens] + tokens
+        self.n_tokens += len(tokens)
+
+    def save_state(self):
+        # The evaluated tokens stand in for the KV cache in the raw context state
+        llama_state = np.array(self.input_ids[:self.n_tokens], dtype=np.intc).tobytes()
+        return LlamaState(list(self.input_ids), self.scores[:self.n_tokens].copy(), self.n_tokens, llama_state,
+                          len(llama_state), 0)
+
+    def load_state(self, state):
+        self.input_ids = np.frombuffer(state.llama_state, dtype=np.intc).tolist()
+        self.n_tokens = state.n_tokens
+
+    def __call__(self, prompt, max_tokens=16, stop=None, echo=False, stream=False, **kwargs):
+        chunks = self._generate(prompt, max_tokens)
+        if stream:
+            return ({"choices": [{"text": delta}]} for delta in chunks)
+        pieces = list(chunks)
+        return {"choices": [{"text": "".join(pieces)}], "usage": {"completion_tokens": len(pieces)}}
+
+    def create_chat_completion(self, messages, max_tokens=None, stop=None, stream=False, **kwargs):
+        if self.chat_handler is None:
+            raise ValueError("The stub Llama only runs chat completions through a chat handler")
+        return self.chat_handler(llama=self, messages=messages, max_tokens=max_tokens, stop=stop, stream=stream,
+                                 **kwargs)
+
+    def _generate(self, prompt, max_tokens):
+        tokens = self.tokenize(prompt.encode("utf-8")) if isinstance(prompt, str) else list(prompt)
+        # Prefix match: only the tokens not already evaluated cost time
+        reused = 0
+        for cached, wanted in zip(self.input_ids[:self.n_tokens], tokens[:-1]):
+            if cached != wanted:
+                break
+            reused += 1
+        self.n_tokens = reused
+        self.eval(tokens[reused:])
+
+        # A batched prompt gets one numbered answer line per frame (it already ends in "1.")
+        frames = max(1, len(_BATCH_LINE.findall(self.detokenize(tokens).decode("utf-8", "ignore"))))
+        per_answer = max(1, min(TOKENS, max_tokens // frames))
+        pieces = []
+        for number in range(1, frames + 1):
+            if number > 1:
+                pieces.append(f"\n{number}.")
+            pieces.extend(ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(per_answer))
+        for piece in pieces[:max_tokens]:
+            time.sleep(TOKEN_MS / 1000.0)
+            yield piece
@@ -0,0 +1,130 @@
+# benchmarks/stubs/llama_cpp/llama_chat_format.py
+#
+# Stand-in for the LLaVA-style chat handlers of llama-cpp-python.
+#
+# The handlers accept any projector path. Embedding an image sleeps STUB_LLAMA_IMAGE_MS
+# and fills STUB_LLAMA_IMAGE_TOKENS context positions, as a CLIP projector would; the
+# answer is generated by the stub Llama. clip_ctx, _llava_cpp, _embed_image_bytes()
+# and _exit_stack are the same hooks the real Llava15ChatHandler has.
+
+import base64
+import os
+import time
+from contextlib import ExitStack, contextmanager
+from types import SimpleNamespace
+
+IMAGE_MS = float(os.getenv("STUB_LLAMA_IMAGE_MS", 150))
+IMAGE_TOKENS = int(os.getenv("STUB_LLAMA_IMAGE_TOKENS", 576))
+
+
+@contextmanager
+def suppress_stdout_stderr(disable=True):
+    yield
+
+
+class _LlavaCpp:
+    """The llava_cpp functions the handlers use."""
+
+    @staticmethod
+    def llava_image_embed_make_with_bytes(ctx_clip, n_threads, image_bytes, image_bytes_length):
+        time.sleep(IMAGE_MS / 1000.0)
+        ctx_clip.embedded += 1
+        return SimpleNamespace(contents=SimpleNamespace(n_image_pos=IMAGE_TOKENS, freed=False))
+
+    @staticmethod
+    def llava_image_embed_free(embed):
+        embed.contents.freed = True
+
+
+class Llava15ChatHandler:
+    """Embeds images with a pretend projector and renders the LLaVA 1.5 chat format."""
+
+    DEFAULT_SYSTEM_MESSAGE = "A chat between a curious human and an artificial intelligence assistant."
+
+    def __init__(self, clip_model_path, verbose=True):
+        self.clip_model_path = clip_model_path
+        self.verbose = verbose
+        self._llava_cpp = _LlavaCpp()
+        self._exit_stack = ExitStack()
+        self.clip_ctx = SimpleNamespace(embedded=0)  # Counts the images embedded
+
+    def load_image(self, image_url):
+        return base64.b64decode(image_url.split(",", 1)[1])
+
+    def _embed_image_bytes(self, image_bytes, n_threads_batch=1):
+        return self._llava_cpp.llava_image_embed_make_with_bytes(self.clip_ctx, n_threads_batch, image_bytes,
+                                                                 len(image_bytes))
+
+    def __call__(self, *, llama, messages, max_tokens=None, stop=None, stream=False, **kwargs):
+        system = next((m["content"] for m in messages if m["role"] == "system"), self.DEFAULT_SYSTEM_MESSAGE)
+        # (kind, value) parts in the order the real template renders them
+        parts = [("text", system)]
+        for message in messages:
+            if message["role"] != "user":
+                continue
+            content = message["content"]
+            if isinstance(content, str):
+                parts.append(("text", "\nUSER: " + content))
+                continue
+            parts.append(("text", "\nUSER: "))
+            for item in content:
+                if item["type"] == "image_url":
+                    url = item["image_url"]
+                    parts.append(("image", url["url"] if isinstance(url, dict) else url))
+            parts.extend(("text", item["text"]) for item in content if item["type"] == "text")
+        parts.append(("text", "\nASSISTANT: "))
+
+        # Like the real handler: the context is evaluated from scratch on every call
+        llama.reset()
+        for kind, value in parts:
+            if kind == "text":
+                llama.eval(llama.tokenize(value.encode("utf-8"), add_bos=False))
+            else:
+                embed = self._embed_image_bytes(self.load_image(value))
+                if llama.n_tokens + embed.contents.n_image_pos > llama.n_ctx():
+                    raise ValueError(f"Prompt exceeds n_ctx: {llama.n_tokens + embed.contents.n_image_pos} "
+                                     f"> {llama.n_ctx()}")
+                llama.input_ids = llama.input_ids[:llama.n_tokens] + [-1] * embed.contents.n_image_pos
+                llama.n_tokens += embed.contents.n_image_pos
+        prompt = llama.input_ids[:llama.n_tokens]
+        prompt_tokens = len(prompt)
+
+        chunks = llama._generate(prompt, max_tokens or 16)
+        if stream:
+            def deltas():
+                yield {"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]}
+                for piece in chunks:
+                    yield {"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            return deltas()
+        pieces = list(chunks)
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces),
+                      "total_tokens": prompt_tokens + len(pieces)},
+        }
+
+
+class Llava16ChatHandler(Llava15ChatHandler):
+    pass
+
+
+class MoondreamChatHandler(Llava15ChatHandler):
+    pass
+
+
+class NanoLlavaChatHandler(Llava15ChatHandler):
+    pass
+
+
+class ObsidianChatHandler(Llava15ChatHandler):
+    pass
+
+
+class Llama3VisionAlphaChatHandler(Llava15ChatHandler):
+    pass
+
+
+class MiniCPMv26ChatHandler(Llava15ChatHandler):
+    pass
@@ -6,19 +6,137 @@ import paho.mqtt.client as mqtt
 import cv2
 import numpy as np
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import base64
-import json
+from shared.frame_codec import encode_frame, encode_frame_json
+from shared.topics import camera_feed_topic, LLM_STATUS_TOPIC
+from shared.service_status import decode_status, STATE_READY
+from shared.metrics import counter, histogram, start_metrics_server, SIZE_BUCKETS
+from shared.mqtt_metrics import PublishTracker
+from shared import log
+from capture import FrameReader, parse_source, FRAMES_READ, OPEN_SECONDS
+from scene_change import SceneChangeDetector
+from face_detector import FaceDetector
+from cameras import Camera, parse_camera_list
+from quality_controller import QualityController, QualitySettings, parse_levels, DEFAULT_LEVELS
+from offline_buffer import OfflineBuffer, OfflineReplayer
 load_dotenv()
 
 # MQTT Settings
-MQTT_BROKER = "mqtt_broker"  # Change to your actual MQTT broker address
-MQTT_PORT = 1883
-MQTT_TOPIC = "camera/feed"
+MQTT_BROKER = os.getenv('MQTT_BROKER', 'mqtt_broker')  # Change to your actual MQTT broker address
+MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
+MQTT_TOPIC = os.getenv('MQTT_TOPIC', 'camera/feed') # Topic for the single CAMERA_SOURCE camera
 SLEEP_DURATION = int(os.getenv('SLEEP_DURATION', 60))
+# Wire format for frames: "binary" (shared/frame_codec.py envelope) or "json" (legacy base64-in-JSON)
+FRAME_FORMAT = os.getenv('FRAME_FORMAT', 'binary').lower()
+CAMERA_ID = os.getenv('CAMERA_ID', 'cam0')
 
 # Camera settings (You can update these based on your actual camera feed source)
-CAMERA_SOURCE = 0  # Use 0 for the default camera or replace with IP for network cameras
+# Use 0 for the default camera, an RTSP/HTTP URL for network cameras,
+# or a video file / image directory for testing (continuous mode only)
+CAMERA_SOURCE = parse_source(os.getenv('CAMERA_SOURCE', '0'))
+
+# Several cameras (continuous mode): "front=0,door=rtsp://...". Each camera gets its own
+# capture thread and publishes to camera/<id>/feed. When unset, CAMERA_ID/CAMERA_SOURCE
+# is used as the single camera, publishing to MQTT_TOPIC.
+CAMERAS = os.getenv('CAMERAS', '')
+# Shared pool for resize/detect/encode across all cameras
+PROCESSING_WORKERS = int(os.getenv('PROCESSING_WORKERS', os.cpu_count() or 1))
+
+# Capture mode: "cycle" opens the camera, sends one frame and sleeps SLEEP_DURATION;
+# "continuous" keeps the camera open on a reader thread and publishes at TARGET_FPS
+CAPTURE_MODE = os.getenv('CAPTURE_MODE', 'cycle').lower()
+TARGET_FPS = float(os.getenv('TARGET_FPS', 2))
+SOURCE_FPS = float(os.getenv('SOURCE_FPS', 10)) # Playback rate for image directories / files without FPS info
+CAPTURE_BUFFER_SIZE = int(os.getenv('CAPTURE_BUFFER_SIZE', 1)) # Frames held by the reader; older ones are dropped
+STATS_INTERVAL = int(os.getenv('STATS_INTERVAL', 30)) # Seconds between throughput reports
+
+# Scene-change pre-filter (continuous mode): unchanged frames skip detection and publishing
+SCENE_CHANGE_ENABLED = os.getenv('SCENE_CHANGE_ENABLED', 'true').lower() == 'true'
+SCENE_CHANGE_METHOD = os.getenv('SCENE_CHANGE_METHOD', 'diff') # "diff" or "phash"
+# Changed-pixel fraction for "diff", Hamming distance in bits for "phash"; empty uses the method default
+SCENE_CHANGE_THRESHOLD = float(os.getenv('SCENE_CHANGE_THRESHOLD')) if os.getenv('SCENE_CHANGE_THRESHOLD') else None
+HEARTBEAT_SECONDS = float(os.getenv('HEARTBEAT_SECONDS', 30)) # Publish at least this often even if nothing changed
+
+# LLM readiness
+MQTT_TOPIC_LLM_STATUS = os.getenv('MQTT_TOPIC_LLM_STATUS', LLM_STATUS_TOPIC) # Retained status of the LLM service
+WAIT_FOR_LLM_SECONDS = float(os.getenv('WAIT_FOR_LLM_SECONDS', 0)) # Hold back the first frame until the LLM is ready; 0 disables
+
+# Output image settings. Detection always runs on a 640x480 copy; the published image
+# is resized from the captured frame, so it can be sharper than that (never upscaled).
+FRAME_WIDTH = int(os.getenv('FRAME_WIDTH', 640))
+FRAME_HEIGHT = int(os.getenv('FRAME_HEIGHT', 480))
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', 95)) # OpenCV's default
+
+# Adaptive quality (see quality_controller.py): picks size/quality/frame rate from a ladder
+# to stay near TARGET_BITRATE_KBPS without building a backlog; overrides the settings above
+ADAPTIVE_QUALITY = os.getenv('ADAPTIVE_QUALITY', 'false').lower() == 'true'
+QUALITY_LEVELS = os.getenv('QUALITY_LEVELS', DEFAULT_LEVELS) # WIDTHxHEIGHT@QUALITY, most detailed first
+QUALITY_START_LEVEL = int(os.getenv('QUALITY_START_LEVEL', 3)) # 640x480@80 in the default ladder
+TARGET_BITRATE_KBPS = float(os.getenv('TARGET_BITRATE_KBPS', 2000)) # For all cameras together
+QUALITY_ADAPT_INTERVAL = float(os.getenv('QUALITY_ADAPT_INTERVAL', 2)) # Seconds between adjustments
+MAX_PUBLISH_BACKLOG = int(os.getenv('MAX_PUBLISH_BACKLOG', 2)) # Unsent frames that count as congestion
+MAX_PUBLISH_LATENCY_MS = float(os.getenv('MAX_PUBLISH_LATENCY_MS', 250)) # p90 send latency that counts as congestion
+MIN_FPS_SCALE = float(os.getenv('MIN_FPS_SCALE', 0.25)) # Lowest fraction of TARGET_FPS below the last level
+
+# Face crops: each detected face is also sent as its own JPEG cut from the captured frame,
+# so consumers get detail the (possibly heavily compressed) full image lacks. Binary format only.
+FACE_CROP_QUALITY = int(os.getenv('FACE_CROP_QUALITY', 0)) # JPEG quality of the crops; 0 disables
+FACE_CROP_SIZE = int(os.getenv('FACE_CROP_SIZE', 224)) # Longest side of a crop in pixels
+FACE_CROP_MARGIN = float(os.getenv('FACE_CROP_MARGIN', 0.2)) # Context around the face, as a fraction of its size
+FACE_CROP_MAX = int(os.getenv('FACE_CROP_MAX', 4)) # Largest faces first
+
+# Broker outages: reconnect with exponential backoff and keep frames on disk until the broker is back
+MQTT_RECONNECT_MIN_DELAY = int(os.getenv('MQTT_RECONNECT_MIN_DELAY', 1)) # Seconds before the first retry; doubles per failure
+MQTT_RECONNECT_MAX_DELAY = int(os.getenv('MQTT_RECONNECT_MAX_DELAY', 60)) # Longest wait between retries
+OFFLINE_BUFFER_PATH = os.getenv('OFFLINE_BUFFER_PATH', '/tmp/camera_offline_buffer.sqlite3') # SQLite file; mount a volume to keep it across restarts
+OFFLINE_BUFFER_MB = float(os.getenv('OFFLINE_BUFFER_MB', 256)) # Frames kept while disconnected (oldest evicted); 0 disables
+OFFLINE_REPLAY_FPS = float(os.getenv('OFFLINE_REPLAY_FPS', 5)) # Buffered frames published per second after reconnecting
+OFFLINE_REPLAY_ORDER = os.getenv('OFFLINE_REPLAY_ORDER', 'oldest').lower() # "oldest" or "newest" first
+OFFLINE_REPLAY_QOS = int(os.getenv('OFFLINE_REPLAY_QOS', 1)) # 1 keeps a frame buffered until the broker acknowledges it
+OFFLINE_REPLAY_INFLIGHT = int(os.getenv('OFFLINE_REPLAY_INFLIGHT', 10)) # Replayed frames awaiting delivery at once
+OFFLINE_REPLAY_LABEL = "offline_replay" # Topic label of replayed frames in the MQTT metrics
+
+# Metrics
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9101)) # Port serving GET /metrics; 0 disables
+RESIZE_SECONDS = histogram("camera_resize_seconds", "Seconds spent resizing a frame", ("camera",))
+DETECT_SECONDS = histogram("camera_detect_seconds", "Seconds spent detecting faces in a frame", ("camera",))
+ENCODE_SECONDS = histogram("camera_encode_seconds", "Seconds spent JPEG-encoding a frame", ("camera",))
+JPEG_BYTES = histogram("camera_jpeg_bytes", "Size of the encoded JPEG", ("camera",), SIZE_BUCKETS)
+FRAMES_PUBLISHED = counter("camera_frames_published_total", "Frames published to MQTT", ("camera",))
+CROP_BYTES = histogram("camera_face_crop_bytes", "Size of the face crops sent with a frame", ("camera",), SIZE_BUCKETS)
+
+def create_quality_controller():
+    """Builds the adaptive quality controller from the environment, or None if disabled."""
+    if not ADAPTIVE_QUALITY:
+        return None
+    return QualityController(
+        parse_levels(QUALITY_LEVELS),
+        target_bitrate=TARGET_BITRATE_KBPS * 1000,
+        start_level=QUALITY_START_LEVEL,
+        interval=QUALITY_ADAPT_INTERVAL,
+        max_backlog=MAX_PUBLISH_BACKLOG,
+        max_latency=MAX_PUBLISH_LATENCY_MS / 1000,
+        min_fps_scale=MIN_FPS_SCALE,
+        # Replayed frames wait for acks at their own pace; only live frames count as backlog
+        backlog=lambda: publish_tracker.pending() - (offline_replayer.inflight() if offline_replayer else 0),
+    )
+
+def record_sent(label, seconds):
+    """Feeds the send latency of live frames to the quality controller."""
+    if label != OFFLINE_REPLAY_LABEL:
+        quality_controller.record_sent(seconds)
+
+quality_controller = create_quality_controller()
+# MQTT bytes out and publish latency; send latencies also feed the quality controller
+publish_tracker = PublishTracker(on_sent=record_sent if quality_controller else None)
+
+def current_settings():
+    """Returns the QualitySettings for the next frame: the controller's, or the fixed ones."""
+    if quality_controller is not None:
+        return quality_controller.settings()
+    return QualitySettings(FRAME_WIDTH, FRAME_HEIGHT, JPEG_QUALITY)
 
 # Store the latest received image data
 latest_image_payload: bytes | None = None
@@ -26,128 +144,375 @@ latest_image_media_type: str = "image/jpeg" # Default media type, can be updated
 
 client_id = f'python-mqtt-{random.randint(0, 1000)}'
 
+llm_ready = threading.Event() # Set while the LLM service reports "ready"
+
 # Initialize MQTT client
 mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+# paho's network thread retries with this delay, doubling after each failed attempt
+mqtt_client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY, max_delay=MQTT_RECONNECT_MAX_DELAY)
+
+def create_offline_buffer():
+    """Opens the offline buffer and its replay thread from the environment, or (None, None) if disabled."""
+    if OFFLINE_BUFFER_MB <= 0:
+        return None, None
+    buffer = OfflineBuffer(OFFLINE_BUFFER_PATH, int(OFFLINE_BUFFER_MB * 1024 * 1024))
+    if buffer.frames:
+        print(f"💾 {buffer.frames} frame(s) left in the offline buffer from a previous run.")
+    replayer = OfflineReplayer(
+        buffer, mqtt_client,
+        lambda topic, payload, qos: publish_tracker.publish(mqtt_client, topic, payload, qos=qos, label=OFFLINE_REPLAY_LABEL),
+        rate=OFFLINE_REPLAY_FPS,
+        order=OFFLINE_REPLAY_ORDER,
+        qos=OFFLINE_REPLAY_QOS,
+        max_inflight=OFFLINE_REPLAY_INFLIGHT,
+    )
+    return buffer, replayer
+
+offline_buffer, offline_replayer = create_offline_buffer()
 
 # Connect to the MQTT broker
 def on_connect(client, userdata, flags, reason_code, properties):
     print(f"MQTT connected with result code {reason_code}")
+    if reason_code.is_failure:
+        return
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     client.subscribe("$SYS/#")
-
-def on_disconnect(client, userdata, reason_code, properties):
+    client.subscribe(MQTT_TOPIC_LLM_STATUS)
+    if offline_replayer is not None:
+        offline_replayer.on_connect()
+
+def on_connect_fail(client, userdata):
+    log.sampled("connect-failed", f"⚠️ MQTT broker {MQTT_BROKER}:{MQTT_PORT} unreachable; retrying with backoff "
+                                  f"(up to {MQTT_RECONNECT_MAX_DELAY}s).")
+
+def on_message(client, userdata, msg):
+    if msg.topic == MQTT_TOPIC_LLM_STATUS:
+        status = decode_status(msg.payload)
+        if status and status["state"] == STATE_READY:
+            llm_ready.set()
+        else:
+            llm_ready.clear()
+
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    publish_tracker.on_disconnect()
+    if not reason_code.is_failure:
+        # Our own disconnect() on shutdown
+        print(f"MQTT disconnected with result code {reason_code}.")
+        return
     print(f"MQTT disconnected with result code {reason_code}. Attempting to reconnect...")
-    # Docker's restart policy helps, but manual reconnect logic could be added here if needed
+    if offline_buffer is not None:
+        print(f"💾 Buffering frames to {OFFLINE_BUFFER_PATH} until the broker is back.")
 
 def on_publish(client, userdata, mid, rc, properties):
     """Callback for when a message is successfully published."""
+    publish_tracker.on_publish(mid)
     if rc == mqtt.MQTT_ERR_SUCCESS:
-        print(f"Message with mid {mid} published successfully.")
+        log.debug(f"Message with mid {mid} published successfully.")
     else:
         print(f"Failed to publish message with mid {mid}. Result code: {rc}")
     # print(f"Properties: {properties}") # Optional: print properties if needed
 
 mqtt_client.on_connect = on_connect
+mqtt_client.on_connect_fail = on_connect_fail
 mqtt_client.on_disconnect = on_disconnect
 mqtt_client.on_publish = on_publish # Set the publish callback
+mqtt_client.on_message = on_message
 
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+# Connects on the network thread (loop_start), so an unreachable broker doesn't stop the service
+mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
 
 # If you manually copied it to the /app directory:
 # CASCADE_PATH = '/app/haarcascade_frontalface_default.xml'
 # If relying on the opencv-python package installation path:
 CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
 
-# cv2.data.haarcascades points to the directory where these files are typically installed.
-face_cascade = cv2.CascadeClassifier(CASCADE_PATH)
-
-# Check if the cascade file loaded correctly
-if face_cascade.empty():
-    print("Error loading face cascade classifier XML file.")
-    # Handle this error - perhaps exit or raise an exception
-    # For simplicity in this example, we'll assume it loads.
-    # In a real application, you should ensure this file is found.
+# Face detection settings (see face_detector.py). The defaults match the original
+# behaviour: Haar cascade over the full frame on every frame.
+FACE_DETECTOR_BACKEND = os.getenv('FACE_DETECTOR_BACKEND', 'haar') # "haar" or "dnn"
+# Measured with benchmarks/bench_face_detection.py on images/: DETECT_SCALE=0.5 finds no face (recall 0.00,
+# the face in 2.png needs the full resolution); ROI tracking keeps recall 1.00 with 18 of 20 frames of 2.png
+# answered by ~7 ms ROI scans instead of ~90 ms full scans
+DETECT_SCALE = float(os.getenv('DETECT_SCALE', 1.0)) # Detect on a copy downscaled by this factor
+DETECT_ROI_TRACKING = os.getenv('DETECT_ROI_TRACKING', 'false').lower() == 'true' # Search around previous faces only
+DETECT_FULL_SCAN_INTERVAL = int(os.getenv('DETECT_FULL_SCAN_INTERVAL', 10)) # Full-frame rescan every N frames
+DNN_MODEL_PATH = os.getenv('DNN_MODEL_PATH') # e.g. res10_300x300_ssd_iter_140000.caffemodel
+DNN_CONFIG_PATH = os.getenv('DNN_CONFIG_PATH') # e.g. deploy.prototxt
+DNN_CONFIDENCE = float(os.getenv('DNN_CONFIDENCE', 0.5))
+
+def create_face_detector():
+    """Builds the face detector from the environment, falling back to Haar if the DNN model can't load."""
+    options = dict(
+        detect_scale=DETECT_SCALE,
+        roi_tracking=DETECT_ROI_TRACKING,
+        full_scan_interval=DETECT_FULL_SCAN_INTERVAL,
+        cascade_path=CASCADE_PATH,
+        dnn_model_path=DNN_MODEL_PATH,
+        dnn_config_path=DNN_CONFIG_PATH,
+        dnn_confidence=DNN_CONFIDENCE,
+    )
+    try:
+        return FaceDetector(backend=FACE_DETECTOR_BACKEND, **options)
+    except Exception as e:
+        if FACE_DETECTOR_BACKEND == 'haar':
+            raise
+        print(f"❌ Could not load '{FACE_DETECTOR_BACKEND}' face detector ({e}). Falling back to Haar cascade.")
+        return FaceDetector(backend='haar', **options)
+
+# Load the face detector once at startup
+face_detector = create_face_detector()
+
+# The single camera used by cycle mode, and by continuous mode when CAMERAS is unset
+default_camera = Camera(CAMERA_ID, CAMERA_SOURCE, MQTT_TOPIC, face_detector)
+
+def draw_detections(frame, boxes):
+    """Draws a blue rectangle around each (x, y, w, h) box on `frame`, in place."""
+    for (x, y, w, h) in boxes:
+        cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 0, 0), 2)
+    return frame
 
-def detect_faces(frame):
+def detect_faces(frame, detector=None):
     """
-    Detects faces in an image frame using Haar Cascades and draws rectangles.
+    Detects faces in an image frame using the configured face detector and draws rectangles.
 
     Args:
         frame: A NumPy array representing the image frame (e.g., from cv2.VideoCapture.read()).
+        detector: The FaceDetector to use; defaults to the module-level face_detector.
 
     Returns:
-        The original frame with bounding boxes drawn around detected faces.
-        Returns the original frame unchanged if face detection fails or no faces are found.
+        A tuple (frame, boxes): the original frame with bounding boxes drawn around detected
+        faces, and the list of detected boxes as (x, y, w, h) tuples.
+        Returns the original frame unchanged and an empty list if no faces are found.
     """
     if frame is None:
         # print("Warning: Received None frame for detection.") # Log less frequently
-        return frame # Return the None frame directly
-
-    # Haar cascades work best on grayscale images
-    # Create a grayscale copy to avoid modifying the original frame in place if it were needed later
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-    # Detect faces in the grayscale image
-    faces = face_cascade.detectMultiScale(
-        gray,
-        scaleFactor=1.1,  # Adjust if detection is too slow or misses faces
-        minNeighbors=5,   # Adjust if you get too many false positives or miss faces
-        minSize=(30, 30)  # Minimum size of the object to detect
-    )
+        return frame, [] # Return the None frame directly
 
-    # Draw a rectangle around each detected face on the original color frame
-    # Iterate through the detected bounding boxes (x, y, width, height)
-    for (x, y, w, h) in faces:
-        # Draw a blue rectangle with thickness 2
-        cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 0, 0), 2)
+    # Detect faces (the detector handles grayscale conversion, downscaling and ROI tracking)
+    faces = (detector or face_detector).detect(frame)
 
-    # Return the frame with detections drawn
-    return frame
+    # Return the frame with detections drawn, plus the boxes so they can be published as metadata
+    return draw_detections(frame, faces), faces
+
+def scale_boxes(boxes, scale_x, scale_y):
+    """Scales (x, y, w, h) boxes from one image size to another."""
+    return [(int(round(x * scale_x)), int(round(y * scale_y)), int(round(w * scale_x)), int(round(h * scale_y)))
+            for (x, y, w, h) in boxes]
+
+def output_size(frame, settings):
+    """
+    Returns the (width, height) to publish `frame` at: the settings' size, but not upscaled
+    past the captured frame or the 640x480 detection copy, whichever is larger.
+    """
+    height, width = frame.shape[:2]
+    scale = min(1.0, max(width, 640) / settings.width, max(height, 480) / settings.height)
+    return max(1, int(settings.width * scale)), max(1, int(settings.height * scale))
 
-def process_frame(frame):
+def process_frame(frame, detector=None, camera_id=CAMERA_ID, settings=None):
     """
     Applies processing steps like resizing and face detection to the frame.
 
+    Faces are detected on a 640x480 copy. If `settings` asks for another output size,
+    the output is resized from the captured frame and the boxes are scaled to match.
+
     Args:
         frame: A NumPy array representing the image frame.
+        detector: The FaceDetector to use; defaults to the module-level face_detector.
+        camera_id: Camera the timings are recorded under.
+        settings: QualitySettings with the output size; defaults to current_settings().
 
     Returns:
-        The processed frame (e.g., resized with detections).
-        Returns None if the input frame is None.
+        A tuple (processed_frame, boxes): the processed frame (e.g., resized with detections)
+        and the detected face boxes in processed-frame coordinates.
+        Returns (None, []) if the input frame is None.
     """
     if frame is None:
         # print("Warning: Received None frame for processing.") # Log less frequently
-        return None
+        return None, []
+    settings = settings or current_settings()
+    width, height = output_size(frame, settings)
 
-    # Example: Correctly resize the frame
-    # Note: If resizing, the coordinates from detection (done on the resized frame)
-    # would correspond to the resized dimensions.
-    # If detection should happen on the original resolution, resize *after* detection or not at all.
-    # Assuming you want to resize *before* detection:
-    resized_frame = cv2.resize(frame, (640, 480))
+    # Resize before detection: the detector settings are tuned for 640x480
+    with RESIZE_SECONDS.time(camera=camera_id):
+        resized_frame = cv2.resize(frame, (640, 480))
     frame_to_process = resized_frame
     # frame_to_process = frame # Process at original capture resolution
 
-    # Apply face detection to the frame (detect_faces handles grayscale conversion internally)
-    frame_with_detections = detect_faces(frame_to_process)
+    if (width, height) == (640, 480):
+        # Apply face detection to the frame (detect_faces handles grayscale conversion internally)
+        with DETECT_SECONDS.time(camera=camera_id):
+            frame_with_detections, boxes = detect_faces(frame_to_process, detector)
+        return frame_with_detections, boxes
 
-    # If you wanted to return a grayscale image *after* detection, you could convert here:
-    # gray_with_detections = cv2.cvtColor(frame_with_detections, cv2.COLOR_BGR2GRAY)
-    # return gray_with_detections
+    with DETECT_SECONDS.time(camera=camera_id):
+        faces = (detector or face_detector).detect(frame_to_process)
+    with RESIZE_SECONDS.time(camera=camera_id):
+        output_frame = cv2.resize(frame, (width, height))
+    boxes = scale_boxes(faces, width / 640, height / 480)
 
-    # Return the frame with detections (whether resized or original resolution)
-    return frame_with_detections
+    # Return the frame with detections, in output-frame coordinates
+    return draw_detections(output_frame, boxes), boxes
 
-def capture_and_send():
+def crop_faces(frame, boxes, box_size, quality, camera_id=CAMERA_ID):
     """
-    Captures frames from the camera, processes them, and sends them to the MQTT broker.
+    Cuts each face out of the captured frame and encodes it as its own JPEG.
+
+    Args:
+        frame: The captured frame, before resizing.
+        boxes: Face boxes in the coordinates of the published image.
+        box_size: (width, height) of the published image.
+        quality: JPEG quality of the crops.
+        camera_id: Camera the crop sizes are recorded under.
+
+    Returns:
+        A list of (box, jpeg bytes), with `box` as given in `boxes`, largest faces first.
+    """
+    height, width = frame.shape[:2]
+    scale_x, scale_y = width / box_size[0], height / box_size[1]
+    crops = []
+    for box in sorted(boxes, key=lambda b: b[2] * b[3], reverse=True)[:FACE_CROP_MAX]:
+        x, y, w, h = box
+        margin_x, margin_y = w * FACE_CROP_MARGIN, h * FACE_CROP_MARGIN
+        left = max(0, int((x - margin_x) * scale_x))
+        top = max(0, int((y - margin_y) * scale_y))
+        right = min(width, int((x + w + margin_x) * scale_x))
+        bottom = min(height, int((y + h + margin_y) * scale_y))
+        if right <= left or bottom <= top:
+            continue
+        crop = frame[top:bottom, left:right]
+        longest = max(crop.shape[:2])
+        if longest > FACE_CROP_SIZE:
+            scale = FACE_CROP_SIZE / longest
+            crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+        success, encoded = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if success:
+            crops.append((tuple(box), encoded.tobytes()))
+    if crops:
+        CROP_BYTES.observe(sum(len(data) for _, data in crops), camera=camera_id)
+    return crops
+
+def publish_frame(frame, timestamp=None, camera=None):
+    """
+    Processes a raw frame, encodes it as JPEG and publishes it to MQTT.
+
+    Args:
+        frame: A NumPy array representing the raw image frame.
+        timestamp: Capture time in seconds since the epoch. Defaults to now.
+        camera: The Camera the frame came from. Defaults to the single CAMERA_SOURCE camera.
+
+    Returns:
+        The size of the published payload in bytes, or None if encoding or publishing failed.
     """
+    camera = camera or default_camera
+    settings = current_settings()
+
+    processed_frame, boxes = process_frame(frame, camera.face_detector, camera.camera_id, settings) # Apply your image processing
+    with ENCODE_SECONDS.time(camera=camera.camera_id):
+        # Encode the frame to JPG
+        success, img_encoded = cv2.imencode('.jpg', processed_frame, [cv2.IMWRITE_JPEG_QUALITY, settings.quality])
+    if not success:
+        print(f"❌ [{camera.camera_id}] Failed to encode frame as JPEG.")
+        return None
+
+    img_bytes = img_encoded.tobytes() # Convert encoded image to bytes
+    JPEG_BYTES.observe(len(img_bytes), camera=camera.camera_id)
+
+    try:
+        # Detection summary published alongside the image, so consumers don't have to re-detect
+        height, width = processed_frame.shape[:2]
+        detection_meta = {"faces": len(boxes), "width": width, "height": height}
+        # Encoding settings, so consumers know what the link allowed for this frame
+        detection_meta["jpeg_quality"] = settings.quality
+        if quality_controller is not None:
+            detection_meta["quality_level"] = settings.level
+            detection_meta["fps"] = round(TARGET_FPS * settings.fps_scale, 2)
+        crops = []
+        if FACE_CROP_QUALITY > 0 and boxes and FRAME_FORMAT != 'json':
+            crops = crop_faces(frame, boxes, (width, height), FACE_CROP_QUALITY, camera.camera_id)
+            detection_meta["crop_quality"] = FACE_CROP_QUALITY
+        # Publish time, so consumers can split capture->publish from transport latency
+        detection_meta["published_at"] = time.time()
+        # Without a broker connection the frame goes to the offline buffer and is published later
+        offline = offline_buffer is not None and not mqtt_client.is_connected()
+        if offline:
+            detection_meta["buffered"] = True
+
+        # Wrap the JPEG bytes in the frame envelope
+        sequence = camera.next_sequence()
+        timestamp = timestamp if timestamp is not None else time.time()
+
+        def envelope():
+            if FRAME_FORMAT == 'json':
+                return encode_frame_json(
+                    img_bytes, "image/jpeg",
+                    camera_id=camera.camera_id,
+                    sequence=sequence,
+                    timestamp=timestamp,
+                    boxes=boxes,
+                    **detection_meta,
+                )
+            return encode_frame(
+                img_bytes,
+                camera_id=camera.camera_id,
+                sequence=sequence,
+                timestamp=timestamp,
+                media_type="image/jpeg",
+                boxes=boxes,
+                meta=detection_meta,
+                crops=crops,
+            )
+
+        payload = envelope()
+
+        if offline:
+            offline_buffer.put(camera.topic, payload)
+            return len(payload)
+
+        # Publish the frame to MQTT
+        publish_result = publish_tracker.publish(mqtt_client, camera.topic, payload)
+        if publish_result.rc == mqtt.MQTT_ERR_NO_CONN and offline_buffer is not None:
+            # Disconnected since the check above; consumers need the flag to tell replayed frames apart
+            detection_meta["buffered"] = True
+            payload = envelope()
+            offline_buffer.put(camera.topic, payload)
+            return len(payload)
+        if publish_result.rc != mqtt.MQTT_ERR_SUCCESS:
+            print(f"❌ [{camera.camera_id}] Failed to publish frame message: {publish_result.rc}")
+            return None
+        FRAMES_PUBLISHED.inc(camera=camera.camera_id)
+        if quality_controller is not None:
+            change = quality_controller.record_published(len(payload))
+            if change:
+                print(f"🎚️ Quality {change}")
+        return len(payload)
+    except Exception as e:
+        print(f"❌ [{camera.camera_id}] Failed to publish frame: {e}")
+        return None
+
+def wait_for_startup():
+    """Waits STARTUP_DELAY seconds, then up to WAIT_FOR_LLM_SECONDS for the LLM service to be ready."""
     # Use environment variable for initial delay, default to 5 seconds
     initial_delay = int(os.getenv('STARTUP_DELAY', 5))
     print(f"⏳ Waiting for initial delay ({initial_delay} seconds)...")
     time.sleep(initial_delay)
 
+    if WAIT_FOR_LLM_SECONDS > 0 and not llm_ready.is_set():
+        print(f"⏳ Waiting up to {WAIT_FOR_LLM_SECONDS:.0f}s for the LLM service to report ready...")
+        if llm_ready.wait(WAIT_FOR_LLM_SECONDS):
+            print("✅ LLM service is ready.")
+        else:
+            print("⚠️ LLM service not ready yet, starting anyway.")
+
+def capture_and_send():
+    """
+    Captures frames from the camera, processes them, and sends them to the MQTT broker.
+
+    Opens the camera once per cycle, sends a single frame and then sleeps for
+    SLEEP_DURATION seconds (CAPTURE_MODE=cycle).
+    """
+    wait_for_startup()
+
     # Main loop to continuously capture, send, and wait
     while True:
         print("\n--- Starting a new capture cycle ---")
@@ -155,12 +520,14 @@ def capture_and_send():
         # Open the camera at the start of each cycle
         print(f"📷 Trying to open camera source: {CAMERA_SOURCE}")
         # Ensure you are explicitly using the V4L2 backend as previously recommended
+        open_start = time.perf_counter()
         cap = cv2.VideoCapture(CAMERA_SOURCE, cv2.CAP_V4L2)
+        OPEN_SECONDS.observe(time.perf_counter() - open_start, camera=CAMERA_ID)
 
         # Check if camera opened successfully
         if not cap.isOpened():
             print(f"❌ Could not open camera source {CAMERA_SOURCE}.")
-            print("😴 Waiting for 60 seconds before retrying...")
+            print(f"😴 Waiting for {SLEEP_DURATION} seconds before retrying...")
             cap.release() # Ensure any partially opened handle is released
             time.sleep(SLEEP_DURATION) # Wait before attempting to open again in the next cycle
             continue # Skip the rest of this loop iteration and start the next
@@ -177,46 +544,15 @@ def capture_and_send():
             ret, frame = cap.read() # Read a frame from the camera
 
             if ret:
+                FRAMES_READ.inc(camera=CAMERA_ID)
                 # Process and send only the first successfully read frame in this cycle
-                if not sent_one_image:
-                    processed_frame = process_frame(frame) # Apply your image processing
-                    success, img_encoded = cv2.imencode('.jpg', processed_frame) # Encode the frame to JPG
-
-                    if success:
-                        img_bytes = img_encoded.tobytes() # Convert encoded image to bytes
-
-                        try:
-                            # Encode the image bytes to base64
-                            img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-
-                            # Create the JSON payload dictionary
-                            payload_dict = {
-                                "image": img_base64,
-                                "type": "image/jpeg" # Specify the image type
-                                # You could add other metadata here like timestamp, camera_id etc.
-                            }
-
-                            # Convert the dictionary to a JSON string
-                            payload_json = json.dumps(payload_dict)
-
-                            # Publish the JSON string to MQTT
-                            publish_result = mqtt_client.publish(MQTT_TOPIC, payload_json)
-                            print("✅ Published one frame to MQTT")
-
-                            # Check publish result
-                            if publish_result.rc == mqtt.MQTT_ERR_SUCCESS:
-                                print("✅ Published one frame (JSON with base64 image) to MQTT")
-                                sent_one_image = True # Set the flag
-                                # Add a small delay if needed before concluding the capture window
-                                time.sleep(0.1)
-                                break # Exit the inner capture loop after sending one frame
-                            else:
-                                print(f"❌ Failed to publish JSON message: {publish_result.rc}")
-                                # Depending on the error code, you might want to break or retry
-                                break # Break on publish failure to avoid issues
-                        except Exception as e:
-                            print(f"❌ Failed to publish frame: {e}")
-                            break
+                payload_size = publish_frame(frame, time.time())
+                if payload_size is not None:
+                    print(f"✅ Published one frame ({FRAME_FORMAT}, {payload_size} bytes) to MQTT")
+                    sent_one_image = True # Set the flag
+                    # Add a small delay if needed before concluding the capture window
+                    time.sleep(0.1)
+                break # Exit the inner capture loop after one attempt (sent or failed)
             else:
                 # Handle frame read failure - log if necessary, but avoid spamming logs
                 # print("❌ Failed to capture frame during capture window.")
@@ -237,12 +573,139 @@ def capture_and_send():
         print(f"😴 Waiting for {wait_duration} seconds before next cycle...")
         time.sleep(wait_duration)
 
+def create_scene_detector():
+    """Builds a scene-change detector from the environment, or None if disabled."""
+    if not SCENE_CHANGE_ENABLED:
+        return None
+    return SceneChangeDetector(
+        method=SCENE_CHANGE_METHOD,
+        threshold=SCENE_CHANGE_THRESHOLD,
+        heartbeat_seconds=HEARTBEAT_SECONDS,
+    )
+
+def create_cameras():
+    """
+    Builds the camera list for continuous mode from CAMERAS, or the single
+    CAMERA_ID/CAMERA_SOURCE camera if CAMERAS is unset.
+    """
+    camera_list = parse_camera_list(CAMERAS)
+    if not camera_list:
+        default_camera.scene_detector = create_scene_detector()
+        return [default_camera]
+    return [
+        Camera(camera_id, source, camera_feed_topic(camera_id), create_face_detector(), create_scene_detector())
+        for camera_id, source in camera_list
+    ]
+
+def process_camera_frame(camera, frame, captured_at):
+    """
+    Runs on the shared processing pool: scene-change check, then detect/encode/publish.
+    """
+    try:
+        # Skip detection and publishing entirely if the scene hasn't changed
+        changed, signature = True, None
+        if camera.scene_detector is not None:
+            changed, signature = camera.scene_detector.check(frame)
+
+        if changed:
+            process_start = time.perf_counter()
+            if publish_frame(frame, timestamp=captured_at, camera=camera) is not None:
+                camera.published += 1
+                if camera.scene_detector is not None:
+                    camera.scene_detector.mark_published(signature, time.perf_counter() - process_start)
+            else:
+                camera.failed += 1
+    except Exception as e:
+        camera.failed += 1
+        print(f"❌ [{camera.camera_id}] Error while processing frame: {e}")
+    finally:
+        camera.busy = False
+
+def capture_continuous():
+    """
+    Keeps every camera open on its own reader thread and publishes each camera's newest
+    frame at TARGET_FPS (CAPTURE_MODE=continuous). Frames captured between publishes are dropped.
+
+    Processing runs on a shared pool of PROCESSING_WORKERS threads. Each camera has at most
+    one frame in flight, so a slow camera can't fill the pool at the expense of the others.
+    """
+    wait_for_startup()
+
+    cameras = create_cameras()
+    if len(cameras) > 1:
+        # Parallelism comes from the pool; stop OpenCV from oversubscribing cores per call
+        cv2.setNumThreads(1)
+    for camera in cameras:
+        camera.reader = FrameReader(camera.source, buffer_size=CAPTURE_BUFFER_SIZE, source_fps=SOURCE_FPS,
+                                    name=camera.camera_id).start()
+        print(f"🎥 [{camera.camera_id}] Continuous capture from {camera.source} to {camera.topic} at {TARGET_FPS} FPS target.")
+
+    pool = ThreadPoolExecutor(max_workers=max(1, PROCESSING_WORKERS), thread_name_prefix="frame-worker")
+    report_at = time.monotonic() + STATS_INTERVAL
+
+    try:
+        while True:
+            now = time.monotonic()
+            for camera in cameras:
+                if camera.busy or now < camera.next_due:
+                    continue
+                # Take the newest frame this camera has that we haven't processed yet
+                item = camera.reader.wait_for_frame(camera.last_read_sequence, timeout=0)
+                if item is None:
+                    continue
+                camera.last_read_sequence, captured_at, frame = item
+                camera.busy = True
+                # Pace each camera to the target frame rate (lowered by the quality controller under congestion)
+                if quality_controller is not None:
+                    interval = quality_controller.frame_interval(TARGET_FPS)
+                else:
+                    interval = 1.0 / TARGET_FPS if TARGET_FPS > 0 else 0.0
+                camera.next_due = max(camera.next_due + interval, now)
+                pool.submit(process_camera_frame, camera, frame, captured_at)
+
+            if all(camera.reader.finished and not camera.busy for camera in cameras):
+                print("✅ All capture sources exhausted. Stopping.")
+                break
+
+            if now >= report_at:
+                for camera in cameras:
+                    print(f"📊 [{camera.camera_id}] {camera.stats()}")
+                if quality_controller is not None:
+                    print(f"📊 [quality] {quality_controller.stats()}")
+                if offline_buffer is not None and (offline_buffer.frames or offline_buffer.buffered):
+                    print(f"📊 [offline] {offline_buffer.stats()}")
+                report_at = now + STATS_INTERVAL
+
+            # Sleep until the next camera is due (bounded so new frames are picked up promptly)
+            next_due = min((c.next_due for c in cameras if not c.busy), default=now + 0.01)
+            time.sleep(min(0.05, max(0.002, next_due - time.monotonic())))
+    finally:
+        for camera in cameras:
+            camera.reader.stop()
+        pool.shutdown(wait=True)
+
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
     # Start the MQTT client loop in a separate thread
     mqtt_client.loop_start()
+    if offline_replayer is not None:
+        offline_replayer.start()
 
     # Start capturing and sending frames
-    capture_and_send()
-
-    # Ensure MQTT client stops when finished
-    mqtt_client.loop_stop()
+    try:
+        if CAPTURE_MODE == 'continuous':
+            capture_continuous()
+        else:
+            capture_and_send()
+    except KeyboardInterrupt:
+        print("Camera service interrupted. Shutting down.")
+    finally:
+        # Ensure MQTT client stops when finished; the buffer is closed once nothing replays from it
+        if offline_replayer is not None:
+            offline_replayer.stop()
+        if offline_buffer is not None:
+            offline_buffer.close()
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
@@ -0,0 +1,98 @@
+# camera_service/cameras.py
+#
+# Camera list configuration and per-camera state for continuous capture.
+
+import json
+import threading
+
+from capture import parse_source
+
+
+def parse_camera_list(spec):
+    """
+    Parses the CAMERAS setting.
+
+    Accepted formats:
+        front=0,door=rtsp://10.0.0.5/stream,test=/app/test_images
+        {"front": 0, "door": "rtsp://10.0.0.5/stream"}
+        [{"id": "front", "source": 0}, {"id": "door", "source": "rtsp://10.0.0.5/stream"}]
+
+    Args:
+        spec: The CAMERAS string.
+
+    Returns:
+        A list of (camera_id, source) tuples in configuration order.
+
+    Raises:
+        ValueError: If the spec is malformed or contains duplicate camera ids.
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return []
+
+    if spec[0] in "[{":
+        data = json.loads(spec)
+        if isinstance(data, dict):
+            cameras = [(str(k), v) for k, v in data.items()]
+        else:
+            cameras = [(str(entry["id"]), entry["source"]) for entry in data]
+    else:
+        cameras = []
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            camera_id, sep, source = item.partition("=")
+            if not sep or not camera_id.strip():
+                raise ValueError(f"Invalid camera entry '{item}', expected <id>=<source>")
+            cameras.append((camera_id.strip(), source.strip()))
+
+    ids = [camera_id for camera_id, _ in cameras]
+    if len(ids) != len(set(ids)):
+        raise ValueError(f"Duplicate camera ids in CAMERAS: {ids}")
+    for camera_id in ids:
+        if "/" in camera_id or "+" in camera_id or "#" in camera_id:
+            raise ValueError(f"Camera id '{camera_id}' must not contain MQTT topic characters (/ + #)")
+    return [(camera_id, parse_source(source)) for camera_id, source in cameras]
+
+
+class Camera:
+    """Per-camera state: capture reader, detector state, sequence counter and counters."""
+
+    def __init__(self, camera_id, source, topic, face_detector, scene_detector=None):
+        self.camera_id = camera_id
+        self.source = source
+        self.topic = topic
+        self.face_detector = face_detector  # Holds ROI tracking state, so one per camera
+        self.scene_detector = scene_detector
+        self.reader = None
+
+        self.sequence = 0
+        self.last_read_sequence = 0  # Reader sequence of the last frame taken for processing
+        self.next_due = 0.0  # Monotonic time the next frame may be scheduled
+        self.busy = False  # A frame from this camera is being processed on the pool
+
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+
+    def next_sequence(self):
+        """Returns the next frame sequence number for this camera."""
+        with self._lock:
+            self.sequence += 1
+            return self.sequence
+
+    def stats(self):
+        """Returns counters for this camera."""
+        stats = {
+            "topic": self.topic,
+            "published": self.published,
+            "failed": self.failed,
+            "busy": self.busy,
+        }
+        if self.reader is not None:
+            stats["reader"] = self.reader.stats()
+        if self.scene_detector is not None:
+            stats["scene_change"] = self.scene_detector.stats()
+        stats["face_detector"] = self.face_detector.stats()
+        return stats
@@ -0,0 +1,239 @@
+# camera_service/capture.py
+#
+# Continuous frame capture on a dedicated thread.
+#
+# The reader keeps the capture source open and only holds the newest frame(s) in a
+# small ring buffer, so consumers never see stale frames and never pay the cost of
+# opening the device per capture.
+
+import glob
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from shared.metrics import counter, histogram
+
+FRAMES_READ = counter("camera_frames_read_total", "Frames read from the capture source", ("camera",))
+OPEN_SECONDS = histogram("camera_open_seconds", "Seconds taken to open the capture source", ("camera",))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def parse_source(source):
+    """
+    Normalises a capture source from config.
+
+    Args:
+        source: An int/str device index ("0"), a video file path, an image directory
+            or a network URL (rtsp://, http://).
+
+    Returns:
+        An int for device indices, otherwise the string unchanged.
+    """
+    if isinstance(source, int):
+        return source
+    source = str(source).strip()
+    return int(source) if source.isdigit() else source
+
+
+class FrameReader:
+    """
+    Reads frames from a camera, video file or image directory on a background thread.
+
+    Only the newest `buffer_size` frames are kept; older ones are dropped. Consumers call
+    `wait_for_frame()` to get the newest frame they have not seen yet.
+    """
+
+    def __init__(self, source, buffer_size=1, source_fps=10.0, loop=True, reopen_delay=2.0, name=""):
+        """
+        Args:
+            source: Device index, video file, image directory or stream URL (see parse_source).
+            buffer_size: Number of frames kept in the ring buffer.
+            source_fps: Playback rate for image directories and for video files that do
+                not report their own frame rate. Live devices are read as fast as they deliver.
+            loop: Restart image directories and video files when they run out.
+            reopen_delay: Seconds to wait before reopening a device that failed.
+            name: Camera id the metrics are recorded under; defaults to the source.
+        """
+        self.source = parse_source(source)
+        self.source_fps = source_fps
+        self.loop = loop
+        self.reopen_delay = reopen_delay
+        self.name = name or str(self.source)
+
+        self._frames = deque(maxlen=max(1, buffer_size))  # (sequence, timestamp, frame)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sequence = 0
+        self._consumed_sequence = 0  # Newest sequence handed to a consumer
+
+        # Simple counters, read via stats()
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.read_failures = 0
+        self.open_count = 0
+        self.last_open_seconds = 0.0
+        self.finished = False  # True once a non-looping file source is exhausted
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Starts the reader thread (no-op if already running)."""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"FrameReader-{self.source}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Signals the reader thread to stop and waits for it."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # --- Consumer side ---
+
+    def wait_for_frame(self, after_sequence=0, timeout=None):
+        """
+        Returns the newest frame with a sequence number greater than `after_sequence`.
+
+        Args:
+            after_sequence: Sequence number of the last frame the caller consumed.
+            timeout: Seconds to wait for a new frame; None waits indefinitely.
+
+        Returns:
+            (sequence, timestamp, frame), or None on timeout / when the reader stops.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._frames and self._frames[-1][0] > after_sequence:
+                    newest = self._frames[-1]
+                    self._consumed_sequence = max(self._consumed_sequence, newest[0])
+                    return newest
+                if self._stop.is_set() or self.finished:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def stats(self):
+        """Returns a dict of reader counters."""
+        return {
+            "source": str(self.source),
+            "frames_read": self.frames_read,
+            "frames_dropped": self.frames_dropped,
+            "read_failures": self.read_failures,
+            "open_count": self.open_count,
+            "last_open_seconds": round(self.last_open_seconds, 3),
+        }
+
+    # --- Reader thread ---
+
+    def _push(self, frame):
+        with self._cond:
+            # Count the evicted frame as dropped if no consumer ever saw it
+            if len(self._frames) == self._frames.maxlen and self._frames[0][0] > self._consumed_sequence:
+                self.frames_dropped += 1
+            self._sequence += 1
+            self._frames.append((self._sequence, time.time(), frame))
+            self.frames_read += 1
+            self._cond.notify_all()
+        FRAMES_READ.inc(camera=self.name)
+
+    def _run(self):
+        try:
+            if isinstance(self.source, str) and os.path.isdir(self.source):
+                self._run_image_directory()
+            else:
+                self._run_video_capture()
+        finally:
+            with self._cond:
+                self._cond.notify_all()
+
+    def _run_image_directory(self):
+        paths = sorted(
+            p for p in glob.glob(os.path.join(self.source, "*"))
+            if p.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        images = [img for img in (cv2.imread(p, cv2.IMREAD_COLOR) for p in paths) if img is not None]
+        self.open_count += 1
+        if not images:
+            print(f"❌ No readable images found in {self.source}.")
+            self.finished = True
+            return
+
+        interval = 1.0 / self.source_fps if self.source_fps > 0 else 0.0
+        while not self._stop.is_set():
+            for image in images:
+                if self._stop.is_set():
+                    return
+                # Copy so consumers can draw on the frame without touching the cached image
+                self._push(image.copy())
+                self._stop.wait(interval)
+            if not self.loop:
+                self.finished = True
+                return
+
+    def _open_capture(self):
+        start = time.perf_counter()
+        if isinstance(self.source, int):
+            # Explicitly use the V4L2 backend for local devices
+            cap = cv2.VideoCapture(self.source, cv2.CAP_V4L2)
+        else:
+            cap = cv2.VideoCapture(self.source)
+        self.last_open_seconds = time.perf_counter() - start
+        self.open_count += 1
+        OPEN_SECONDS.observe(self.last_open_seconds, camera=self.name)
+        return cap
+
+    def _run_video_capture(self):
+        is_file = isinstance(self.source, str) and os.path.isfile(self.source)
+        while not self._stop.is_set():
+            cap = self._open_capture()
+            if not cap.isOpened():
+                print(f"❌ Could not open capture source {self.source}. Retrying in {self.reopen_delay}s...")
+                cap.release()
+                self._stop.wait(self.reopen_delay)
+                continue
+
+            print(f"✅ Capture source {self.source} opened in {self.last_open_seconds:.2f}s.")
+            interval = 0.0
+            if is_file:
+                # Play files back at their native rate so they behave like a live camera
+                file_fps = cap.get(cv2.CAP_PROP_FPS) or self.source_fps
+                interval = 1.0 / file_fps if file_fps > 0 else 0.0
+
+            consecutive_failures = 0
+            while not self._stop.is_set():
+                ret, frame = cap.read()
+                if ret:
+                    consecutive_failures = 0
+                    self._push(frame)
+                    if interval:
+                        self._stop.wait(interval)
+                    continue
+
+                if is_file:
+                    break  # End of file
+                self.read_failures += 1
+                consecutive_failures += 1
+                if consecutive_failures >= 50:
+                    print(f"❌ Capture source {self.source} stopped delivering frames. Reopening...")
+                    break
+                time.sleep(0.05)  # Avoid a tight loop if frame reading fails
+
+            cap.release()
+            if is_file and not self.loop:
+                self.finished = True
+                return
+            if not is_file and not self._stop.is_set():
+                self._stop.wait(self.reopen_delay)
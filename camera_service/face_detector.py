@@ -0,0 +1,188 @@
+# camera_service/face_detector.py
+#
+# Tunable face detection for the camera service.
+#
+# Speed-ups over running the Haar cascade on every full frame, all optional:
+#   * detect on a downscaled copy and map the boxes back to full resolution,
+#   * search only regions of interest around the previous detections, with a
+#     full-frame rescan every N frames (or as soon as a face is lost). An ROI scan
+#     looks for faces near the tracked sizes over the whole frame and keeps those
+#     inside an ROI: Haar results change with the size of the image searched, and on
+#     images/2.png a crop around the face lost it at most margins. Skipping the small
+#     window sizes is what saves the time (~8 ms instead of ~80 ms there).
+#   * use OpenCV's DNN face detector (SSD, e.g. res10_300x300) instead of Haar.
+
+import cv2
+
+BACKEND_HAAR = "haar"
+BACKEND_DNN = "dnn"
+DETECTOR_BACKENDS = (BACKEND_HAAR, BACKEND_DNN)
+
+DEFAULT_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+
+class HaarBackend:
+    """Haar cascade detector (the original camera_service behaviour)."""
+
+    def __init__(self, cascade_path=DEFAULT_CASCADE_PATH, scale_factor=1.1, min_neighbors=5):
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        if self.cascade.empty():
+            raise RuntimeError(f"Error loading face cascade classifier XML file: {cascade_path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def detect(self, image, min_size, max_size=0):
+        # Haar cascades work best on grayscale images
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        faces = self.cascade.detectMultiScale(
+            gray,
+            scaleFactor=self.scale_factor,  # Adjust if detection is too slow or misses faces
+            minNeighbors=self.min_neighbors,  # Adjust if you get too many false positives or miss faces
+            minSize=(min_size, min_size),  # Minimum size of the object to detect
+            maxSize=(max_size, max_size)  # 0 means no upper limit
+        )
+        return [tuple(int(v) for v in face) for face in faces]
+
+
+class DnnBackend:
+    """OpenCV DNN SSD face detector (e.g. res10_300x300_ssd_iter_140000.caffemodel), run on CPU."""
+
+    def __init__(self, model_path, config_path=None, confidence=0.5, input_size=300):
+        if not model_path:
+            raise RuntimeError("DNN face detector needs DNN_MODEL_PATH (and DNN_CONFIG_PATH for Caffe models)")
+        self.net = cv2.dnn.readNet(model_path, config_path or "")
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def detect(self, image, min_size, max_size=0):
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        height, width = image.shape[:2]
+        blob = cv2.dnn.blobFromImage(
+            image, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0), swapRB=False, crop=False
+        )
+        self.net.setInput(blob)
+        detections = self.net.forward()
+
+        boxes = []
+        for i in range(detections.shape[2]):
+            if detections[0, 0, i, 2] < self.confidence:
+                continue
+            x1, y1, x2, y2 = detections[0, 0, i, 3:7] * (width, height, width, height)
+            x1, y1 = max(0, int(x1)), max(0, int(y1))
+            w, h = min(width, int(x2)) - x1, min(height, int(y2)) - y1
+            if w >= min_size and h >= min_size and (not max_size or max(w, h) <= max_size):
+                boxes.append((x1, y1, w, h))
+        return boxes
+
+
+class FaceDetector:
+    """Face detector with optional downscaling and region-of-interest tracking."""
+
+    def __init__(self, backend=BACKEND_HAAR, detect_scale=1.0, roi_tracking=False, full_scan_interval=10,
+                 roi_margin=0.5, min_size=30, cascade_path=DEFAULT_CASCADE_PATH, scale_factor=1.1,
+                 min_neighbors=5, dnn_model_path=None, dnn_config_path=None, dnn_confidence=0.5):
+        """
+        Args:
+            backend: "haar" or "dnn".
+            detect_scale: Factor (0-1] the frame is downscaled by before detection.
+            roi_tracking: Search only around the previous detections between full scans.
+            full_scan_interval: With ROI tracking, rescan the full frame every N frames.
+            roi_margin: ROI padding around a previous box, as a fraction of the box size. ROI
+                scans keep the faces whose center is inside an ROI.
+            min_size: Minimum face size in full-resolution pixels.
+            cascade_path: Haar cascade XML file.
+            scale_factor: Haar detectMultiScale scaleFactor.
+            min_neighbors: Haar detectMultiScale minNeighbors.
+            dnn_model_path: DNN model weights (e.g. .caffemodel or .onnx).
+            dnn_config_path: DNN model config (e.g. deploy.prototxt).
+            dnn_confidence: Minimum DNN detection confidence.
+        """
+        if backend not in DETECTOR_BACKENDS:
+            raise ValueError(f"Unknown face detector backend '{backend}', expected one of {DETECTOR_BACKENDS}")
+        if backend == BACKEND_DNN:
+            self.backend = DnnBackend(dnn_model_path, dnn_config_path, dnn_confidence)
+        else:
+            self.backend = HaarBackend(cascade_path, scale_factor, min_neighbors)
+        self.backend_name = backend
+        self.detect_scale = min(1.0, max(0.1, detect_scale))
+        self.roi_tracking = roi_tracking
+        self.full_scan_interval = max(1, full_scan_interval)
+        self.roi_margin = roi_margin
+        self.min_size = min_size
+
+        self._previous = []
+        self._frames_since_full_scan = 0
+        self.full_scans = 0
+        self.roi_scans = 0
+
+    def _detect_scaled(self, image, min_size=None, max_size=0):
+        """Runs the backend on `image`, downscaled by detect_scale, and maps boxes back."""
+        min_size = min_size or self.min_size
+        scale = self.detect_scale
+        if scale >= 1.0:
+            return self.backend.detect(image, min_size, max_size)
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        boxes = self.backend.detect(small, max(8, int(min_size * scale)), int(max_size * scale))
+        return [tuple(int(round(v / scale)) for v in box) for box in boxes]
+
+    def _roi(self, box, width, height):
+        x, y, w, h = box
+        pad_x, pad_y = int(w * self.roi_margin), int(h * self.roi_margin)
+        x1, y1 = max(0, x - pad_x), max(0, y - pad_y)
+        x2, y2 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+        return x1, y1, x2, y2
+
+    def _detect_rois(self, frame):
+        height, width = frame.shape[:2]
+        rois = [self._roi(box, width, height) for box in self._previous]
+        # A tracked face keeps roughly its size, so only search nearby scales
+        sides = [max(w, h) for (_, _, w, h) in self._previous]
+        min_size = max(self.min_size, int(min(sides) / 1.5))
+        boxes = []
+        for box in self._detect_scaled(frame, min_size, int(max(sides) * 1.5)):
+            x, y, w, h = box
+            center_x, center_y = x + w // 2, y + h // 2
+            if any(x1 <= center_x < x2 and y1 <= center_y < y2 for x1, y1, x2, y2 in rois):
+                boxes.append(box)
+        return boxes
+
+    def detect(self, frame):
+        """
+        Detects faces in a BGR frame.
+
+        Returns:
+            A list of (x, y, w, h) boxes in frame coordinates.
+        """
+        use_rois = (
+            self.roi_tracking
+            and self._previous
+            and self._frames_since_full_scan < self.full_scan_interval
+        )
+        boxes = None
+        if use_rois:
+            boxes = self._detect_rois(frame)
+            self.roi_scans += 1
+            self._frames_since_full_scan += 1
+            if len(boxes) < len(self._previous):
+                boxes = None  # A face was lost; fall back to a full scan right away
+
+        if boxes is None:
+            boxes = self._detect_scaled(frame)
+            self.full_scans += 1
+            self._frames_since_full_scan = 0
+
+        self._previous = boxes
+        return boxes
+
+    def stats(self):
+        """Returns scan counters."""
+        return {
+            "backend": self.backend_name,
+            "detect_scale": self.detect_scale,
+            "roi_tracking": self.roi_tracking,
+            "full_scans": self.full_scans,
+            "roi_scans": self.roi_scans,
+        }
@@ -0,0 +1,248 @@
+# camera_service/offline_buffer.py
+#
+# Store-and-forward for frames published while the broker is unreachable.
+#
+# Frames go into a SQLite file capped at a number of payload bytes. When the cap is
+# reached, the oldest frames are evicted. After reconnecting, a replay thread publishes
+# them at a limited rate, oldest or newest first. Only a few are in flight at a time,
+# so paho's queue and the process memory stay small. A row is deleted only once paho
+# reports it sent (QoS 0) or acknowledged (QoS 1). A crash therefore replays it again
+# on the next start: delivery is at-least-once, and consumers can dedupe by frame id.
+
+import os
+import sqlite3
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from shared.metrics import counter, gauge
+
+BACKLOG_FRAMES = gauge("camera_offline_backlog_frames", "Frames waiting in the offline buffer")
+BACKLOG_BYTES = gauge("camera_offline_backlog_bytes", "Payload bytes waiting in the offline buffer")
+FRAMES_BUFFERED = counter("camera_offline_buffered_total", "Frames stored while the broker was unreachable")
+FRAMES_REPLAYED = counter("camera_offline_replayed_total", "Buffered frames delivered after reconnecting")
+FRAMES_EVICTED = counter("camera_offline_evicted_total", "Buffered frames dropped to stay within the size cap")
+
+REPLAY_OLDEST = "oldest"
+REPLAY_NEWEST = "newest"
+
+
+class OfflineBuffer:
+    """A size-capped, disk-backed queue of (topic, payload) frames."""
+
+    def __init__(self, path, max_bytes):
+        """
+        Args:
+            path: SQLite file; created if missing. Frames left from a previous run are kept.
+            max_bytes: Payload bytes kept before the oldest frames are evicted.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Incremental vacuum must be chosen before the table exists; it lets the file shrink once drained
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS frames ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, "
+                         "queued_at REAL NOT NULL, size INTEGER NOT NULL, payload BLOB NOT NULL)")
+        self.frames, self.bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM frames").fetchone()
+        self.buffered = 0
+        self.evicted = 0
+        self.replayed = 0
+        BACKLOG_FRAMES.set_function(lambda: self.frames)
+        BACKLOG_BYTES.set_function(lambda: self.bytes)
+
+    def put(self, topic, payload):
+        """Stores a frame, evicting the oldest ones if the buffer would exceed max_bytes."""
+        size = len(payload)
+        if size > self.max_bytes:
+            self.evicted += 1
+            FRAMES_EVICTED.inc()
+            return
+        with self._lock:
+            # The counters follow the database only once the transaction has committed
+            frames, total = self.frames + 1, self.bytes + size
+            evicted = 0
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("INSERT INTO frames (topic, queued_at, size, payload) VALUES (?, ?, ?, ?)",
+                                 (topic, time.time(), size, payload))
+                while total > self.max_bytes:
+                    row = self._db.execute("SELECT id, size FROM frames ORDER BY id LIMIT 1").fetchone()
+                    self._db.execute("DELETE FROM frames WHERE id = ?", (row[0],))
+                    frames -= 1
+                    total -= row[1]
+                    evicted += 1
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                # E.g. a full disk: leave no transaction open, or every later put() fails.
+                # SQLite has already rolled back after some errors, SQLITE_FULL among them.
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+            self.frames, self.bytes = frames, total
+        self.buffered += 1
+        FRAMES_BUFFERED.inc()
+        if evicted:
+            self.evicted += evicted
+            FRAMES_EVICTED.inc(evicted)
+
+    def peek(self, limit, newest_first=False, exclude=()):
+        """
+        Returns up to `limit` frames as (id, topic, payload), without removing them.
+
+        Args:
+            limit: Maximum number of frames.
+            newest_first: Order of the returned frames.
+            exclude: Ids to skip, e.g. frames already in flight.
+        """
+        order = "DESC" if newest_first else "ASC"
+        exclude = tuple(exclude)
+        with self._lock:
+            if exclude:
+                placeholders = ",".join("?" * len(exclude))
+                query = f"SELECT id, topic, payload FROM frames WHERE id NOT IN ({placeholders}) ORDER BY id {order} LIMIT ?"
+                return self._db.execute(query, (*exclude, limit)).fetchall()
+            return self._db.execute(f"SELECT id, topic, payload FROM frames ORDER BY id {order} LIMIT ?",
+                                    (limit,)).fetchall()
+
+    def remove(self, ids):
+        """Deletes delivered frames. Frames already evicted are ignored."""
+        if not ids:
+            return
+        with self._lock:
+            removed = removed_bytes = 0
+            self._db.execute("BEGIN")
+            try:
+                for frame_id in ids:
+                    row = self._db.execute("SELECT size FROM frames WHERE id = ?", (frame_id,)).fetchone()
+                    if row is not None:
+                        self._db.execute("DELETE FROM frames WHERE id = ?", (frame_id,))
+                        removed += 1
+                        removed_bytes += row[0]
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+            self.frames -= removed
+            self.bytes -= removed_bytes
+            if self.frames == 0:
+                self._db.execute("PRAGMA incremental_vacuum")
+        self.replayed += removed
+        FRAMES_REPLAYED.inc(removed)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        """Returns the backlog and counters."""
+        return {
+            "backlog_frames": self.frames,
+            "backlog_mb": round(self.bytes / (1024 * 1024), 1),
+            "buffered": self.buffered,
+            "replayed": self.replayed,
+            "evicted": self.evicted,
+        }
+
+
+class OfflineReplayer:
+    """Publishes buffered frames on a background thread while the client is connected."""
+
+    def __init__(self, buffer, client, publish, rate=5.0, order=REPLAY_OLDEST, qos=1, max_inflight=10):
+        """
+        Args:
+            buffer: The OfflineBuffer to drain.
+            client: The paho client, used to check the connection.
+            publish: Callable(topic, payload, qos) -> MQTTMessageInfo.
+            rate: Frames replayed per second at most.
+            order: REPLAY_OLDEST or REPLAY_NEWEST.
+            qos: QoS of replayed frames; 1 keeps a frame buffered until the broker has it.
+            max_inflight: Replayed frames waiting to be sent/acknowledged at once.
+        """
+        if order not in (REPLAY_OLDEST, REPLAY_NEWEST):
+            raise ValueError(f"Unknown replay order '{order}', expected '{REPLAY_OLDEST}' or '{REPLAY_NEWEST}'")
+        self.buffer = buffer
+        self.client = client
+        self.publish = publish
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.newest_first = order == REPLAY_NEWEST
+        self.qos = qos
+        self.max_inflight = max(1, max_inflight)
+        self._inflight = {}  # buffer id -> MQTTMessageInfo; only touched by the replay thread
+        self._reconnected = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="offline-replay", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._reconnected.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def on_connect(self):
+        """Call from the client's on_connect callback."""
+        self._reconnected.set()
+
+    def inflight(self):
+        """Returns the number of replayed frames not yet sent/acknowledged."""
+        return len(self._inflight)
+
+    def _run(self):
+        next_due = time.monotonic()
+        while not self._stop.is_set():
+            if self._reconnected.is_set():
+                self._reconnected.clear()
+                # QoS 0 messages queued before the disconnect are lost; their frames are still buffered
+                if self.qos == 0:
+                    self._inflight.clear()
+                if self.buffer.frames:
+                    print(f"📤 Reconnected; replaying {self.buffer.frames} buffered frame(s) "
+                          f"({'newest' if self.newest_first else 'oldest'} first).")
+
+            self._collect_delivered()
+            if not self.client.is_connected() or self.buffer.frames <= len(self._inflight) \
+                    or len(self._inflight) >= self.max_inflight:
+                self._reconnected.wait(0.2)
+                continue
+
+            now = time.monotonic()
+            if now < next_due:
+                time.sleep(min(0.2, next_due - now))
+                continue
+            rows = self.buffer.peek(1, self.newest_first, exclude=self._inflight)
+            if not rows:
+                # The count said more frames were buffered; they were delivered or removed meanwhile
+                self._reconnected.wait(0.2)
+                continue
+            frame_id, topic, payload = rows[0]
+            info = self.publish(topic, payload, self.qos)
+            # Published while disconnected in the meantime, a QoS > 0 message is still queued by paho
+            # and resent after reconnecting, so it stays in flight rather than being published again
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0):
+                # Rejected (e.g. QoS 0 while disconnected, or paho's queue is full); the frame stays buffered
+                self._reconnected.wait(0.2)
+                continue
+            self._inflight[frame_id] = info
+            next_due = max(next_due + self.interval, now)
+
+    def _collect_delivered(self):
+        delivered = [frame_id for frame_id, info in self._inflight.items() if info.is_published()]
+        for frame_id in delivered:
+            del self._inflight[frame_id]
+        if delivered:
+            self.buffer.remove(delivered)
+            if not self.buffer.frames:
+                print("✅ Offline buffer drained.")
@@ -0,0 +1,201 @@
+# camera_service/quality_controller.py
+#
+# Adaptive JPEG quality, resolution and frame rate.
+#
+# The controller walks a ladder of (width, height, JPEG quality) levels, from most to
+# least detailed. The goal is to keep the published bitrate near a target while the
+# link keeps up. After every adjustment interval it looks at:
+#   - bitrate: frame bytes published per second over the interval
+#   - backlog: frames handed to paho but not yet written to the socket
+#   - send latency: publish() until paho reports the frame sent (p90 over the interval)
+#
+# A backlog, slow sends or a bitrate over target step down one level right away.
+# When the bitrate is well under target and sends are fast for a few intervals in a
+# row, it steps up one level. Below the lowest level the frame rate is reduced
+# instead. Stepping back up restores the frame rate first.
+
+import threading
+import time
+from dataclasses import dataclass
+
+from shared.metrics import counter, gauge
+from shared.stats import percentile
+
+# Most to least detailed; 640x480 is the fixed size the service has always published
+DEFAULT_LEVELS = "1280x960@90,1024x768@85,800x600@80,640x480@80,640x480@65,480x360@60,320x240@50"
+
+QUALITY_LEVEL = gauge("camera_quality_level", "Current quality level (0 = most detailed)")
+JPEG_QUALITY = gauge("camera_jpeg_quality", "JPEG quality frames are encoded at")
+FPS_SCALE = gauge("camera_fps_scale", "Fraction of the target frame rate being published")
+QUALITY_CHANGES = counter("camera_quality_changes_total", "Quality level or frame rate changes", ("direction",))
+
+
+@dataclass(frozen=True)
+class QualitySettings:
+    """Encoding settings for the next frame."""
+    width: int
+    height: int
+    quality: int
+    fps_scale: float = 1.0  # Fraction of the target frame rate to publish at
+    level: int = 0
+
+
+def parse_levels(spec):
+    """
+    Parses a quality ladder such as "1280x960@90,640x480@80".
+
+    Returns:
+        A list of (width, height, quality) tuples, in the given order.
+
+    Raises:
+        ValueError: If an entry is malformed.
+    """
+    levels = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            size, quality = item.split("@")
+            width, height = size.lower().split("x")
+            levels.append((int(width), int(height), max(1, min(100, int(quality)))))
+        except ValueError:
+            raise ValueError(f"Invalid quality level '{item}', expected WIDTHxHEIGHT@QUALITY") from None
+    if not levels:
+        raise ValueError("The quality ladder is empty")
+    return levels
+
+
+class QualityController:
+    """Chooses the quality level from the published bitrate, the paho backlog and send latency."""
+
+    def __init__(self, levels, target_bitrate, start_level=0, interval=2.0, max_backlog=2, max_latency=0.25,
+                 raise_after=3, min_fps_scale=0.25, backlog=None):
+        """
+        Args:
+            levels: (width, height, quality) tuples, most detailed first.
+            target_bitrate: Bits per second to aim for, across all cameras sharing the link.
+            start_level: Index of the level to start at.
+            interval: Seconds between adjustments.
+            max_backlog: More unsent frames than this means the link is congested.
+            max_latency: A p90 send latency above this (seconds) means the link is congested.
+            raise_after: Consecutive intervals with headroom needed to step up a level.
+            min_fps_scale: Lowest fraction of the target frame rate to fall back to.
+            backlog: Callable returning the number of frames not yet sent.
+        """
+        self.levels = list(levels)
+        self.target_bitrate = target_bitrate
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.max_latency = max_latency
+        self.raise_after = max(1, raise_after)
+        self.min_fps_scale = min(1.0, max(0.01, min_fps_scale))
+        self.backlog = backlog or (lambda: 0)
+
+        self._lock = threading.Lock()
+        self._level = max(0, min(len(self.levels) - 1, start_level))
+        self._fps_scale = 1.0
+        self._good_intervals = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_frames = 0
+        self._latencies = []
+        self.last_bitrate = 0.0
+        self.last_latency_p90 = 0.0
+        self.steps_down = 0
+        self.steps_up = 0
+        self._export()
+
+    def settings(self):
+        """Returns the QualitySettings for the next frame."""
+        with self._lock:
+            width, height, quality = self.levels[self._level]
+            return QualitySettings(width, height, quality, self._fps_scale, self._level)
+
+    def frame_interval(self, target_fps):
+        """Returns the seconds between frames for `target_fps` at the current frame rate scale."""
+        if target_fps <= 0:
+            return 0.0
+        with self._lock:
+            return 1.0 / (target_fps * self._fps_scale)
+
+    def record_sent(self, seconds):
+        """Records the send latency of one frame (from the paho on_publish callback)."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def record_published(self, size):
+        """
+        Records a published frame of `size` bytes and adjusts the level once per interval.
+
+        Returns:
+            A description of the change if the level or frame rate changed, else None.
+        """
+        with self._lock:
+            self._window_bytes += size
+            self._window_frames += 1
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.interval:
+                return None
+            bitrate = self._window_bytes * 8 / elapsed
+            latency_p90 = percentile(self._latencies, 90)
+            frames = self._window_frames
+            self._window_start, self._window_bytes, self._window_frames, self._latencies = now, 0, 0, []
+            self.last_bitrate, self.last_latency_p90 = bitrate, latency_p90
+        return self._adjust(bitrate, latency_p90, self.backlog(), frames)
+
+    def _adjust(self, bitrate, latency_p90, backlog, frames):
+        with self._lock:
+            before = (self._level, self._fps_scale)
+            if backlog > self.max_backlog or latency_p90 > self.max_latency or bitrate > self.target_bitrate * 1.15:
+                self._good_intervals = 0
+                if self._level < len(self.levels) - 1:
+                    self._level += 1
+                else:
+                    self._fps_scale = max(self.min_fps_scale, self._fps_scale / 2)
+                if (self._level, self._fps_scale) != before:
+                    self.steps_down += 1
+                    QUALITY_CHANGES.inc(direction="down")
+            elif bitrate < self.target_bitrate * 0.6 and latency_p90 < self.max_latency / 2 and frames >= 2:
+                # The next level up is roughly 1.5x the bytes; only step up with room for it
+                self._good_intervals += 1
+                if self._good_intervals >= self.raise_after:
+                    self._good_intervals = 0
+                    if self._fps_scale < 1.0:
+                        self._fps_scale = min(1.0, self._fps_scale * 2)
+                    elif self._level > 0:
+                        self._level -= 1
+                    if (self._level, self._fps_scale) != before:
+                        self.steps_up += 1
+                        QUALITY_CHANGES.inc(direction="up")
+            else:
+                self._good_intervals = 0
+
+            if (self._level, self._fps_scale) == before:
+                return None
+            self._export()
+            width, height, quality = self.levels[self._level]
+            return (f"level {before[0]} -> {self._level} ({width}x{height} q{quality}, "
+                    f"{self._fps_scale:.0%} frame rate): {bitrate / 1000:.0f} kbit/s, "
+                    f"backlog {backlog}, send p90 {latency_p90 * 1000:.0f} ms")
+
+    def _export(self):
+        QUALITY_LEVEL.set(self._level)
+        JPEG_QUALITY.set(self.levels[self._level][2])
+        FPS_SCALE.set(self._fps_scale)
+
+    def stats(self):
+        """Returns the current level and the figures of the last interval."""
+        settings = self.settings()
+        return {
+            "level": settings.level,
+            "size": f"{settings.width}x{settings.height}",
+            "quality": settings.quality,
+            "fps_scale": settings.fps_scale,
+            "bitrate_kbps": round(self.last_bitrate / 1000, 1),
+            "target_kbps": round(self.target_bitrate / 1000, 1),
+            "send_p90_ms": round(self.last_latency_p90 * 1000, 1),
+            "steps_down": self.steps_down,
+            "steps_up": self.steps_up,
+        }
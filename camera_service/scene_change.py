@@ -0,0 +1,154 @@
+# camera_service/scene_change.py
+#
+# Cheap scene-change check run before face detection and publishing.
+#
+# Each frame is reduced to a tiny signature (a downscaled grayscale image, or a
+# 64-bit perceptual hash) and compared with the signature of the last frame that
+# was published. Unchanged frames can then skip detection and publishing entirely.
+
+import time
+
+import cv2
+import numpy as np
+
+METHOD_DIFF = "diff"
+METHOD_PHASH = "phash"
+SCENE_CHANGE_METHODS = (METHOD_DIFF, METHOD_PHASH)
+
+
+def frame_difference(previous, current, pixel_threshold=25):
+    """
+    Fraction of pixels whose grayscale value changed by more than `pixel_threshold`.
+
+    Args:
+        previous: Downscaled grayscale signature of the reference frame.
+        current: Downscaled grayscale signature of the new frame.
+        pixel_threshold: Per-pixel change (0-255) that counts as "changed".
+
+    Returns:
+        A float between 0.0 and 1.0.
+    """
+    diff = cv2.absdiff(previous, current)
+    return float(np.count_nonzero(diff > pixel_threshold)) / diff.size
+
+
+def perceptual_hash(gray):
+    """
+    64-bit DCT perceptual hash of a grayscale image.
+
+    Returns:
+        A length-64 boolean NumPy array.
+    """
+    resized = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(resized)[:8, :8].flatten()
+    # Ignore the DC term when picking the median so overall brightness doesn't dominate
+    return low_freq > np.median(low_freq[1:])
+
+
+class SceneChangeDetector:
+    """
+    Decides whether a frame differs enough from the last published one to be worth processing.
+
+    Also tracks how many frames were skipped and how much time that saved.
+    """
+
+    def __init__(self, method=METHOD_DIFF, threshold=None, heartbeat_seconds=30.0, size=(64, 48)):
+        """
+        Args:
+            method: "diff" (downscaled grayscale differencing) or "phash" (perceptual hash).
+            threshold: For "diff", the fraction of changed pixels (default 0.02); for "phash",
+                the Hamming distance in bits (default 6). A frame changes the scene when the
+                measure exceeds this threshold.
+            heartbeat_seconds: Publish anyway if this long has passed since the last published
+                frame. 0 disables the heartbeat.
+            size: (width, height) the frame is downscaled to before comparing.
+        """
+        if method not in SCENE_CHANGE_METHODS:
+            raise ValueError(f"Unknown scene change method '{method}', expected one of {SCENE_CHANGE_METHODS}")
+        self.method = method
+        self.threshold = threshold if threshold is not None else (0.02 if method == METHOD_DIFF else 6)
+        self.heartbeat_seconds = heartbeat_seconds
+        self.size = size
+
+        self._reference = None  # Signature of the last published frame
+        self._last_published_at = 0.0
+
+        # Metrics
+        self.frames_checked = 0
+        self.frames_skipped = 0
+        self.heartbeats = 0
+        self._check_seconds = 0.0
+        self._process_seconds = 0.0
+        self._frames_processed = 0
+        self.last_score = 0.0
+
+    def _signature(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        if self.method == METHOD_PHASH:
+            return perceptual_hash(gray)
+        # A light blur keeps sensor noise from counting as change
+        return cv2.GaussianBlur(gray, (3, 3), 0)
+
+    def _score(self, signature):
+        if self.method == METHOD_PHASH:
+            return float(np.count_nonzero(self._reference != signature))
+        return frame_difference(self._reference, signature)
+
+    def check(self, frame):
+        """
+        Compares `frame` with the last published frame.
+
+        Returns:
+            (changed, signature). Pass the signature to mark_published() if the frame is published.
+        """
+        start = time.perf_counter()
+        signature = self._signature(frame)
+        now = time.monotonic()
+
+        if self._reference is None:
+            changed = True
+        else:
+            self.last_score = self._score(signature)
+            changed = self.last_score > self.threshold
+            if not changed and self.heartbeat_seconds > 0 and now - self._last_published_at >= self.heartbeat_seconds:
+                changed = True
+                self.heartbeats += 1
+
+        self.frames_checked += 1
+        if not changed:
+            self.frames_skipped += 1
+        self._check_seconds += time.perf_counter() - start
+        return changed, signature
+
+    def mark_published(self, signature, process_seconds=None):
+        """
+        Makes `signature` the new reference frame.
+
+        Args:
+            signature: The signature returned by check().
+            process_seconds: Time spent detecting, encoding and publishing the frame; used to
+                estimate the time saved by skipped frames.
+        """
+        self._reference = signature
+        self._last_published_at = time.monotonic()
+        if process_seconds is not None:
+            self._process_seconds += process_seconds
+            self._frames_processed += 1
+
+    def stats(self):
+        """Returns skip ratio and timing figures (milliseconds)."""
+        avg_check_ms = self._check_seconds / self.frames_checked * 1000 if self.frames_checked else 0.0
+        avg_process_ms = self._process_seconds / self._frames_processed * 1000 if self._frames_processed else 0.0
+        saved_ms = self.frames_skipped * max(0.0, avg_process_ms - avg_check_ms)
+        return {
+            "method": self.method,
+            "frames_checked": self.frames_checked,
+            "frames_skipped": self.frames_skipped,
+            "skip_ratio": round(self.frames_skipped / self.frames_checked, 3) if self.frames_checked else 0.0,
+            "heartbeats": self.heartbeats,
+            "last_score": round(self.last_score, 4),
+            "avg_check_ms": round(avg_check_ms, 3),
+            "avg_process_ms": round(avg_process_ms, 3),
+            "saved_ms_per_frame": round(saved_ms / self.frames_checked, 3) if self.frames_checked else 0.0,
+        }
@@ -2,29 +2,103 @@
 
 import os
 import time
-from llama_cpp import Llama
 import paho.mqtt.client as mqtt
 import json
 import random
-import base64 # Needed for base64 decoding
+import threading
+from dataclasses import dataclass
 from dotenv import load_dotenv
+from shared.frame_codec import decode_frame, peek_camera_id, peek_meta, FrameDecodeError
+from shared.topics import CAMERA_FEED_SUBSCRIPTION, LLM_STATUS_TOPIC, camera_id_from_topic
+from shared.service_status import (encode_status, STATE_LOADING, STATE_READY, STATE_FAILED,
+                                   STATE_OFFLINE)
+from shared.insight_message import encode_insight, encode_partial, partial_topic
+from shared.metrics import counter, gauge, histogram, start_metrics_server
+from shared.mqtt_metrics import PublishTracker, record_received
+from shared import log
+from work_queue import WorkQueue
+from result_cache import ResultCache, make_cache_key
+from detection_gate import DetectionGate
+from prompts import (PROMPT_PREFIX, build_detection_section, build_batch_section, build_vision_section,
+                     build_short_section, split_batch_response, has_detections)
+from generation_stats import GenerationStats
+from model_loader import prepare_model
+from completion import complete
+from process_pool import ProcessPool
+from vision import image_digest
+from load_controller import LoadController, parse_tiers, DEFAULT_TIERS, PROMPT_SHORT
 
 load_dotenv()
 
+startup_started = time.perf_counter()
+
 # --- LLM Settings ---
 model_path = os.getenv("MODEL_PATH")
 # model_name = os.getenv("MODEL_NAME") # Not used in current script
 n_ctx = int(os.getenv("LLM_CONTEXT_SIZE", 512))
 max_tokens = int(os.getenv("LLM_MAX_TOKENS", 64))
-n_threads = int(os.getenv("LLM_THREADS", 4))
+n_threads = int(os.getenv("LLM_THREADS", 4)) # Threads per model instance (per worker process with LLM_PROCESSES)
 # LLM_GPU_LAYERS = int(os.getenv("LLM_GPU_LAYERS", 0)) # Optional: for GPU offloading
+LLM_PROMPT_PREFIX = os.getenv("LLM_PROMPT_PREFIX", PROMPT_PREFIX) # Fixed instruction at the start of every prompt
+LLM_PREFIX_CACHE = os.getenv("LLM_PREFIX_CACHE", "true").lower() == "true" # Evaluate the prompt prefix once and reuse its KV state
+LLM_PREFIX_STATE_PATH = os.getenv("LLM_PREFIX_STATE_PATH", "/app/state/llm_prefix_state.bin") # Prefix state snapshot; empty disables it
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() == "true" # Publish tokens on <llm topic>/partial/<frame_id> as they are generated
+LLM_USE_MMAP = os.getenv("LLM_USE_MMAP", "true").lower() == "true" # Memory-map the weights instead of reading them
+LLM_USE_MLOCK = os.getenv("LLM_USE_MLOCK", "true").lower() == "true" # Keep the weights resident (needs a memlock limit)
+LLM_WARMUP_TOKENS = int(os.getenv("LLM_WARMUP_TOKENS", 1)) # Tokens generated by the startup warm-up; 0 skips it
+LLM_PROCESSES = int(os.getenv("LLM_PROCESSES", 0)) # Worker processes with their own model copy; 0 runs the model in this process
+
+# --- Vision Settings ---
+LLM_CLIP_MODEL_PATH = os.getenv("LLM_CLIP_MODEL_PATH", "") # CLIP projector (mmproj GGUF) of a vision model; empty keeps the model text-only
+LLM_VISION_CHAT_FORMAT = os.getenv("LLM_VISION_CHAT_FORMAT", "llava-1-5") # llava-1-5, llava-1-6, moondream, nanollava, ... (see vision.py)
+LLM_VISION_MAX_CROPS = int(os.getenv("LLM_VISION_MAX_CROPS", 1)) # Face crops shown per frame, largest first; each fills hundreds of context positions
+LLM_VISION_IMAGE_SIZE = int(os.getenv("LLM_VISION_IMAGE_SIZE", 336)) # Projector input size; larger crops are downscaled to it
+LLM_VISION_EMBED_CACHE = int(os.getenv("LLM_VISION_EMBED_CACHE", 32)) # Image embeddings kept for repeated crops
+LLM_VISION = bool(LLM_CLIP_MODEL_PATH) and LLM_VISION_MAX_CROPS > 0
+
+# --- Load Shedding Settings ---
+LLM_ADAPTIVE_LOAD = os.getenv("LLM_ADAPTIVE_LOAD", "false").lower() == "true" # Step down to cheaper tiers when answers fall behind
+LLM_LATENCY_BUDGET_MS = float(os.getenv("LLM_LATENCY_BUDGET_MS", 5000)) # Target p90 from receiving a frame to its answer
+LLM_LOAD_TIERS = os.getenv("LLM_LOAD_TIERS", DEFAULT_TIERS) # tokens fraction:full|short:1 in N frames[:fallback], most expensive first
+LLM_LOAD_INTERVAL = float(os.getenv("LLM_LOAD_INTERVAL", 10)) # Seconds between tier adjustments
+LLM_LOAD_MAX_BACKLOG = int(os.getenv("LLM_LOAD_MAX_BACKLOG", 2)) # More queued frames than this steps down a tier
+LLM_LOAD_RAISE_AFTER = int(os.getenv("LLM_LOAD_RAISE_AFTER", 3)) # Intervals with headroom before stepping back up
+LLM_FALLBACK_MODEL_PATH = os.getenv("LLM_FALLBACK_MODEL_PATH", "") # Smaller GGUF for the fallback tiers; loaded when first needed
+
+# --- Inference Queue Settings ---
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", 1)) # Worker threads draining the inference queue (at least LLM_PROCESSES)
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", 4)) # Maximum pending frames per camera
+LLM_QUEUE_POLICY = os.getenv("LLM_QUEUE_POLICY", "coalesce") # drop_oldest, drop_newest or coalesce (per camera)
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", 60)) # Seconds between queue statistics reports
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", 1)) # Frames described in one prompt during bursts; 1 disables batching
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", 0)) # Wait this long for more frames; 0 only batches frames already queued
+
+# --- Result Cache Settings ---
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 256)) # Cached completions; 0 disables the cache
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 600)) # Seconds a cached completion stays valid
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH") # Optional JSON file, e.g. /app/state/llm_cache.json
+
+# --- Replayed Frame Settings ---
+LLM_BUFFERED_FPS = float(os.getenv("LLM_BUFFERED_FPS", 0)) # Frames replayed from a camera's offline buffer answered per second; 0 skips them
+
+# --- Detection Gate Settings ---
+LLM_GATE_ENABLED = os.getenv("LLM_GATE_ENABLED", "true").lower() == "true" # Only run the LLM when detections change
+LLM_GATE_IOU_THRESHOLD = float(os.getenv("LLM_GATE_IOU_THRESHOLD", 0.5)) # Faces whose IoU drops below this count as moved
+LLM_GATE_REFRESH_SECONDS = float(os.getenv("LLM_GATE_REFRESH_SECONDS", 0)) # Re-run anyway after this long; 0 disables
+
+# --- Metrics Settings ---
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9102)) # Port serving GET /metrics; 0 disables
 
 
 # --- MQTT Settings ---
 # Topic where the camera service publishes images (Using MQTT_TOPIC env var)
 MQTT_IMAGE_TOPIC = os.getenv("MQTT_TOPIC", "camera/feed")
+# Per-camera frame topics (camera/<id>/feed), subscribed to in addition to MQTT_IMAGE_TOPIC
+MQTT_CAMERA_TOPICS = os.getenv("MQTT_CAMERA_TOPICS", CAMERA_FEED_SUBSCRIPTION)
 # Topic where the LLM service publishes text responses (Using MQTT_TOPIC_LLM env var)
 MQTT_LLM_TOPIC_OUT = os.getenv("MQTT_TOPIC_LLM", "llm_response")
+# Retained readiness message (loading / ready / failed / offline)
+MQTT_LLM_STATUS_TOPIC = os.getenv("MQTT_TOPIC_LLM_STATUS", LLM_STATUS_TOPIC)
 
 
 mqtt_host = os.getenv("MQTT_HOST", "mqtt_broker")
@@ -33,114 +107,611 @@ mqtt_port = int(os.getenv("MQTT_PORT", 1883))
 
 client_id = f'python-llm-service-{random.randint(0, 1000)}' # More descriptive client ID
 
-# --- Initialize LLM ---
-print(f"Loading LLM model from {model_path}...")
-try:
-    llm = Llama(
-        model_path=model_path,
-        n_ctx=n_ctx,
-        n_threads=n_threads,
-        # n_gpu_layers=LLM_GPU_LAYERS, # Uncomment if using GPU offloading
-        use_mlock=True, # Use mlock for better performance if available
-        verbose=False # Reduce verbosity from llama_cpp during inference
-    )
-    print("LLM model loaded successfully.")
-except Exception as e:
-    print(f"Error loading LLM model: {e}")
-    print("Please check MODEL_PATH and LLM_CONTEXT_SIZE environment variables.")
-    # Exit or raise exception if LLM fails to load, as the service cannot function
-    exit(1) # Exit the script
+# --- LLM (loaded by initialize_model() once MQTT is up, so readiness can be announced) ---
+llm = None
+prefix_cache = None # Prompt prefix KV state
+process_pool = None # Worker processes, when LLM_PROCESSES > 0 (llm and prefix_cache then stay None)
+load_breakdown = {} # Seconds spent in each startup step
+service_ready = threading.Event() # Set once the model is loaded and warmed up
+load_error = None # Why loading failed, if it did
+
+llm_lock = threading.Lock() # Serialises access to the shared Llama instance
+
+# --- Fallback model (LLM_FALLBACK_MODEL_PATH), loaded in this process when a fallback tier is first reached ---
+fallback_llm = None
+fallback_prefix_cache = None
+fallback_lock = threading.Lock() # Serialises access to the fallback Llama instance
+fallback_loading = threading.Event() # Set once loading has been started
+STOP_SEQUENCES = ["Q:", "\n"] # Stop sequences common for instruct models
+BATCH_STOP_SEQUENCES = ["Q:", "\n\n"] # Batched answers span one line per frame
+VISION_STOP_SEQUENCES = ["Q:", "\n", "USER:"] # The LLaVA chat formats mark turns with USER:/ASSISTANT:
+
+def vision_settings():
+    """Returns the vision.create_chat_handler() arguments, or None for a text-only model."""
+    if not LLM_VISION:
+        return None
+    return {
+        "clip_model_path": LLM_CLIP_MODEL_PATH,
+        "chat_format": LLM_VISION_CHAT_FORMAT,
+        "image_size": LLM_VISION_IMAGE_SIZE,
+        "cache_size": LLM_VISION_EMBED_CACHE,
+    }
+
+def model_settings():
+    """Returns the model_loader.prepare_model() arguments for the configured model."""
+    return {
+        "model_path": model_path,
+        "n_ctx": n_ctx,
+        "n_threads": n_threads,
+        "use_mmap": LLM_USE_MMAP,
+        "use_mlock": LLM_USE_MLOCK,
+        "warmup_tokens": LLM_WARMUP_TOKENS,
+        "prefix": LLM_PROMPT_PREFIX,
+        "prefix_cache": LLM_PREFIX_CACHE,
+        "prefix_state_path": LLM_PREFIX_STATE_PATH,
+        "vision": vision_settings(),
+    }
+
+def load_fallback_model():
+    """Loads the fallback model on a background thread, once; until it is ready the main model answers."""
+    if fallback_loading.is_set():
+        return
+    fallback_loading.set()
+
+    def load():
+        global fallback_llm, fallback_prefix_cache
+        settings = dict(model_settings(), model_path=LLM_FALLBACK_MODEL_PATH, prefix_state_path="", vision=None)
+        try:
+            model, cache, breakdown = prepare_model(**settings)
+        except Exception as e:
+            print(f"⚠️ Could not load the fallback model, the main model keeps answering: {e}")
+            return
+        fallback_prefix_cache, fallback_llm = cache, model
+        print(f"🪶 Fallback model {os.path.basename(LLM_FALLBACK_MODEL_PATH)} ready: {breakdown}")
+
+    threading.Thread(target=load, name="llm-fallback-load", daemon=True).start()
+
+def initialize_model():
+    """
+    Loads the model and prepares it for the first frame: memory-map and lock the weights,
+    run a warm-up generation and evaluate (or load) the prompt prefix state. With
+    LLM_PROCESSES > 0 every worker process does this for its own copy instead.
+
+    Sets the llm, prefix_cache, process_pool and load_breakdown globals.
+    """
+    global llm, prefix_cache, process_pool, load_breakdown
+    if LLM_PROCESSES > 0:
+        print(f"Starting {LLM_PROCESSES} LLM worker process(es) with {n_threads} thread(s) each...")
+        pool = ProcessPool(LLM_PROCESSES, model_settings(), LLM_PROMPT_PREFIX)
+        breakdown = {"processes": LLM_PROCESSES, "threads_per_process": n_threads, "workers": pool.start()}
+        process_pool = pool
+    else:
+        llm, prefix_cache, breakdown = prepare_model(**model_settings())
+    breakdown["total_seconds"] = round(time.perf_counter() - startup_started, 3)
+    load_breakdown = breakdown
+
+generation_stats = GenerationStats() # Time-to-first-token and total latency
+
+# --- Metrics ---
+PROMPT_EVAL_SECONDS = histogram("llm_prompt_eval_seconds", "Seconds evaluating the prompt tokens not already in the KV cache")
+COMPLETION_SECONDS = histogram("llm_completion_seconds", "Seconds per completion, prompt eval included")
+FIRST_TOKEN_SECONDS = histogram("llm_first_token_seconds", "Seconds until the first streamed token")
+TOKENS_PER_SECOND = histogram("llm_tokens_per_second", "Generation speed, prompt eval excluded",
+                              buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500))
+PROMPT_TOKENS = histogram("llm_prompt_tokens", "Prompt length in tokens", buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+COMPLETION_TOKENS = counter("llm_completion_tokens_total", "Tokens generated")
+FRAMES = counter("llm_frames_total", "Frames handled, by outcome (dropped, shed, buffered, invalid, gated, cached, inferred, failed)", ("outcome",))
+QUEUE_DEPTH = gauge("llm_queue_depth", "Frames waiting in the inference queue")
+IMAGES = counter("llm_images_total", "Face crops shown to the vision model, by embedding (cached, computed)", ("embedding",))
+IMAGE_EMBED_SECONDS = histogram("llm_image_embed_seconds", "Seconds embedding the images of one completion (cache misses only)")
+publish_tracker = PublishTracker() # MQTT bytes out and publish latency
+PARTIAL_TOPIC_LABEL = partial_topic(MQTT_LLM_TOPIC_OUT, "+") # One series for all partial topics
+
+def record_completion(result):
+    """Records the timings of a completion.complete() result dict in the metrics."""
+    total = result["finished_at"] - result["started_at"]
+    prompt_eval = result.get("prompt_eval_seconds", 0.0)
+    COMPLETION_SECONDS.observe(total)
+    PROMPT_EVAL_SECONDS.observe(prompt_eval)
+    PROMPT_TOKENS.observe(result.get("prompt_tokens", 0))
+    COMPLETION_TOKENS.inc(result["tokens"])
+    if result["first_token_at"] is not None:
+        FIRST_TOKEN_SECONDS.observe(result["first_token_at"] - result["started_at"])
+    generating = total - prompt_eval
+    if result["tokens"] and generating > 0:
+        TOKENS_PER_SECOND.observe(result["tokens"] / generating)
+    if result.get("images"):
+        hits = result["image_cache_hits"]
+        IMAGES.inc(hits, embedding="cached")
+        IMAGES.inc(result["images"] - hits, embedding="computed")
+        if result["images"] > hits:
+            IMAGE_EMBED_SECONDS.observe(result["image_embed_seconds"])
+
+# --- Initialize Result Cache ---
+result_cache = ResultCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_PATH) if LLM_CACHE_SIZE > 0 else None
+
+# --- Initialize Load Controller ---
+# The backlog is read from the inference queue, which is created further down
+load_controller = LoadController(
+    parse_tiers(LLM_LOAD_TIERS, max_tokens, fallback_available=bool(LLM_FALLBACK_MODEL_PATH)),
+    LLM_LATENCY_BUDGET_MS / 1000.0,
+    interval=LLM_LOAD_INTERVAL,
+    max_backlog=LLM_LOAD_MAX_BACKLOG,
+    raise_after=LLM_LOAD_RAISE_AFTER,
+    backlog=lambda: inference_queue.depth(),
+) if LLM_ADAPTIVE_LOAD else None
+
+def record_answer_latency(request, finished_at=None):
+    """Feeds the load controller the receive-to-answer latency of a frame (None: inference failed)."""
+    if load_controller is not None and request.load_token is not None:
+        load_controller.record(request.load_token, finished_at)
+
+def on_load_change(change):
+    """Announces a load tier change, called from the load controller's timer thread."""
+    print(f"⚖️ Load {change}")
+    if load_controller.tier().fallback and LLM_FALLBACK_MODEL_PATH:
+        load_fallback_model()
+    state, fields = current_status()
+    publish_status(state, **fields)
+
+# --- Initialize Detection Gate ---
+detection_gate = DetectionGate(LLM_GATE_IOU_THRESHOLD, LLM_GATE_REFRESH_SECONDS) if LLM_GATE_ENABLED else None
+
+# --- Readiness ---
+def publish_status(state, **fields):
+    """
+    Publishes the service state as a retained message on MQTT_LLM_STATUS_TOPIC.
+
+    Returns:
+        The paho MQTTMessageInfo, or None if publishing failed.
+    """
+    try:
+        # QoS 1 messages are queued by paho until the connection is up
+        return publish_tracker.publish(mqtt_client, MQTT_LLM_STATUS_TOPIC, encode_status("llm_service", state, **fields),
+                                       qos=1, retain=True)
+    except Exception as e:
+        print(f"Error publishing service status: {e}")
+        return None
+
+def current_status():
+    """Returns (state, fields) for the status message."""
+    if load_error is not None:
+        return STATE_FAILED, {"error": load_error}
+    if service_ready.is_set():
+        fields = {"model": os.path.basename(model_path or ""), "load": load_breakdown}
+        if LLM_VISION:
+            fields["vision"] = os.path.basename(LLM_CLIP_MODEL_PATH)
+        if load_controller is not None:
+            fields["load_tier"] = load_controller.tier().describe()
+        return STATE_READY, fields
+    return STATE_LOADING, {"model": os.path.basename(model_path or "")}
+
+def publish_final_status(state, timeout=5.0, **fields):
+    """Publishes the last status message before exiting and waits for it to be delivered."""
+    deadline = time.monotonic() + timeout
+    # Messages published while still connecting are not confirmed by paho
+    while not mqtt_client.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    status_info = publish_status(state, **fields)
+    try:
+        if status_info is not None:
+            status_info.wait_for_publish(timeout=max(0.1, deadline - time.monotonic()))
+    except (RuntimeError, ValueError) as e:
+        print(f"⚠️ Service status '{state}' not delivered: {e}")
 
+def subscribe_frames(client):
+    """Subscribes to the frame topics. Only done once the model is ready, so no frame is processed cold."""
+    try:
+        client.subscribe([(MQTT_IMAGE_TOPIC, 0), (MQTT_CAMERA_TOPICS, 0)])
+        print(f"Subscribed to image topics: {MQTT_IMAGE_TOPIC}, {MQTT_CAMERA_TOPICS}")
+    except Exception as e:
+         print(f"Failed to subscribe to {MQTT_IMAGE_TOPIC}, {MQTT_CAMERA_TOPICS}: {e}")
 
 # --- MQTT Callbacks ---
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
         print("MQTT connected successfully!")
+        # Re-announce the state: the broker may have published the last will meanwhile
+        state, fields = current_status()
+        publish_status(state, **fields)
         # Subscribe to the image topic upon connection
-        try:
-            client.subscribe(MQTT_IMAGE_TOPIC)
-            print(f"Subscribed to image topic: {MQTT_IMAGE_TOPIC}")
-        except Exception as e:
-             print(f"Failed to subscribe to {MQTT_IMAGE_TOPIC}: {e}")
+        if service_ready.is_set():
+            subscribe_frames(client)
     else:
         print(f"MQTT failed to connect, return code {reason_code}")
         # Implement retry logic here if needed
 
-def on_disconnect(client, userdata, reason_code, properties):
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
     print(f"MQTT disconnected with result code {reason_code}.")
+    publish_tracker.on_disconnect()
     # Implement logic here to attempt reconnection
 
-def on_message(client, userdata, msg):
+def on_publish(client, userdata, mid, reason_code, properties):
+    publish_tracker.on_publish(mid)
+
+def publish_llm_response(llm_response, frame, received_at, started_at, cached=False,
+                         finished_at=None, first_token_at=None, batch_size=1, images=0, tier=None, model=None):
     """
-    Callback for when a message is received from a subscribed topic.
-    This function now expects messages from the image topic.
+    Publishes an LLM response to MQTT_LLM_TOPIC_OUT as a structured insight message.
+
+    Args:
+        llm_response: The generated text.
+        frame: The decoded frame the text describes.
+        received_at: Time the frame arrived from MQTT.
+        started_at: Time inference (or the cache lookup) started.
+        cached: True if the text came from the result cache.
+        finished_at: Time inference finished. Defaults to now.
+        first_token_at: Time the first token was generated (streaming mode).
+        batch_size: Number of frames described by the same completion.
+        images: Number of face crops the vision model was shown.
+        tier: The LoadTier the frame was answered at (adaptive load only).
+        model: File name of the model that answered, when it may be the fallback model.
     """
-    print(f"Received message on topic {msg.topic}")
+    finished_at = finished_at or time.time()
+    timing = {}
+    if first_token_at is not None:
+        timing = {"llm_first_token_at": first_token_at, "ttft_seconds": round(first_token_at - started_at, 4)}
+    if images:
+        timing["images"] = images
+    if tier is not None:
+        timing["load_tier"] = tier.level
+    if model is not None:
+        timing["model"] = model
+    message = encode_insight(
+        llm_response,
+        frame,
+        llm_received_at=received_at,
+        llm_started_at=started_at,
+        llm_finished_at=finished_at,
+        inference_seconds=round(finished_at - started_at, 4),
+        cached=cached,
+        batch_size=batch_size,
+        **timing,
+    )
+    try:
+        publish_result = publish_tracker.publish(mqtt_client, MQTT_LLM_TOPIC_OUT, message)
+        if publish_result.rc == mqtt.MQTT_ERR_SUCCESS:
+             log.debug(f"Published LLM response for frame {frame.frame_id} to {MQTT_LLM_TOPIC_OUT}")
+        else:
+             print(f"Failed to publish LLM response, result code: {publish_result.rc}")
+    except Exception as e:
+        print(f"Error publishing LLM response: {e}")
 
-    if msg.topic == MQTT_IMAGE_TOPIC:
+def publish_partial(frame, index, delta, text, done=False):
+    """Publishes a partial result on <MQTT_LLM_TOPIC_OUT>/partial/<frame_id> (streaming mode)."""
+    try:
+        publish_tracker.publish(mqtt_client, partial_topic(MQTT_LLM_TOPIC_OUT, frame.frame_id),
+                                encode_partial(frame.frame_id, index, delta, text, done), label=PARTIAL_TOPIC_LABEL)
+    except Exception as e:
+        print(f"Error publishing partial LLM response: {e}")
+
+def partial_publisher(frame):
+    """
+    Returns (on_token, finish) callbacks that publish a frame's streamed tokens as partial results.
+    """
+    pieces = []
+
+    def on_token(delta):
+        pieces.append(delta)
+        publish_partial(frame, len(pieces) - 1, delta, "".join(pieces).lstrip())
+
+    def finish():
+        publish_partial(frame, len(pieces), "", "".join(pieces).strip(), done=True)
+
+    return on_token, finish
+
+def infer(section, stop_sequences, frame=None, n_tokens=None, stream=None, images=(), fallback=False):
+    """
+    Runs inference for a prompt section (the text after LLM_PROMPT_PREFIX), on this
+    process's model or on an idle worker process.
+
+    Args:
+        section: The prompt section.
+        stop_sequences: Stop sequences for the completion.
+        frame: The frame being described (for partial results).
+        n_tokens: Maximum tokens to generate. Defaults to LLM_MAX_TOKENS.
+        stream: Publish partial results. Defaults to LLM_STREAMING.
+        images: Face crops shown to the vision model before the section.
+        fallback: Answer with the fallback model, if it is loaded.
+
+    In streaming mode each token is published as a partial result as soon as it is generated.
+
+    Returns:
+        (text, started_at, first_token_at, finished_at, model), with text stripped.
+        first_token_at is None when not streaming; model is the file name of the model
+        that answered.
+    """
+    n_tokens = n_tokens or max_tokens
+    stream = LLM_STREAMING if stream is None else stream
+    on_token, finish = partial_publisher(frame) if stream else (None, None)
+
+    model = os.path.basename(model_path or "")
+    if fallback and fallback_llm is not None:
+        model = os.path.basename(LLM_FALLBACK_MODEL_PATH)
+        # Text only: the fallback model has no CLIP projector
+        with fallback_lock:
+            result = complete(fallback_llm, section, LLM_PROMPT_PREFIX, stop_sequences, n_tokens,
+                              prefix_cache=fallback_prefix_cache, on_token=on_token)
+    elif process_pool is not None:
+        result = process_pool.infer(section, stop_sequences, n_tokens, on_token, images=images)
+    else:
+        # A single Llama instance is not thread-safe, so workers take turns using it
+        with llm_lock:
+            # Started inside the lock: waiting for it is not inference time
+            result = complete(llm, section, LLM_PROMPT_PREFIX, stop_sequences, n_tokens,
+                              prefix_cache=prefix_cache, on_token=on_token, images=images)
+    if finish is not None:
+        finish()
+
+    record_completion(result)
+    started_at, first_token_at, finished_at = result["started_at"], result["first_token_at"], result["finished_at"]
+    generation_stats.record(
+        finished_at - started_at,
+        first_token_at - started_at if first_token_at is not None else None,
+        result["tokens"],
+    )
+    return result["text"].strip(), started_at, first_token_at, finished_at, model
+
+@dataclass
+class InferenceRequest:
+    """A decoded frame that passed the gate and missed the cache, ready for inference."""
+    frame: object
+    received_at: float
+    detection_section: str
+    cache_key: str
+    images: tuple = ()  # Face crops shown to the vision model
+    tier: object = None  # LoadTier chosen when the request was prepared (adaptive load only)
+    fallback: bool = False  # Answered by the fallback model (a fallback tier, once the model has loaded)
+    load_token: int = None  # Load controller token while the frame waits for its answer
+
+    @property
+    def max_tokens(self):
+        return self.tier.max_tokens if self.tier is not None else max_tokens
+
+    @property
+    def stop_sequences(self):
+        return VISION_STOP_SEQUENCES if self.images else STOP_SEQUENCES
+
+def prepare_request(item):
+    """
+    Decodes a queued frame and decides whether it needs inference.
+
+    Frames that are not frames, are gated, or are answered from the result cache are
+    handled here.
+
+    Args:
+        item: (payload, received_at) as queued by on_message.
+
+    Returns:
+        An InferenceRequest, or None if nothing is left to do.
+    """
+    payload, received_at = item
+    # --- Decode Image Data ---
+    # Binary frame envelope, or the legacy JSON with base64 image data
+    try:
+        frame = decode_frame(payload)
+    except FrameDecodeError as e:
+        FRAMES.inc(outcome="invalid")
+        log.sampled("invalid-frame", f"Received message on image topic that is not a frame: {e}")
+        # This could be other JSON data on the topic, maybe log or handle differently
         try:
-            # --- Decode Image Data ---
-            # Assuming the payload is a JSON string containing base64 image data
-            payload_str = msg.payload.decode('utf-8')
-            message_data = json.loads(payload_str)
-
-            if message_data:
-                print("Image data decoded.")
-
-                # --- Generate LLM Prompt based on Detection static prompt ---
-                prompt_text = "A faces were detected in an image. What general observations or insights can you provide about a face in the image?"
-
-                print(f"LLM Prompt: '{prompt_text}'")
-
-                # --- Run LLM Inference ---
-                try:
-                    # Using a simple text completion interface
-                    output = llm(
-                        prompt=prompt_text,
-                        max_tokens=max_tokens,
-                        stop=["Q:", "\n"], # Stop sequences common for instruct models
-                        echo=False # Don't include the prompt in the output
-                    )
-                    # Extract the response text
-                    llm_response = output["choices"][0]["text"].strip()
-                    print(f"LLM Response: '{llm_response}'")
-
-                    # --- Publish LLM Response ---
-                    try:
-                        publish_result = client.publish(MQTT_LLM_TOPIC_OUT, llm_response)
-                        if publish_result.rc == mqtt.MQTT_ERR_SUCCESS:
-                             print(f"Published LLM response to {MQTT_LLM_TOPIC_OUT}")
-                        else:
-                             print(f"Failed to publish LLM response, result code: {publish_result.rc}")
-                    except Exception as e:
-                        print(f"Error publishing LLM response: {e}")
-
-                except Exception as e:
-                    print(f"Error during LLM inference: {e}")
-                    # Depending on the error, you might want to stop or log more
-
-            else:
-                print("Received message on image topic without 'image' key in payload.")
-                # This could be other JSON data on the topic, maybe log or handle differently
-                try:
-                    # Attempt to process as generic JSON if it's not an image payload
-                    # You might add more specific handling here based on expected messages
-                    print("Attempting to process as generic JSON...")
-                    data = json.loads(payload_str)
-                    print(f"Generic JSON payload received: {data}")
-                    # You could add logic here to prompt LLM based on other data
-                except json.JSONDecodeError:
-                    print("Payload is not JSON.")
-                except Exception as e:
-                     print(f"Error handling generic JSON payload: {e}")
-
-
-        except json.JSONDecodeError:
-            print("Failed to decode JSON payload from image topic (initial check).")
-        except base64.binascii.Error:
-            print("Failed to decode base64 image data from image payload.")
-        except Exception as e:
-            print(f"An unexpected error occurred while processing message: {e}")
+            data = json.loads(payload)
+            log.debug(f"Generic JSON payload received: {data}")
+            # You could add logic here to prompt LLM based on other data
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            log.debug("Payload is not JSON.")
+        return None
+
+    log.debug(f"Image data decoded (frame #{frame.sequence} from '{frame.camera_id}', {len(frame.boxes)} face(s)).")
+
+    # Legacy JSON frames are not peeked in on_message
+    if frame.legacy and frame.meta.get("buffered") and not admit_buffered():
+        FRAMES.inc(outcome="buffered")
+        return None
+
+    # --- Gate on detection changes ---
+    # Frames without detection metadata (old publishers) always go through
+    if detection_gate is not None and has_detections(frame):
+        if not detection_gate.should_process(frame.camera_id, frame.boxes):
+            FRAMES.inc(outcome="gated")
+            log.debug("Detections unchanged since the last processed frame, skipping LLM.")
+            return None
+
+    # --- Generate LLM Prompt from the frame's detections ---
+    # Fixed prefix + detection section; only the section changes between frames
+    tier = load_controller.tier() if load_controller is not None else None
+    # Until the fallback model has loaded, the main model answers fallback tiers
+    fallback = tier is not None and tier.fallback and fallback_llm is not None
+    images = ()
+    if tier is not None and tier.prompt == PROMPT_SHORT:
+        # Shedding load: no images and a compact section
+        detection_section = build_short_section(frame)
+    elif LLM_VISION and frame.crops and has_detections(frame) and not fallback:  # The fallback model is text-only
+        # The camera sends the largest faces first; the budget keeps the prompt short
+        images = tuple(data for _, data in frame.crops[:LLM_VISION_MAX_CROPS])
+        detection_section = build_vision_section(frame, len(images))
+    else:
+        detection_section = build_detection_section(frame)
+    prompt_text = LLM_PROMPT_PREFIX + detection_section
+
+    log.debug(f"LLM Prompt (after prefix): '{detection_section}'"
+              + (f" with {len(images)} face crop(s)" if images else ""))
+
+    # --- Check the result cache ---
+    # Identical crops with an identical prompt get the cached answer
+    cache_params = {"images": [image_digest(image) for image in images]} if images else {}
+    if fallback:
+        cache_params["model"] = "fallback"
+    cache_key = make_cache_key(prompt_text, max_tokens=tier.max_tokens if tier is not None else max_tokens,
+                               stop=VISION_STOP_SEQUENCES if images else STOP_SEQUENCES, **cache_params)
+    if result_cache is not None:
+        started_at = time.time()
+        cached_response = result_cache.get(cache_key)
+        if cached_response is not None:
+            FRAMES.inc(outcome="cached")
+            log.debug("LLM Response served from cache.")
+            publish_llm_response(cached_response, frame, received_at, started_at, cached=True, tier=tier)
+            return None
+
+    load_token = load_controller.begin(received_at) if load_controller is not None else None
+    return InferenceRequest(frame, received_at, detection_section, cache_key, images, tier, fallback, load_token)
+
+def run_single(request):
+    """Runs inference for one frame and publishes the response."""
+    try:
+        llm_response, started_at, first_token_at, finished_at, model = infer(
+            request.detection_section, request.stop_sequences, request.frame, n_tokens=request.max_tokens,
+            images=request.images, fallback=request.fallback)
+        FRAMES.inc(outcome="inferred")
+        log.sampled("llm-response", f"LLM Response: '{llm_response}'")
+
+        if result_cache is not None:
+            result_cache.put(request.cache_key, llm_response)
+
+        publish_llm_response(llm_response, request.frame, request.received_at, started_at,
+                             finished_at=finished_at, first_token_at=first_token_at, images=len(request.images),
+                             tier=request.tier, model=model if request.tier is not None else None)
+        record_answer_latency(request, finished_at)
+
+    except Exception as e:
+        FRAMES.inc(outcome="failed")
+        record_answer_latency(request)
+        print(f"Error during LLM inference: {e}")
+        # Depending on the error, you might want to stop or log more
+
+def run_batch(requests):
+    """
+    Describes several frames with a single completion and publishes one response per frame.
+    The frames share one load tier and model (see process_frame_batch).
+
+    Frames the model gave no numbered answer for are run on their own afterwards.
+    """
+    frames = [request.frame for request in requests]
+    log.debug(f"🧺 Batching {len(requests)} frames into one prompt "
+          f"({', '.join(frame.camera_id or 'default' for frame in frames)}).")
+    try:
+        # Blank lines end the list of answers; single newlines separate them
+        text, started_at, _, finished_at, model = infer(
+            build_batch_section(frames), BATCH_STOP_SEQUENCES,
+            n_tokens=requests[0].max_tokens * len(requests), stream=False, fallback=requests[0].fallback,
+        )
+    except Exception as e:
+        FRAMES.inc(len(requests), outcome="failed")
+        for request in requests:
+            record_answer_latency(request)
+        print(f"Error during batched LLM inference: {e}")
+        return
+
+    missing = []
+    for request, answer in zip(requests, split_batch_response(text, len(requests))):
+        if answer is None:
+            missing.append(request)
+            continue
+        FRAMES.inc(outcome="inferred")
+        log.sampled("llm-response", f"LLM Response ({request.frame.camera_id or 'default'}): '{answer}'")
+        if result_cache is not None:
+            result_cache.put(request.cache_key, answer)
+        publish_llm_response(answer, request.frame, request.received_at, started_at,
+                             finished_at=finished_at, batch_size=len(requests),
+                             tier=request.tier, model=model if request.tier is not None else None)
+        record_answer_latency(request, finished_at)
+
+    if missing:
+        print(f"⚠️ Batched answer covered {len(requests) - len(missing)}/{len(requests)} frames, "
+              f"running the rest individually.")
+        for request in missing:
+            run_single(request)
+
+def process_frame_message(item):
+    """
+    Decodes a frame payload, runs LLM inference and publishes the response.
+    Runs on an inference worker thread, never on the paho network thread.
+
+    Args:
+        item: (payload, received_at) as queued by on_message.
+    """
+    request = prepare_request(item)
+    if request is not None:
+        run_single(request)
+
+def process_frame_batch(items):
+    """
+    Handles a burst of queued frames (LLM_BATCH_SIZE > 1): frames still needing inference
+    after the gate and cache are described in one prompt per load tier (the tier can change
+    while the burst is prepared). Frames with face crops for the vision model are run on
+    their own.
+
+    Args:
+        items: [(payload, received_at), ...] as queued by on_message.
+    """
+    groups = {}  # (tier, fallback) -> requests; a batch is generated with one tier's settings
+    for request in map(prepare_request, items):
+        if request is not None and request.images:
+            run_single(request)
+        elif request is not None:
+            groups.setdefault((request.tier, request.fallback), []).append(request)
+    for requests in groups.values():
+        if len(requests) == 1:
+            run_single(requests[0])
+        else:
+            run_batch(requests)
+
+# --- Inference Queue ---
+# The MQTT callback only enqueues; inference runs on these worker threads
+inference_queue = WorkQueue(
+    process_frame_message,
+    maxsize=LLM_QUEUE_SIZE,
+    policy=LLM_QUEUE_POLICY,
+    workers=max(LLM_WORKERS, LLM_PROCESSES), # One thread per worker process keeps them all busy
+    name="llm",
+    batch_handler=process_frame_batch,
+    batch_size=LLM_BATCH_SIZE,
+    batch_window=LLM_BATCH_WINDOW_MS / 1000.0,
+)
+QUEUE_DEPTH.set_function(inference_queue.depth)
+
+buffered_lock = threading.Lock()
+next_buffered_at = 0.0 # Monotonic time the next replayed frame may be answered
+
+def admit_buffered():
+    """
+    Rate-limits frames replayed from a camera's offline buffer, so a reconnect does not
+    queue inference for the whole backlog.
+
+    Returns:
+        True if the replayed frame should be answered.
+    """
+    global next_buffered_at
+    if LLM_BUFFERED_FPS <= 0:
+        return False
+    with buffered_lock:
+        now = time.monotonic()
+        if now < next_buffered_at:
+            return False
+        next_buffered_at = now + 1.0 / LLM_BUFFERED_FPS
+        return True
+
+def on_message(client, userdata, msg):
+    """
+    Callback for when a message is received from a subscribed topic.
+    Image frames are handed to the inference queue; this must return quickly so the
+    paho network loop can keep sending keepalives and draining messages.
+    """
+    if msg.topic == MQTT_IMAGE_TOPIC or mqtt.topic_matches_sub(MQTT_CAMERA_TOPICS, msg.topic):
+        # Scheduling is per camera; the id is read from the frame header (or topic) only
+        record_received(msg.topic, msg.payload)
+        camera_id = peek_camera_id(msg.payload) or camera_id_from_topic(msg.topic)
+        if peek_meta(msg.payload).get("buffered") and not admit_buffered():
+            FRAMES.inc(outcome="buffered")
+            return
+        # Shedding load: the skipped frames never reach the queue
+        if load_controller is not None and not load_controller.admit(camera_id):
+            FRAMES.inc(outcome="shed")
+            return
+        # The receive time travels with the payload for the latency breakdown
+        if not inference_queue.put(camera_id, (msg.payload, time.time())):
+            FRAMES.inc(outcome="dropped")
+            log.sampled("queue-full", "⚠️ Inference queue full, dropped incoming frame.")
 
     # You could add logic here to handle messages from other topics if subscribed (not expected by default)
     # elif msg.topic == "some/other/topic":
@@ -149,15 +720,21 @@ def on_message(client, userdata, msg):
 
 # --- Initialize MQTT Client ---
 mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+# The broker announces "offline" if the service goes away without disconnecting
+mqtt_client.will_set(MQTT_LLM_STATUS_TOPIC, encode_status("llm_service", STATE_OFFLINE), qos=1, retain=True)
 
 # Set MQTT callbacks
 mqtt_client.on_connect = on_connect
 mqtt_client.on_disconnect = on_disconnect
 mqtt_client.on_message = on_message # This callback now handles the image topic
+mqtt_client.on_publish = on_publish
 
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
     print(f"Connecting to MQTT Broker at {mqtt_host}:{mqtt_port}...")
     # Use connect_async and loop_start for non-blocking operation
     try:
@@ -167,16 +744,64 @@ if __name__ == "__main__":
         print(f"Failed to connect to MQTT Broker: {e}")
         exit(1) # Exit if MQTT connection fails at startup
 
-    print("LLM Service started. Waiting for messages...")
+    publish_status(STATE_LOADING, model=os.path.basename(model_path or ""))
+    try:
+        initialize_model()
+    except Exception as e:
+        print(f"Error loading LLM model: {e}")
+        print("Please check MODEL_PATH and LLM_CONTEXT_SIZE environment variables.")
+        load_error = str(e)
+        publish_final_status(STATE_FAILED, error=load_error)
+        mqtt_client.disconnect() # A clean disconnect keeps the broker from replacing it with the last will
+        mqtt_client.loop_stop()
+        # Exit, as the service cannot function without the model
+        exit(1) # Exit the script
+    print(f"⏱️ Startup breakdown: {load_breakdown}")
+
+    inference_queue.start()
+    if load_controller is not None:
+        load_controller.start(on_load_change)
+    service_ready.set()
+    if mqtt_client.is_connected():
+        subscribe_frames(mqtt_client)
+    state, fields = current_status()
+    publish_status(state, **fields)
+
+    print(f"LLM Service started with {inference_queue.workers} inference worker(s), "
+          f"{LLM_PROCESSES or 'no'} worker process(es), "
+          f"queue size {LLM_QUEUE_SIZE} ({LLM_QUEUE_POLICY}), "
+          f"batch size {LLM_BATCH_SIZE}, streaming {'on' if LLM_STREAMING else 'off'}, "
+          f"vision {f'on ({LLM_VISION_MAX_CROPS} crop(s) per frame)' if LLM_VISION else 'off'}. Waiting for messages...")
 
     # The MQTT loop is running in the background.
-    # Use loop_forever to keep the main thread running and processing messages.
+    # The main thread just reports inference queue statistics periodically.
     try:
-        mqtt_client.loop_forever()
+        while True:
+            time.sleep(STATS_INTERVAL)
+            print(f"📊 Inference queue: {inference_queue.stats()}")
+            print(f"📊 Generation: {generation_stats.stats()}")
+            if process_pool is not None:
+                print(f"📊 Process pool: {process_pool.stats()}")
+            if prefix_cache is not None:
+                print(f"📊 Prompt prefix: {prefix_cache.stats()}")
+            if llm is not None and LLM_VISION:
+                print(f"📊 Image embeddings: {llm.chat_handler.stats()}")
+            if result_cache is not None:
+                print(f"📊 Result cache: {result_cache.stats()}")
+            if detection_gate is not None:
+                print(f"📊 Detection gate: {detection_gate.stats()}")
+            if load_controller is not None:
+                print(f"📊 Load tier: {load_controller.stats()}")
     except KeyboardInterrupt:
         print("LLM Service interrupted. Shutting down.")
     finally:
         print("Stopping MQTT loop and disconnecting.")
+        if load_controller is not None:
+            load_controller.stop()
+        inference_queue.stop()
+        if process_pool is not None:
+            process_pool.stop()
+        publish_final_status(STATE_OFFLINE, timeout=2) # Delivered before the loop stops
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
         print("LLM Service shut down.")
\ No newline at end of file
@@ -0,0 +1,181 @@
+# llm_service/completion.py
+#
+# Running one completion on a Llama instance.
+#
+# Shared by the service's own model (LLM_PROCESSES=0) and the worker processes of
+# the process pool, so both build prompts and measure timings the same way.
+#
+# The prompt is evaluated explicitly before generating, so prompt-eval time can be
+# measured apart from generation. llama-cpp-python's prefix matching then finds
+# every prompt token but the last already in the context and only evaluates that one.
+#
+# Prompts with images go through the model's chat handler instead (see vision.py),
+# which evaluates the whole prompt, images included, before generating.
+
+import base64
+import time
+
+from shared import log
+
+
+def build_prompt(section, prefix, prefix_cache=None):
+    """
+    Builds the prompt for a section (the text after the fixed prefix).
+
+    With a prefix cache the prompt is returned as tokens and the prefix state is
+    made current, so only the section is evaluated. Must be called with the Llama
+    instance locked.
+
+    Returns:
+        (prompt, saved_seconds): the prompt text or tokens, and the estimated
+        prompt-eval seconds saved by reusing the prefix.
+    """
+    if prefix_cache is None:
+        return prefix + section, 0.0
+    # Prefix tokens are already in the KV cache; only the section is evaluated
+    prompt = prefix_cache.prompt_tokens(section)
+    saved_seconds = prefix_cache.prepare_request(prompt)
+    log.debug(f"♻️ Reused prompt prefix, ~{saved_seconds * 1000:.0f} ms prompt eval saved")
+    return prompt, saved_seconds
+
+
+def evaluate_prompt(llm, tokens):
+    """
+    Evaluates the prompt tokens not yet in the context, except the last one (which
+    llama-cpp-python always evaluates itself to get the first token's logits).
+
+    Returns:
+        Seconds spent evaluating.
+    """
+    if len(tokens) > llm.n_ctx():
+        return 0.0  # Left to the completion call, which reports the error
+    reused = 0
+    for cached, wanted in zip(llm.input_ids[:llm.n_tokens], tokens[:-1]):
+        if cached != wanted:
+            break
+        reused += 1
+    start = time.perf_counter()
+    llm.n_tokens = reused  # Same rewind llama-cpp-python's prefix match does
+    if len(tokens) - 1 > reused:
+        llm.eval(tokens[reused:-1])
+    return time.perf_counter() - start
+
+
+def complete(llm, section, prefix, stop_sequences, max_tokens, prefix_cache=None, on_token=None, images=()):
+    """
+    Runs a completion. Must be called with the Llama instance locked.
+
+    Args:
+        llm: The llama_cpp.Llama instance.
+        section: The prompt text after the prefix.
+        prefix: The fixed prompt prefix.
+        stop_sequences: Stop sequences for the completion.
+        max_tokens: Maximum tokens to generate.
+        prefix_cache: Optional PrefixCache holding the prefix state.
+        on_token: Optional callable invoked as on_token(delta) for every generated token.
+            Generation is streamed when it is given.
+        images: JPEG images shown to the model before the section; needs a model loaded
+            with a vision chat handler.
+
+    Returns:
+        A dict with "text" (unstripped), "started_at", "first_token_at" (None when not
+        streaming), "finished_at", "tokens", "prompt_tokens", "prompt_eval_seconds" and
+        "prefix_saved_seconds". Completions with images also have "images",
+        "image_cache_hits" and "image_embed_seconds".
+    """
+    if images:
+        return complete_with_images(llm, section, prefix, images, stop_sequences, max_tokens, on_token)
+    started_at = time.time()
+    prompt, saved_seconds = build_prompt(section, prefix, prefix_cache)
+    if isinstance(prompt, str):
+        prompt = llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+    prompt_eval_seconds = evaluate_prompt(llm, prompt)
+
+    first_token_at = None
+    if on_token is None:
+        # Using a simple text completion interface
+        output = llm(
+            prompt=prompt,
+            max_tokens=max_tokens,
+            stop=stop_sequences,
+            echo=False # Don't include the prompt in the output
+        )
+        text = output["choices"][0]["text"]
+        tokens = output.get("usage", {}).get("completion_tokens", 0)
+    else:
+        pieces = []
+        for chunk in llm(prompt=prompt, max_tokens=max_tokens, stop=stop_sequences, echo=False, stream=True):
+            delta = chunk["choices"][0]["text"]
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.time()
+            pieces.append(delta)
+            on_token(delta)
+        text = "".join(pieces)
+        tokens = len(pieces)
+
+    return {
+        "text": text,
+        "started_at": started_at,
+        "first_token_at": first_token_at,
+        "finished_at": time.time(),
+        "tokens": tokens,
+        "prompt_tokens": len(prompt),
+        "prompt_eval_seconds": prompt_eval_seconds,
+        "prefix_saved_seconds": saved_seconds,
+    }
+
+
+def build_image_messages(section, prefix, images):
+    """Builds the chat messages for a section with images: the prefix as system message, then the images."""
+    content = [
+        {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + base64.b64encode(image).decode("ascii")}}
+        for image in images
+    ]
+    content.append({"type": "text", "text": section})
+    return [{"role": "system", "content": prefix.strip()}, {"role": "user", "content": content}]
+
+
+def complete_with_images(llm, section, prefix, images, stop_sequences, max_tokens, on_token=None):
+    """
+    Runs a chat completion showing `images` to a vision model. Must be called with the
+    Llama instance locked. Arguments and result as for complete().
+
+    The handler evaluates the prompt before the first chunk is requested, so the time
+    until create_chat_completion() returns is the prompt eval, image embedding included.
+    """
+    handler = llm.chat_handler
+    hits, embed_seconds = handler.hits, handler.embed_seconds
+    started_at = time.time()
+    start = time.perf_counter()
+    chunks = llm.create_chat_completion(messages=build_image_messages(section, prefix, images),
+                                        max_tokens=max_tokens, stop=stop_sequences, stream=True)
+    prompt_eval_seconds = time.perf_counter() - start
+    prompt_tokens = llm.n_tokens
+
+    first_token_at = None
+    pieces = []
+    for chunk in chunks:
+        delta = chunk["choices"][0]["delta"].get("content")
+        if not delta:
+            continue
+        if first_token_at is None:
+            first_token_at = time.time()
+        pieces.append(delta)
+        if on_token is not None:
+            on_token(delta)
+
+    return {
+        "text": "".join(pieces),
+        "started_at": started_at,
+        "first_token_at": first_token_at if on_token is not None else None,
+        "finished_at": time.time(),
+        "tokens": len(pieces),
+        "prompt_tokens": prompt_tokens,
+        "prompt_eval_seconds": prompt_eval_seconds,
+        "prefix_saved_seconds": 0.0,
+        "images": len(images),
+        "image_cache_hits": handler.hits - hits,
+        "image_embed_seconds": handler.embed_seconds - embed_seconds,
+    }
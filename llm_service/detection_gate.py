@@ -0,0 +1,95 @@
+# llm_service/detection_gate.py
+#
+# Decides whether a frame's detections differ enough from the last processed
+# frame (of the same camera) to be worth an LLM call.
+
+import threading
+import time
+
+
+def iou(box_a, box_b):
+    """Intersection over union of two (x, y, w, h) boxes."""
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    inter_w = min(ax + aw, bx + bw) - max(ax, bx)
+    inter_h = min(ay + ah, by + bh) - max(ay, by)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    intersection = inter_w * inter_h
+    union = aw * ah + bw * bh - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def boxes_moved(previous, current, iou_threshold):
+    """
+    True if any box in `current` has no counterpart in `previous` with IoU >= iou_threshold.
+    Boxes are matched greedily by best IoU; both lists must have the same length.
+    """
+    unmatched = list(previous)
+    for box in current:
+        best_index, best_iou = -1, 0.0
+        for i, candidate in enumerate(unmatched):
+            overlap = iou(box, candidate)
+            if overlap > best_iou:
+                best_index, best_iou = i, overlap
+        if best_iou < iou_threshold:
+            return True
+        unmatched.pop(best_index)
+    return False
+
+
+class DetectionGate:
+    """
+    Per-camera gate that only lets a frame through when its detections change meaningfully:
+    the face count changes, or a face moves so that its IoU with the previous box drops
+    below `iou_threshold`.
+    """
+
+    def __init__(self, iou_threshold=0.5, refresh_interval=0.0):
+        """
+        Args:
+            iou_threshold: Minimum IoU for a face to count as "not moved".
+            refresh_interval: Let a frame through anyway if this many seconds passed since
+                the camera's last processed frame. 0 disables the refresh.
+        """
+        self.iou_threshold = iou_threshold
+        self.refresh_interval = refresh_interval
+
+        self._last = {}  # camera_id -> (boxes, processed_at)
+        self._lock = threading.Lock()
+
+        self.passed = 0
+        self.skipped = 0
+
+    def should_process(self, camera_id, boxes):
+        """
+        Returns True if the frame should go to the LLM, and records it as the camera's
+        last processed detections in that case.
+        """
+        now = time.monotonic()
+        boxes = [tuple(b) for b in boxes]
+        with self._lock:
+            previous = self._last.get(camera_id)
+            changed = (
+                previous is None
+                or len(previous[0]) != len(boxes)
+                or boxes_moved(previous[0], boxes, self.iou_threshold)
+                or (self.refresh_interval > 0 and now - previous[1] >= self.refresh_interval)
+            )
+            if changed:
+                self._last[camera_id] = (boxes, now)
+                self.passed += 1
+            else:
+                self.skipped += 1
+            return changed
+
+    def stats(self):
+        """Returns pass/skip counters."""
+        with self._lock:
+            total = self.passed + self.skipped
+            return {
+                "passed": self.passed,
+                "skipped": self.skipped,
+                "skip_ratio": round(self.skipped / total, 3) if total else 0.0,
+                "cameras": len(self._last),
+            }
@@ -0,0 +1,53 @@
+# llm_service/generation_stats.py
+#
+# Time-to-first-token and total generation latency of recent LLM requests.
+
+import threading
+from collections import deque
+
+from shared.stats import percentile
+
+
+class GenerationStats:
+    """Rolling window of per-request generation timings."""
+
+    def __init__(self, window=200):
+        """
+        Args:
+            window: Number of recent requests kept for the percentiles.
+        """
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=window)
+        self._total = deque(maxlen=window)
+        self._tokens_per_second = deque(maxlen=window)
+        self.requests = 0
+
+    def record(self, total_seconds, ttft_seconds=None, tokens=0):
+        """
+        Records one completed generation.
+
+        Args:
+            total_seconds: Inference start to last token.
+            ttft_seconds: Inference start to first token, if known (streaming mode).
+            tokens: Number of generated tokens.
+        """
+        with self._lock:
+            self.requests += 1
+            self._total.append(total_seconds)
+            if ttft_seconds is not None:
+                self._ttft.append(ttft_seconds)
+            if tokens and total_seconds > 0:
+                self._tokens_per_second.append(tokens / total_seconds)
+
+    def stats(self):
+        """Returns TTFT and total latency percentiles (seconds) and generation speed."""
+        with self._lock:
+            ttft, total, speed = list(self._ttft), list(self._total), list(self._tokens_per_second)
+            return {
+                "requests": self.requests,
+                "ttft_p50": round(percentile(ttft, 50), 3),
+                "ttft_p95": round(percentile(ttft, 95), 3),
+                "total_p50": round(percentile(total, 50), 3),
+                "total_p95": round(percentile(total, 95), 3),
+                "tokens_per_second_p50": round(percentile(speed, 50), 1),
+            }
@@ -0,0 +1,258 @@
+# llm_service/load_controller.py
+#
+# Load shedding: cheaper inference when the model falls behind the frames.
+#
+# The controller walks a ladder of tiers, from full quality to cheapest. Each tier
+# sets the tokens generated (as a fraction of LLM_MAX_TOKENS), the prompt (full, or
+# a short one without face crops), how many frames per camera are skipped, and
+# whether the smaller fallback model answers. A timer thread adjusts the tier once
+# per interval, looking at:
+#   - latency: frame received until its answer was generated (p90 over the interval),
+#     so time spent waiting in the queue counts too. Frames still being answered count
+#     with their age so far, so a stalled model shows up without any answer arriving.
+#   - backlog: frames waiting in the inference queue
+#
+# A latency over the budget or a backlog at the end of an interval steps down one
+# tier. When the latency is well under the budget with an
+# empty queue for a few intervals in a row, it steps up one tier.
+
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+
+from shared.metrics import counter, gauge
+from shared.stats import percentile
+
+# Most to least expensive: tokens fraction:prompt:frames kept (1 in N)[:fallback]
+DEFAULT_TIERS = "1:full:1,0.5:full:1,0.5:short:1,0.5:short:2,0.5:short:1:fallback,0.25:short:2:fallback"
+
+PROMPT_FULL = "full"
+PROMPT_SHORT = "short"
+
+LOAD_TIER = gauge("llm_load_tier", "Current load-shedding tier (0 = full quality)")
+LOAD_TIER_CHANGES = counter("llm_load_tier_changes_total", "Load-shedding tier changes", ("direction",))
+
+
+@dataclass(frozen=True)
+class LoadTier:
+    """How frames are answered at one tier."""
+    level: int
+    max_tokens: int
+    prompt: str = PROMPT_FULL
+    skip: int = 1  # Answer one in every `skip` frames per camera
+    fallback: bool = False  # Answer with the fallback model
+
+    def describe(self):
+        """Returns the tier as a JSON-serialisable dict, as published in the status and insights."""
+        return {"level": self.level, "max_tokens": self.max_tokens, "prompt": self.prompt, "skip": self.skip,
+                "model": "fallback" if self.fallback else "primary"}
+
+
+def parse_tiers(spec, max_tokens, fallback_available=False):
+    """
+    Parses a tier ladder such as "1:full:1,0.5:short:2,0.5:short:1:fallback".
+
+    Args:
+        spec: Comma-separated tiers, most expensive first.
+        max_tokens: LLM_MAX_TOKENS; tier token counts are fractions of it.
+        fallback_available: Whether a fallback model is configured. Fallback tiers are
+            dropped without one.
+
+    Returns:
+        A list of LoadTier, numbered in order.
+
+    Raises:
+        ValueError: If an entry is malformed.
+    """
+    tiers = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        try:
+            if len(parts) not in (3, 4) or parts[1] not in (PROMPT_FULL, PROMPT_SHORT) \
+                    or (len(parts) == 4 and parts[3] != "fallback"):
+                raise ValueError
+            tokens = max(1, round(float(parts[0]) * max_tokens))
+            skip = max(1, int(parts[2]))
+        except ValueError:
+            raise ValueError(f"Invalid load tier '{item}', expected TOKENS_FRACTION:full|short:SKIP[:fallback]") from None
+        fallback = len(parts) == 4
+        if fallback and not fallback_available:
+            continue
+        tiers.append(LoadTier(len(tiers), tokens, parts[1], skip, fallback))
+    if not tiers:
+        raise ValueError("The load tier ladder is empty")
+    return tiers
+
+
+class LoadController:
+    """Chooses the load-shedding tier from the frame latency and the inference backlog."""
+
+    def __init__(self, tiers, latency_budget, interval=10.0, max_backlog=2, raise_after=3, backlog=None):
+        """
+        Args:
+            tiers: LoadTier ladder, most expensive first.
+            latency_budget: Seconds from receiving a frame to its answer to aim for (p90).
+            interval: Seconds between adjustments.
+            max_backlog: More queued frames than this means inference is falling behind.
+            raise_after: Consecutive intervals with headroom needed to step up a tier.
+            backlog: Callable returning the number of queued frames.
+        """
+        self.tiers = list(tiers)
+        self.latency_budget = latency_budget
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.raise_after = max(1, raise_after)
+        self.backlog = backlog or (lambda: 0)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._level = 0
+        self._good_intervals = 0
+        self._window_start = time.monotonic()
+        self._latencies = []
+        self._inflight = {}  # token -> receive time (time.time()) of frames being answered
+        self._tokens = itertools.count()
+        self._seen = {}  # camera id -> frames seen, for skipping
+        self.last_latency_p90 = 0.0
+        self.shed = 0
+        self.steps_down = 0
+        self.steps_up = 0
+        LOAD_TIER.set(0)
+
+    def tier(self):
+        """Returns the current LoadTier."""
+        with self._lock:
+            return self.tiers[self._level]
+
+    def admit(self, key):
+        """
+        Decides whether a frame from camera `key` is answered at the current tier.
+
+        Returns:
+            False for frames skipped to shed load.
+        """
+        with self._lock:
+            skip = self.tiers[self._level].skip
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+            if skip > 1 and seen % skip:
+                self.shed += 1
+                return False
+            return True
+
+    def begin(self, received_at):
+        """
+        Marks a frame as being answered, so its age counts while no answer has arrived.
+
+        Args:
+            received_at: time.time() the frame was received.
+
+        Returns:
+            A token for record().
+        """
+        with self._lock:
+            token = next(self._tokens)
+            self._inflight[token] = received_at
+            return token
+
+    def record(self, token, finished_at=None):
+        """
+        Records the receive-to-answer latency of a frame started with begin().
+
+        Args:
+            token: The token begin() returned.
+            finished_at: time.time() the answer was generated, or None if inference failed.
+        """
+        with self._lock:
+            received_at = self._inflight.pop(token, None)
+            if received_at is not None and finished_at is not None:
+                self._latencies.append(finished_at - received_at)
+
+    def update(self):
+        """
+        Adjusts the tier if an interval has passed since the last adjustment.
+
+        Returns:
+            A description of the change if the tier changed, else None.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start < self.interval:
+                return None
+            wall_now = time.time()
+            latency_p90 = percentile(self._latencies + [wall_now - t for t in self._inflight.values()], 90)
+            self._window_start, self._latencies = now, []
+            self.last_latency_p90 = latency_p90
+        return self._adjust(latency_p90, self.backlog())
+
+    def start(self, on_change=None):
+        """
+        Starts adjusting the tier every interval on a background thread.
+
+        Args:
+            on_change: Called with the description of each tier change.
+        """
+        def run():
+            while not self._stop.wait(self.interval):
+                change = self.update()
+                if change is not None and on_change is not None:
+                    on_change(change)
+
+        with self._lock:
+            self._window_start = time.monotonic()
+        self._thread = threading.Thread(target=run, name="llm-load-controller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the adjustment thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _adjust(self, latency_p90, backlog):
+        with self._lock:
+            before = self._level
+            if latency_p90 > self.latency_budget or backlog > self.max_backlog:
+                self._good_intervals = 0
+                if self._level < len(self.tiers) - 1:
+                    self._level += 1
+                    self.steps_down += 1
+                    LOAD_TIER_CHANGES.inc(direction="down")
+            elif latency_p90 < self.latency_budget * 0.6 and backlog == 0:
+                self._good_intervals += 1
+                if self._good_intervals >= self.raise_after and self._level > 0:
+                    self._good_intervals = 0
+                    self._level -= 1
+                    self.steps_up += 1
+                    LOAD_TIER_CHANGES.inc(direction="up")
+            else:
+                self._good_intervals = 0
+
+            if self._level == before:
+                return None
+            LOAD_TIER.set(self._level)
+            tier = self.tiers[self._level]
+            return (f"tier {before} -> {self._level} ({tier.max_tokens} tokens, {tier.prompt} prompt, "
+                    f"1/{tier.skip} frames, {'fallback' if tier.fallback else 'primary'} model): "
+                    f"p90 {latency_p90:.2f}s vs budget {self.latency_budget:.2f}s, backlog {backlog}")
+
+    def stats(self):
+        """Returns the current tier and the figures of the last interval."""
+        tier = self.tier()
+        return {
+            "tier": tier.level,
+            "max_tokens": tier.max_tokens,
+            "prompt": tier.prompt,
+            "skip": tier.skip,
+            "fallback": tier.fallback,
+            "latency_p90": round(self.last_latency_p90, 3),
+            "budget": self.latency_budget,
+            "shed": self.shed,
+            "steps_down": self.steps_down,
+            "steps_up": self.steps_up,
+        }
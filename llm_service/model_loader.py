@@ -0,0 +1,189 @@
+# llm_service/model_loader.py
+#
+# Timed model loading: memory-map, lock, warm up.
+#
+# With use_mmap the GGUF weights are mapped rather than read, so constructing the
+# model only costs the tensor setup; pages are read from disk when first touched.
+# Locking is done as a separate step: the file mapping is found in /proc/self/maps
+# and mlock()ed, which reads it in once and keeps it resident. That way the time
+# spent on the page-in shows up on its own in the load-time breakdown instead of
+# being hidden inside the constructor. Where that is not possible (no /proc, or
+# mmap disabled), use_mlock is passed to llama.cpp as before.
+#
+# The warm-up runs a short dummy generation so the first real frame does not pay
+# for cold caches and lazily initialised buffers.
+#
+# prepare_model() runs the whole sequence; the service uses it for its own model and
+# every worker process of the process pool uses it for its copy. With use_mmap the
+# copies share one set of weight pages in the page cache. For a vision model the CLIP
+# projector is loaded first and handed to the model as its chat handler (vision.py).
+
+import ctypes
+import os
+import time
+
+import llama_cpp
+from llama_cpp import Llama
+
+from prefix_cache import PrefixCache
+from vision import create_chat_handler
+
+
+def _model_mappings(model_path):
+    """Returns the (start, length) address ranges the model file is mapped at."""
+    real_path = os.path.realpath(model_path)
+    ranges = []
+    with open("/proc/self/maps") as f:
+        for line in f:
+            parts = line.split(maxsplit=5)
+            if len(parts) == 6 and parts[5].strip() == real_path:
+                start, end = (int(address, 16) for address in parts[0].split("-"))
+                ranges.append((start, end - start))
+    return ranges
+
+
+def lock_model_pages(model_path):
+    """
+    mlock()s the memory mapping of the model file.
+
+    Returns:
+        (locked bytes, error message or None).
+    """
+    try:
+        ranges = _model_mappings(model_path)
+    except OSError as e:
+        return 0, f"cannot read /proc/self/maps: {e}"
+    if not ranges:
+        return 0, "model file mapping not found"
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    locked = 0
+    for start, length in ranges:
+        if libc.mlock(ctypes.c_void_p(start), ctypes.c_size_t(length)) != 0:
+            errno = ctypes.get_errno()
+            return locked, (f"mlock failed: {os.strerror(errno)} "
+                            f"(raise the memlock limit, e.g. ulimit -l unlimited)")
+        locked += length
+    return locked, None
+
+
+def load_model(model_path, n_ctx, n_threads, use_mmap=True, use_mlock=True, chat_handler=None):
+    """
+    Loads the model and locks its weights in memory.
+
+    Args:
+        model_path: The GGUF file.
+        n_ctx: Context size.
+        n_threads: Threads used for generation.
+        use_mmap: Memory-map the weights instead of reading them.
+        use_mlock: Keep the weights resident in RAM.
+        chat_handler: Optional llama_cpp chat handler, e.g. a vision handler with a CLIP projector.
+
+    Returns:
+        (llm, timings), where timings has "mmap_seconds", "mlock_seconds", "mlock" (how
+        locking was done or why it failed) and "locked_bytes".
+    """
+    # Locking the mapping ourselves needs a file mapping and Linux' /proc
+    lock_separately = use_mlock and use_mmap and os.path.exists("/proc/self/maps")
+
+    start = time.perf_counter()
+    llm = Llama(
+        model_path=model_path,
+        n_ctx=n_ctx,
+        n_threads=n_threads,
+        # n_gpu_layers=LLM_GPU_LAYERS, # Uncomment if using GPU offloading
+        use_mmap=use_mmap,
+        use_mlock=use_mlock and not lock_separately,
+        chat_handler=chat_handler,
+        verbose=False # Reduce verbosity from llama_cpp during inference
+    )
+    timings = {"mmap_seconds": round(time.perf_counter() - start, 3), "mlock_seconds": 0.0, "locked_bytes": 0}
+
+    if not use_mlock:
+        timings["mlock"] = "off"
+    elif not lock_separately:
+        timings["mlock"] = "llama.cpp (included in load)"
+    else:
+        start = time.perf_counter()
+        locked, error = lock_model_pages(model_path)
+        timings["mlock_seconds"] = round(time.perf_counter() - start, 3)
+        timings["locked_bytes"] = locked
+        timings["mlock"] = error or "locked"
+        if error:
+            print(f"⚠️ Could not lock the model in memory: {error}")
+    return llm, timings
+
+
+def warm_up(llm, prompt="Hello", n_tokens=1):
+    """
+    Runs a short dummy generation.
+
+    Returns:
+        Seconds until the first token was generated.
+    """
+    start = time.perf_counter()
+    first_token_seconds = None
+    for _ in llm(prompt=prompt, max_tokens=n_tokens, echo=False, stream=True):
+        if first_token_seconds is None:
+            first_token_seconds = time.perf_counter() - start
+    return round(first_token_seconds if first_token_seconds is not None else time.perf_counter() - start, 3)
+
+
+def prepare_model(model_path, n_ctx, n_threads, use_mmap=True, use_mlock=True, warmup_tokens=1,
+                  prefix="", prefix_cache=True, prefix_state_path=None, vision=None):
+    """
+    Loads the model and prepares it for the first request: memory-map and lock the
+    weights, run a warm-up generation and evaluate (or load) the prompt prefix state.
+
+    Args:
+        model_path, n_ctx, n_threads, use_mmap, use_mlock: See load_model().
+        warmup_tokens: Tokens generated by the warm-up; 0 skips it.
+        prefix: The fixed prompt prefix.
+        prefix_cache: Keep the KV state of the prefix (see prefix_cache.py).
+        prefix_state_path: Snapshot file for the prefix state, or None.
+        vision: Keyword arguments for vision.create_chat_handler(), or None for a text-only model.
+
+    Returns:
+        (llm, prefix cache or None, breakdown of the seconds each step took).
+    """
+    chat_handler = None
+    clip_seconds = None
+    if vision:
+        print(f"Loading CLIP projector from {vision['clip_model_path']}...")
+        start = time.perf_counter()
+        chat_handler = create_chat_handler(**vision)
+        clip_seconds = round(time.perf_counter() - start, 3)
+        print(f"🖼️ CLIP projector loaded in {clip_seconds:.2f}s ({vision.get('chat_format', 'llava-1-5')}).")
+
+    print(f"Loading LLM model from {model_path}...")
+    llm, breakdown = load_model(model_path, n_ctx, n_threads, use_mmap=use_mmap, use_mlock=use_mlock,
+                                chat_handler=chat_handler)
+    if clip_seconds is not None:
+        breakdown["clip_seconds"] = clip_seconds
+    print(f"LLM model loaded successfully (mmap {breakdown['mmap_seconds']:.2f}s, "
+          f"mlock {breakdown['mlock_seconds']:.2f}s: {breakdown['mlock']}).")
+
+    if warmup_tokens > 0:
+        breakdown["first_token_seconds"] = warm_up(llm, n_tokens=warmup_tokens)
+        print(f"🔥 Warm-up generation: first token after {breakdown['first_token_seconds']:.2f}s")
+
+    cache = None
+    if prefix_cache:
+        start = time.perf_counter()
+        try:
+            cache = PrefixCache(
+                llm,
+                prefix,
+                snapshot_path=prefix_state_path or None,
+                model_path=model_path,
+                n_ctx=n_ctx,
+                library_version=getattr(llama_cpp, "__version__", ""),
+            )
+            cache.prepare()
+            breakdown["prefix_source"] = cache.source
+        except Exception as e:
+            print(f"⚠️ Prompt prefix caching disabled: {e}")
+            cache = None
+        breakdown["prefix_seconds"] = round(time.perf_counter() - start, 3)
+    return llm, cache, breakdown
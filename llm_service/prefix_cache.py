@@ -0,0 +1,209 @@
+# llm_service/prefix_cache.py
+#
+# Reuse of the evaluated KV state of the fixed prompt prefix.
+#
+# Every prompt starts with the same instruction prefix (see prompts.py). The prefix is
+# evaluated once and its llama.cpp state is kept; each request sends
+# prefix tokens + detection tokens, and llama-cpp-python's prefix matching then only
+# evaluates the tokens after the part already in the KV cache. If something else has
+# replaced the context in the meantime, the saved prefix state is loaded back first.
+#
+# The state is also snapshotted to disk, so a restart can load it instead of
+# evaluating the prefix again. The snapshot is only used if the model file, context
+# size, prefix text and llama-cpp-python version all match.
+#
+# Snapshot layout: a magic line, one line of JSON header (validity key, prefix tokens,
+# size and SHA-256 of the state), then the raw llama.cpp context state. Nothing in the
+# file is executed or unpickled; the header is checked before the state is loaded.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import llama_cpp
+import numpy as np
+
+SNAPSHOT_MAGIC = b"LLM-PREFIX-STATE 1\n"
+MAX_HEADER_BYTES = 1 << 20
+
+
+class PrefixCache:
+    """Keeps the KV state of a fixed prompt prefix for a Llama instance."""
+
+    def __init__(self, llm, prefix, snapshot_path=None, model_path=None, n_ctx=0, library_version=""):
+        """
+        Args:
+            llm: The llama_cpp.Llama instance (callers serialise access to it).
+            prefix: The fixed prompt prefix text.
+            snapshot_path: Optional file the prefix state is saved to and loaded from.
+            model_path: Model file, part of the snapshot's validity key.
+            n_ctx: Context size, part of the snapshot's validity key.
+            library_version: llama-cpp-python version, part of the snapshot's validity key.
+        """
+        self.llm = llm
+        self.prefix = prefix
+        self.snapshot_path = snapshot_path
+        self.key = self._snapshot_key(model_path, n_ctx, library_version)
+
+        self.prefix_tokens = []
+        self.state = None
+        self.prefix_eval_seconds = 0.0  # Cost of evaluating the prefix from scratch
+        self.source = None  # "snapshot" or "evaluated"
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.restores = 0
+        self.reused_tokens = 0
+        self.saved_seconds = 0.0
+
+    def _snapshot_key(self, model_path, n_ctx, library_version):
+        model_stat = os.stat(model_path) if model_path and os.path.exists(model_path) else None
+        return {
+            "model_path": model_path,
+            "model_size": model_stat.st_size if model_stat else None,
+            "model_mtime": int(model_stat.st_mtime) if model_stat else None,
+            "n_ctx": n_ctx,
+            "prefix_sha256": hashlib.sha256(self.prefix.encode("utf-8")).hexdigest(),
+            "library_version": library_version,
+        }
+
+    # --- Setup ---
+
+    def prepare(self):
+        """Loads the prefix state from the snapshot, or evaluates the prefix and saves one."""
+        self.prefix_tokens = self.llm.tokenize(self.prefix.encode("utf-8"), add_bos=True, special=True)
+        if self._load_snapshot():
+            self.source = "snapshot"
+            print(f"♻️ Loaded prompt prefix state ({len(self.prefix_tokens)} tokens) from {self.snapshot_path}")
+            return
+
+        self.llm.reset()
+        start = time.perf_counter()
+        self.llm.eval(self.prefix_tokens)
+        self.prefix_eval_seconds = time.perf_counter() - start
+        self.state = self.llm.save_state()
+        self.source = "evaluated"
+        print(f"♻️ Evaluated prompt prefix ({len(self.prefix_tokens)} tokens) in "
+              f"{self.prefix_eval_seconds * 1000:.0f} ms")
+        self._save_snapshot()
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                if f.readline(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    raise ValueError("not a prompt prefix snapshot")
+                header = json.loads(f.readline(MAX_HEADER_BYTES))
+                if header.get("key") != self.key or header.get("prefix_tokens") != list(self.prefix_tokens):
+                    print("⚠️ Prompt prefix snapshot is for a different model or prefix, re-evaluating.")
+                    return False
+                llama_state = f.read(int(header["state_size"]) + 1)
+            if len(llama_state) != header["state_size"]:
+                raise ValueError("state size does not match the header")
+            if hashlib.sha256(llama_state).hexdigest() != header["state_sha256"]:
+                raise ValueError("state checksum does not match the header")
+            state = self._prefix_state(llama_state, int(header.get("seed", 0)))
+            self.llm.load_state(state)
+            prefix_eval_seconds = float(header["prefix_eval_seconds"])
+        except Exception as e:
+            print(f"⚠️ Could not load prompt prefix snapshot {self.snapshot_path}: {e}")
+            return False
+        self.state = state
+        self.prefix_eval_seconds = prefix_eval_seconds
+        return True
+
+    def _prefix_state(self, llama_state, seed):
+        """Rebuilds the LlamaState of the evaluated prefix around a raw llama.cpp context state."""
+        n_prefix = len(self.prefix_tokens)
+        input_ids = self.llm.input_ids.copy()
+        input_ids[:n_prefix] = self.prefix_tokens
+        # Logits of the prefix positions are not kept: every request evaluates at least its last token
+        scores = np.zeros_like(self.llm.scores[:n_prefix])
+        return llama_cpp.LlamaState(input_ids=input_ids, scores=scores, n_tokens=n_prefix, llama_state=llama_state,
+                                    llama_state_size=len(llama_state), seed=seed)
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        llama_state = bytes(self.state.llama_state)
+        header = {
+            "key": self.key,
+            "prefix_tokens": [int(token) for token in self.prefix_tokens],
+            "prefix_eval_seconds": self.prefix_eval_seconds,
+            "seed": int(self.state.seed),
+            "state_size": len(llama_state),
+            "state_sha256": hashlib.sha256(llama_state).hexdigest(),
+        }
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"  # Pool workers may save at the same time
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(llama_state)
+            os.replace(tmp_path, self.snapshot_path)  # Atomic, so a crash never leaves a torn file
+            print(f"💾 Saved prompt prefix state to {self.snapshot_path}")
+        except OSError as e:
+            print(f"⚠️ Could not save prompt prefix snapshot to {self.snapshot_path}: {e}")
+
+    # --- Per request ---
+
+    def prompt_tokens(self, dynamic_text):
+        """
+        Returns the prompt as tokens: the cached prefix tokens plus the tokenized dynamic part.
+
+        Tokenizing the parts separately keeps the prefix tokens identical in every prompt,
+        so llama.cpp's prefix match always covers the whole prefix.
+        """
+        return list(self.prefix_tokens) + self.llm.tokenize(dynamic_text.encode("utf-8"), add_bos=False, special=True)
+
+    def prepare_request(self, tokens):
+        """
+        Makes sure the context starts with the prefix state before `tokens` are generated from.
+        Must be called with the Llama instance locked.
+
+        Returns:
+            The estimated prompt-eval seconds saved for this request.
+        """
+        if self.state is None:
+            return 0.0
+        n_prefix = len(self.prefix_tokens)
+        current = self.llm.input_ids[:self.llm.n_tokens]
+        if self.llm.n_tokens < n_prefix or list(current[:n_prefix]) != list(self.prefix_tokens):
+            self.llm.load_state(self.state)
+            with self._lock:
+                self.restores += 1
+            current = self.llm.input_ids[:self.llm.n_tokens]
+
+        # Same prefix match llama-cpp-python performs (the last prompt token is always evaluated)
+        reused = 0
+        for cached, wanted in zip(current, tokens[:-1]):
+            if cached != wanted:
+                break
+            reused += 1
+
+        per_token = self.prefix_eval_seconds / n_prefix if n_prefix else 0.0
+        saved = reused * per_token
+        with self._lock:
+            self.requests += 1
+            self.reused_tokens += reused
+            self.saved_seconds += saved
+        return saved
+
+    def stats(self):
+        """Returns prefix size, where the state came from, and prompt-eval time saved."""
+        with self._lock:
+            requests = self.requests
+            return {
+                "prefix_tokens": len(self.prefix_tokens),
+                "prefix_eval_ms": round(self.prefix_eval_seconds * 1000, 1),
+                "source": self.source,
+                "requests": requests,
+                "restores": self.restores,
+                "avg_reused_tokens": round(self.reused_tokens / requests, 1) if requests else 0.0,
+                "saved_ms_per_request": round(self.saved_seconds * 1000 / requests, 1) if requests else 0.0,
+                "saved_ms_total": round(self.saved_seconds * 1000, 1),
+            }
@@ -0,0 +1,280 @@
+# llm_service/process_pool.py
+#
+# Pool of worker processes, each running its own copy of the model (LLM_PROCESSES > 0).
+#
+# A single Llama instance only runs one completion at a time. On machines with many
+# cores, several processes with a few threads each can get more short completions
+# through than one process using all the threads. Every worker loads the same GGUF
+# with mmap, so the weights are read from disk once and their pages are shared
+# through the page cache; only the KV cache and scratch buffers are per process.
+#
+# The dispatcher hands each request to an idle worker over a pipe. Streamed tokens
+# come back over the same pipe, so partial results are still published by the
+# service. A worker that dies is restarted in the background, with a growing delay
+# if it keeps failing, and the request it was running fails with an error.
+#
+# Workers are started with "spawn", not "fork", because the service already runs the
+# MQTT and queue threads when a crashed worker has to be replaced.
+
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+from completion import complete
+from model_loader import prepare_model
+
+MAX_RESTART_DELAY = 60.0
+
+
+def _worker_main(index, conn, settings):
+    """
+    Entry point of a worker process.
+
+    Messages sent to the parent: ("ready", breakdown), ("failed", error) at startup, then per
+    request any number of ("token", delta) followed by ("done", result) or ("error", message).
+    """
+    # Ctrl+C reaches the whole process group; the service stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        llm, prefix_cache, breakdown = prepare_model(**settings["model"])
+    except Exception as e:
+        conn.send(("failed", str(e)))
+        return
+    conn.send(("ready", breakdown))
+
+    on_token = lambda delta: conn.send(("token", delta))
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break  # The service is gone
+        if request is None:
+            break
+        try:
+            result = complete(
+                llm, request["section"], settings["prefix"], request["stop"], request["max_tokens"],
+                prefix_cache=prefix_cache, on_token=on_token if request["stream"] else None,
+                images=request.get("images", ()),
+            )
+            conn.send(("done", result))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _Worker:
+    """The parent's handle on one worker process."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.busy = False
+        self.requests = 0
+        self.errors = 0
+        self.restarts = 0
+        self.consecutive_failures = 0
+
+
+class ProcessPool:
+    """Dispatches completions to a fixed number of model worker processes."""
+
+    def __init__(self, processes, model_settings, prefix, start_timeout=600.0):
+        """
+        Args:
+            processes: Number of worker processes.
+            model_settings: Keyword arguments for model_loader.prepare_model(); n_threads is
+                the thread count of each worker.
+            prefix: The fixed prompt prefix.
+            start_timeout: Seconds a worker may take to load the model.
+        """
+        self.settings = {"model": model_settings, "prefix": prefix}
+        self.start_timeout = start_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(max(1, processes))]
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    # --- Worker lifecycle ---
+
+    def _spawn(self, worker):
+        """Starts the worker's process and waits until it has loaded the model. Returns its breakdown."""
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(worker.index, child_conn, self.settings),
+            name=f"llm-process-{worker.index}", daemon=True,
+        )
+        process.start()
+        child_conn.close()  # Only the child holds it now, so recv() sees EOF if the child dies
+        worker.process, worker.conn = process, parent_conn
+
+        if not parent_conn.poll(self.start_timeout):
+            process.kill()
+            raise RuntimeError(f"LLM worker {worker.index} did not load the model within {self.start_timeout:.0f}s")
+        try:
+            kind, data = parent_conn.recv()
+        except (EOFError, OSError):
+            raise RuntimeError(f"LLM worker {worker.index} exited while loading the model "
+                               f"(exit code {process.exitcode})") from None
+        if kind != "ready":
+            raise RuntimeError(f"LLM worker {worker.index} failed to load the model: {data}")
+        print(f"⚙️ LLM worker {worker.index} (pid {process.pid}) ready.")
+        return dict(data, pid=process.pid)
+
+    def start(self):
+        """
+        Starts all workers in parallel and waits until they have loaded the model.
+
+        Returns:
+            The load-time breakdown of each worker.
+
+        Raises:
+            RuntimeError: If a worker fails to start.
+        """
+        results = [None] * len(self._workers)
+
+        def spawn(worker):
+            try:
+                results[worker.index] = self._spawn(worker)
+            except Exception as e:
+                results[worker.index] = e
+
+        threads = [threading.Thread(target=spawn, args=(worker,)) for worker in self._workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            self.stop()
+            raise errors[0]
+        for worker in self._workers:
+            self._idle.put(worker)
+        return results
+
+    def _restart_later(self, worker):
+        """Replaces a dead worker process in the background."""
+        def restart():
+            while not self._stopping:
+                delay = min(MAX_RESTART_DELAY, 2.0 ** worker.consecutive_failures)
+                print(f"🔁 Restarting LLM worker {worker.index} in {delay:.0f}s...")
+                time.sleep(delay)
+                try:
+                    self._spawn(worker)
+                except Exception as e:
+                    worker.consecutive_failures += 1
+                    print(f"⚠️ {e}")
+                    continue
+                with self._lock:
+                    worker.restarts += 1
+                worker.consecutive_failures = 0
+                self._idle.put(worker)
+                return
+
+        threading.Thread(target=restart, name=f"llm-restart-{worker.index}", daemon=True).start()
+
+    def _handle_crash(self, worker):
+        with self._lock:
+            worker.busy = False
+            worker.errors += 1
+        worker.consecutive_failures += 1
+        exitcode = worker.process.exitcode if worker.process is not None else None
+        print(f"💥 LLM worker {worker.index} crashed (exit code {exitcode}).")
+        if worker.conn is not None:
+            worker.conn.close()
+        self._restart_later(worker)
+
+    def _acquire(self):
+        """Takes an idle worker, skipping (and restarting) any that died while idle."""
+        while True:
+            worker = self._idle.get()
+            if worker.process.is_alive():
+                with self._lock:
+                    worker.busy = True
+                return worker
+            self._handle_crash(worker)
+
+    # --- Requests ---
+
+    def infer(self, section, stop_sequences, max_tokens, on_token=None, images=()):
+        """
+        Runs a completion on the next idle worker, waiting for one if all are busy.
+
+        Args:
+            section: The prompt text after the prefix.
+            stop_sequences: Stop sequences for the completion.
+            max_tokens: Maximum tokens to generate.
+            on_token: Optional callable invoked as on_token(delta) for every streamed token.
+            images: JPEG images shown to the model (vision models only).
+
+        Returns:
+            The result dict of completion.complete().
+
+        Raises:
+            RuntimeError: If the completion failed or the worker crashed while running it.
+        """
+        worker = self._acquire()
+        try:
+            worker.conn.send({"section": section, "stop": stop_sequences, "max_tokens": max_tokens,
+                              "stream": on_token is not None, "images": list(images)})
+            while True:
+                kind, data = worker.conn.recv()
+                if kind == "token":
+                    on_token(data)
+                    continue
+                with self._lock:
+                    worker.busy = False
+                    worker.requests += 1
+                    if kind == "error":
+                        worker.errors += 1
+                self._idle.put(worker)
+                if kind == "error":
+                    raise RuntimeError(f"LLM worker {worker.index}: {data}")
+                worker.consecutive_failures = 0
+                return data
+        except (EOFError, OSError, BrokenPipeError):
+            self._handle_crash(worker)
+            raise RuntimeError(f"LLM worker {worker.index} crashed during inference") from None
+
+    def stop(self, timeout=5.0):
+        """Asks the workers to exit and waits for them, killing any that do not."""
+        self._stopping = True
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+    def stats(self):
+        """Returns per-worker state and request counts."""
+        with self._lock:
+            workers = [
+                {
+                    "index": worker.index,
+                    "pid": worker.process.pid if worker.process is not None else None,
+                    "alive": worker.process is not None and worker.process.is_alive(),
+                    "busy": worker.busy,
+                    "requests": worker.requests,
+                    "errors": worker.errors,
+                    "restarts": worker.restarts,
+                }
+                for worker in self._workers
+            ]
+        return {
+            "processes": len(workers),
+            "busy": sum(worker["busy"] for worker in workers),
+            "alive": sum(worker["alive"] for worker in workers),
+            "requests": sum(worker["requests"] for worker in workers),
+            "restarts": sum(worker["restarts"] for worker in workers),
+            "workers": workers,
+        }
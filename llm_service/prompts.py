@@ -0,0 +1,182 @@
+# llm_service/prompts.py
+#
+# Builds LLM prompts from the detection metadata the camera service publishes
+# with each frame.
+#
+# Positions and sizes are described coarsely (left/centre/right, small/medium/large)
+# rather than in pixels, so that small jitter between frames renders the same prompt
+# and the result cache can answer it.
+#
+# Every prompt is a fixed instruction prefix followed by a short dynamic section
+# describing the detections. The prefix never changes, so its evaluated KV state can
+# be reused across requests (see prefix_cache.py).
+
+import re
+
+# "3. text" or "3) text" at the start of a line of a batched answer
+_NUMBERED_LINE = re.compile(r"^\s*(\d+)\s*[.):]\s*(.*)$")
+
+# Fixed start of every prompt; keep it free of per-frame details
+PROMPT_PREFIX = (
+    "You describe scenes from a security camera. A face detector reports the faces it found "
+    "in each frame. Answer the question with general observations or insights about the scene "
+    "in one or two short sentences.\n"
+)
+
+# Used when a frame carries no detection metadata (e.g. an old camera publisher)
+GENERIC_PROMPT = "A faces were detected in an image. What general observations or insights can you provide about a face in the image?"
+
+
+def describe_box(box, width, height):
+    """
+    Describes a face box in words.
+
+    Args:
+        box: (x, y, w, h) in pixels.
+        width: Frame width in pixels.
+        height: Frame height in pixels.
+
+    Returns:
+        A short phrase such as "a large face on the left".
+    """
+    x, y, w, h = box
+    centre_x = (x + w / 2) / width if width else 0.5
+    horizontal = "left" if centre_x < 1 / 3 else "right" if centre_x > 2 / 3 else "centre"
+
+    area_ratio = (w * h) / (width * height) if width and height else 0.0
+    size = "large" if area_ratio > 0.1 else "medium" if area_ratio > 0.02 else "small"
+    return f"a {size} face on the {horizontal}"
+
+
+def describe_detections(boxes, width, height):
+    """Returns a one-sentence summary of the detected faces."""
+    if not boxes:
+        return "No faces were detected in the camera image."
+    count = len(boxes)
+    noun = "face was" if count == 1 else "faces were"
+    # Left-to-right so the same scene always renders the same text
+    parts = [describe_box(box, width, height) for box in sorted(boxes, key=lambda b: b[0])]
+    return f"{count} {noun} detected in the camera image: {', '.join(parts)}."
+
+
+def build_detection_section(frame):
+    """
+    Builds the dynamic part of the prompt for a decoded frame.
+
+    Args:
+        frame: A shared.frame_codec.Frame.
+
+    Returns:
+        The text that follows PROMPT_PREFIX, ending where the answer starts.
+    """
+    if not has_detections(frame):
+        return f"Q: {GENERIC_PROMPT}\nA:"
+
+    summary = describe_detections(frame.boxes, frame.meta.get("width", 0), frame.meta.get("height", 0))
+    if not frame.boxes:
+        question = "What might the empty scene indicate?"
+    else:
+        question = "What general observations or insights can you provide about the scene?"
+    return f"Detections: {summary}\nQ: {question}\nA:"
+
+
+def build_short_section(frame):
+    """
+    Builds a compact dynamic part of the prompt, used while shedding load.
+
+    Args:
+        frame: A shared.frame_codec.Frame.
+
+    Returns:
+        The text that follows PROMPT_PREFIX, ending where the answer starts.
+    """
+    faces = len(frame.boxes) if has_detections(frame) else "some"
+    return f"Faces: {faces}.\nQ: Describe the scene in one short sentence.\nA:"
+
+
+def build_vision_section(frame, images):
+    """
+    Builds the dynamic part of the prompt when face crops are shown to a vision model.
+
+    Args:
+        frame: A shared.frame_codec.Frame.
+        images: Number of face crops attached, largest faces first.
+
+    Returns:
+        The text following the images. The chat format adds the answer marker itself.
+    """
+    summary = describe_detections(frame.boxes, frame.meta.get("width", 0), frame.meta.get("height", 0))
+    if images == 1:
+        shown = "The attached image shows the largest face."
+    else:
+        shown = f"The attached images show the {images} largest faces, largest first."
+    return (f"Detections: {summary} {shown}\n"
+            f"Q: What general observations or insights can you provide about the people and the scene?")
+
+
+def build_prompt(frame, prefix=PROMPT_PREFIX):
+    """
+    Builds the full LLM prompt for a decoded frame.
+
+    Args:
+        frame: A shared.frame_codec.Frame.
+        prefix: The fixed prompt prefix.
+
+    Returns:
+        The prompt text.
+    """
+    return prefix + build_detection_section(frame)
+
+
+def has_detections(frame):
+    """True if the frame carries detection metadata from the camera service."""
+    return "faces" in frame.meta
+
+
+def build_batch_section(frames):
+    """
+    Builds the dynamic part of a prompt describing several frames at once.
+
+    Each frame is numbered; the model is asked to answer with one numbered line per
+    frame so that split_batch_response() can hand each answer back to its frame.
+
+    Args:
+        frames: The shared.frame_codec.Frame objects, in answer order.
+
+    Returns:
+        The text that follows PROMPT_PREFIX, ending where the first answer starts.
+    """
+    lines = ["Several camera frames arrived at once. Answer for each frame on its own numbered line."]
+    for number, frame in enumerate(frames, start=1):
+        camera = frame.camera_id or "default"
+        if has_detections(frame):
+            summary = describe_detections(frame.boxes, frame.meta.get("width", 0), frame.meta.get("height", 0))
+        else:
+            summary = "A face was detected in the camera image."
+        lines.append(f"{number}. Camera {camera}: {summary}")
+    lines.append("Q: What general observations or insights can you provide about each scene?")
+    lines.append("A:\n1.")
+    return "\n".join(lines)
+
+
+def split_batch_response(text, count):
+    """
+    Splits a numbered multi-frame answer back into per-frame answers.
+
+    Args:
+        text: The completion of a build_batch_section() prompt (it starts after "1.").
+        count: Number of frames in the batch.
+
+    Returns:
+        A list of `count` answers; an entry is None if the model gave no answer for that frame.
+    """
+    answers = [None] * count
+    number = 1  # The prompt already wrote "1." for the first answer
+    for line in ("1. " + text.lstrip()).splitlines():
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            number, line = int(match.group(1)), match.group(2)
+        line = line.strip()
+        if 1 <= number <= count and line and answers[number - 1] is None:
+            answers[number - 1] = line
+    return answers
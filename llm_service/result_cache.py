@@ -0,0 +1,124 @@
+# llm_service/result_cache.py
+#
+# LRU + TTL cache of LLM completions, keyed on the rendered prompt and the
+# generation parameters. Optionally backed by a JSON file so a container
+# restart does not start with an empty cache.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(prompt, **params):
+    """
+    Builds a cache key from the rendered prompt and the generation parameters.
+
+    Args:
+        prompt: The exact prompt text sent to the model.
+        **params: Generation parameters that change the output (max_tokens, stop, ...).
+
+    Returns:
+        A hex digest string.
+    """
+    material = json.dumps({"prompt": prompt, "params": params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Thread-safe LRU cache with a per-entry time-to-live."""
+
+    def __init__(self, max_entries=256, ttl=600.0, path=None):
+        """
+        Args:
+            max_entries: Maximum number of cached completions; least recently used are evicted.
+            ttl: Seconds an entry stays valid. 0 or less disables expiry.
+            path: Optional JSON file used to persist the cache across restarts.
+        """
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.path = path
+
+        self._entries = OrderedDict()  # key -> (value, created_at wall-clock seconds)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+        if self.path:
+            self._load()
+
+    def _is_fresh(self, created_at, now):
+        return self.ttl <= 0 or now - created_at < self.ttl
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry[1], now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            if self.path:
+                self._save()
+
+    def stats(self):
+        """Returns cache size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+    # --- Persistence (called with the lock held) ---
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump([[k, v, t] for k, (v, t) in self._entries.items()], f)
+            os.replace(tmp_path, self.path)  # Atomic, so a crash never leaves a torn file
+        except OSError as e:
+            print(f"⚠️ Failed to persist LLM result cache to {self.path}: {e}")
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Ignoring unreadable LLM result cache at {self.path}: {e}")
+            return
+
+        now = time.time()
+        for key, value, created_at in rows[-self.max_entries:]:
+            if self._is_fresh(created_at, now):
+                self._entries[key] = (value, created_at)
+        print(f"Loaded {len(self._entries)} cached LLM results from {self.path}.")
@@ -0,0 +1,157 @@
+# llm_service/vision.py
+#
+# Image input for vision-capable models (LLaVA-style: a GGUF language model plus a
+# CLIP projector, the "mmproj" file).
+#
+# The model is shown the face crops the camera service attaches to each frame, not
+# the full frame. Every image costs a fixed block of context positions (576 for
+# LLaVA 1.5 at 336x336), so the crop budget bounds the prompt length. Crops are
+# downscaled to the projector's input size before embedding; larger images would only
+# be resized by CLIP again, and llava-1-6 style projectors would split them into
+# several tiles of tokens.
+#
+# Embedding an image runs the CLIP encoder, which on a CPU takes longer than
+# evaluating the text prompt. The chat handler therefore keeps an LRU cache of
+# embeddings keyed on the crop bytes, so a face that is still in the same place
+# (the camera re-encodes an identical crop) is embedded only once.
+
+import ctypes
+import hashlib
+import time
+from collections import OrderedDict
+
+from llama_cpp import llama_chat_format
+
+try:
+    import cv2  # Optional: without it, crops are handed to the projector at their original size
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+# LLM_VISION_CHAT_FORMAT -> chat handler class in llama_cpp.llama_chat_format
+CHAT_HANDLERS = {
+    "llava-1-5": "Llava15ChatHandler",
+    "llava-1-6": "Llava16ChatHandler",
+    "moondream": "MoondreamChatHandler",
+    "nanollava": "NanoLlavaChatHandler",
+    "obsidian": "ObsidianChatHandler",
+    "llama-3-vision-alpha": "Llama3VisionAlphaChatHandler",
+    "minicpm-v-2.6": "MiniCPMv26ChatHandler",
+}
+
+CROP_JPEG_QUALITY = 90
+
+
+def fit_image(data, size, quality=CROP_JPEG_QUALITY):
+    """
+    Downscales a JPEG so its longest side is at most `size` pixels.
+
+    Returns:
+        The re-encoded JPEG, or `data` unchanged if it already fits, cannot be decoded
+        or OpenCV is not installed.
+    """
+    if cv2 is None or size <= 0:
+        return data
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return data
+    height, width = image.shape[:2]
+    longest = max(height, width)
+    if longest <= size:
+        return data
+    scale = size / longest
+    image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if success else data
+
+
+def image_digest(data):
+    """Identifies an image by its bytes, for the embedding and result caches."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class _EmbeddingCache:
+    """
+    Mixed into a llama_cpp LLaVA chat handler: downscales images and keeps their
+    embeddings in an LRU cache. The handler itself only remembers the last image.
+    """
+
+    def __init__(self, clip_model_path, verbose=False, image_size=336, cache_size=32):
+        super().__init__(clip_model_path=clip_model_path, verbose=verbose)
+        self.image_size = image_size
+        self.cache_size = max(1, cache_size)  # The embedding being evaluated must stay alive
+        self._embeds = OrderedDict()  # digest -> llava_image_embed pointer
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.embed_seconds = 0.0
+        self._exit_stack.callback(self._free_all)
+
+    def _embed_image_bytes(self, image_bytes, n_threads_batch=1):
+        key = image_digest(image_bytes)
+        embed = self._embeds.get(key)
+        if embed is not None:
+            self._embeds.move_to_end(key)
+            self.hits += 1
+            return embed
+
+        start = time.perf_counter()
+        data = fit_image(image_bytes, self.image_size)
+        with llama_chat_format.suppress_stdout_stderr(disable=self.verbose):
+            embed = self._llava_cpp.llava_image_embed_make_with_bytes(
+                self.clip_ctx, n_threads_batch, (ctypes.c_uint8 * len(data)).from_buffer(bytearray(data)), len(data),
+            )
+        if not embed:
+            raise ValueError("The CLIP projector could not embed the image")
+        self.embed_seconds += time.perf_counter() - start
+        self.misses += 1
+
+        self._embeds[key] = embed
+        while len(self._embeds) > self.cache_size:
+            # Evicted embeddings were already evaluated into the context, so they can go
+            _, old = self._embeds.popitem(last=False)
+            self._llava_cpp.llava_image_embed_free(old)
+            self.evicted += 1
+        return embed
+
+    def _free_all(self):
+        while self._embeds:
+            _, embed = self._embeds.popitem()
+            self._llava_cpp.llava_image_embed_free(embed)
+
+    def stats(self):
+        """Returns the embedding cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._embeds),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evicted": self.evicted,
+            "embed_seconds": round(self.embed_seconds, 3),
+        }
+
+
+def create_chat_handler(clip_model_path, chat_format="llava-1-5", image_size=336, cache_size=32):
+    """
+    Loads the CLIP projector into a chat handler that caches image embeddings.
+
+    Args:
+        clip_model_path: The projector GGUF (mmproj) matching the language model.
+        chat_format: A key of CHAT_HANDLERS.
+        image_size: Longest side, in pixels, images are downscaled to before embedding.
+        cache_size: Embeddings kept for repeated images.
+
+    Returns:
+        The chat handler, to be passed to Llama(chat_handler=...).
+
+    Raises:
+        ValueError: If the chat format is unknown or the projector cannot be loaded.
+    """
+    name = CHAT_HANDLERS.get(chat_format)
+    base = getattr(llama_chat_format, name, None) if name else None
+    if base is None:
+        raise ValueError(f"Unknown vision chat format '{chat_format}', expected one of {', '.join(CHAT_HANDLERS)}")
+    handler_class = type(f"Caching{base.__name__}", (_EmbeddingCache, base), {})
+    return handler_class(clip_model_path, image_size=image_size, cache_size=cache_size)
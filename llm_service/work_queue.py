@@ -0,0 +1,237 @@
+# llm_service/work_queue.py
+#
+# Bounded work queue drained by worker threads.
+#
+# The paho network thread only calls put() and returns straight away, so keepalives
+# and incoming messages keep flowing while inference runs on the workers.
+#
+# Items are queued per key (camera) and served round-robin across keys, so one busy
+# camera can neither starve the others nor push their frames out of the queue.
+#
+# With a batch handler, a worker takes up to batch_size pending items at once. It waits
+# up to batch_window seconds for more to arrive; with the default window of 0 it only
+# takes what is already queued, so a lone item is never delayed.
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+from shared.stats import percentile
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+class WorkQueue:
+    """
+    A bounded queue of (key, item) pairs processed by one or more worker threads.
+
+    Each key has its own queue of at most `maxsize` items; workers take items from the
+    keys in round-robin order. Overflow policies, applied per key:
+        drop_oldest: When full, discard the key's oldest pending item to make room.
+        drop_newest: When full, discard the incoming item.
+        coalesce:    Keep only the newest pending item per key, replacing the previous one.
+    """
+
+    def __init__(self, handler, maxsize=4, policy=DROP_OLDEST, workers=1, name="work", latency_window=200,
+                 batch_handler=None, batch_size=1, batch_window=0.0):
+        """
+        Args:
+            handler: Callable invoked as handler(item) on a worker thread.
+            maxsize: Maximum number of pending items per key.
+            policy: One of OVERFLOW_POLICIES.
+            workers: Number of worker threads.
+            name: Name used for the worker threads and in log output.
+            latency_window: Number of recent requests kept for latency percentiles.
+            batch_handler: Optional callable invoked as batch_handler([item, ...]) instead of
+                handler when batch_size > 1.
+            batch_size: Maximum number of items passed to batch_handler at once.
+            batch_window: Seconds a worker waits for more items to fill a batch.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}', expected one of {OVERFLOW_POLICIES}")
+        self.handler = handler
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.workers = max(1, workers)
+        self.name = name
+        self.batch_handler = batch_handler if batch_size > 1 else None
+        self.batch_size = max(1, batch_size)
+        self.batch_window = max(0.0, batch_window)
+
+        self._pending = OrderedDict()  # key -> deque of [item, enqueued_at], in round-robin order
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+        # Counters, read via stats()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.coalesced = 0
+        self.busy_workers = 0
+        self.batches = 0
+        self.batched_items = 0
+        self._wait_times = deque(maxlen=latency_window)
+        self._run_times = deque(maxlen=latency_window)
+
+    # --- Producer side ---
+
+    def put(self, key, item):
+        """
+        Enqueues an item without blocking.
+
+        Args:
+            key: Grouping key used by the coalesce policy (e.g. camera id).
+            item: The work item passed to the handler.
+
+        Returns:
+            True if the item was queued (or merged), False if it was dropped.
+        """
+        now = time.monotonic()
+        with self._cond:
+            queue = self._pending.get(key)
+            if queue is None:
+                # New keys join at the back of the round-robin order
+                queue = self._pending[key] = deque()
+
+            if self.policy == COALESCE and queue:
+                # Keep the queue position (and original wait time), take the newer item
+                queue[-1][0] = item
+                self.coalesced += 1
+                return True
+
+            if len(queue) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped_newest += 1
+                    return False
+                queue.popleft()
+                self.dropped_oldest += 1
+
+            queue.append([item, now])
+            self.enqueued += 1
+            self._cond.notify()
+            return True
+
+    def _take(self):
+        """Pops the next item in round-robin key order. Must be called with the lock held."""
+        key, queue = next(iter(self._pending.items()))
+        item, enqueued_at = queue.popleft()
+        if queue:
+            self._pending.move_to_end(key)  # Other keys go first next time
+        else:
+            del self._pending[key]
+        return key, item, enqueued_at
+
+    def depth(self):
+        """Returns the number of pending items across all keys."""
+        with self._cond:
+            return self._depth()
+
+    def _depth(self):
+        return sum(len(queue) for queue in self._pending.values())
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Starts the worker threads."""
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=5.0):
+        """Stops the workers after their current item. Pending items are discarded."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # --- Workers ---
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                batch = [self._take()]
+                if self.batch_handler is not None:
+                    self._fill_batch(batch)
+                self.busy_workers += 1
+
+            started = time.monotonic()
+            ok = True
+            try:
+                if self.batch_handler is not None:
+                    self.batch_handler([item for _, item, _ in batch])
+                else:
+                    self.handler(batch[0][1])
+            except Exception as e:
+                ok = False
+                keys = ", ".join(sorted({str(key) for key, _, _ in batch}))
+                print(f"❌ {self.name} worker failed to process item(s) for '{keys}': {e}")
+            finished = time.monotonic()
+
+            with self._cond:
+                self.busy_workers -= 1
+                for _, _, enqueued_at in batch:
+                    self._wait_times.append(started - enqueued_at)
+                self._run_times.append(finished - started)
+                if self.batch_handler is not None:
+                    self.batches += 1
+                    self.batched_items += len(batch)
+                if ok:
+                    self.processed += len(batch)
+                else:
+                    self.failed += len(batch)
+
+    def _fill_batch(self, batch):
+        """Adds pending items to `batch`, waiting up to batch_window. Must be called with the lock held."""
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size and not self._stop.is_set():
+            if self._pending:
+                batch.append(self._take())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+
+    # --- Reporting ---
+
+    def stats(self):
+        """Returns queue depth, drop counts and recent latency figures (seconds)."""
+        with self._cond:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+            return {
+                "depth": self._depth(),
+                "depth_by_key": {key: len(queue) for key, queue in self._pending.items()},
+                "maxsize": self.maxsize,
+                "policy": self.policy,
+                "workers": self.workers,
+                "busy_workers": self.busy_workers,
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped_oldest": self.dropped_oldest,
+                "dropped_newest": self.dropped_newest,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched_items / self.batches, 2) if self.batches else 0.0,
+                "queue_wait_p50": round(percentile(wait_times, 50), 3),
+                "queue_wait_p95": round(percentile(wait_times, 95), 3),
+                "latency_p50": round(percentile(run_times, 50), 3),
+                "latency_p95": round(percentile(run_times, 95), 3),
+                "latency_max": round(max(run_times, default=0.0), 3),
+            }
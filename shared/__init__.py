@@ -0,0 +1,4 @@
+# shared/__init__.py
+#
+# Code shared by camera_service, api_gateway and llm_service.
+# Each service mounts this directory at /app/shared (see the docker-compose files).
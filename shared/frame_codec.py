@@ -0,0 +1,305 @@
+# shared/frame_codec.py
+#
+# Binary envelope for camera frames published on MQTT.
+#
+# Layout (all integers big-endian):
+#
+#   magic        2s   b"EF"
+#   version      B    FRAME_VERSION
+#   media type   B    index into MEDIA_TYPES
+#   timestamp    d    capture time, seconds since the epoch
+#   sequence     Q    per-camera frame counter
+#   camera id    B    length, followed by that many UTF-8 bytes
+#   boxes        H    count, followed by count * (x, y, w, h) as uint16
+#   metadata     I    length, followed by that many bytes of compact JSON (0 = none)
+#   image             raw image bytes until the end of the payload
+#
+# Optional face crops (higher-quality JPEGs of the detected faces) follow the image.
+# They are described in the metadata, so the header layout is unchanged:
+#   "image_size": length of the image, "crops": [{"box": [x, y, w, h], "size": n}, ...]
+# with each crop's bytes appended in that order. A decoder unaware of crops sees
+# them as trailing bytes after the JPEG's end marker, which image decoders ignore.
+#
+# The legacy format ({"image": <base64>, "type": ...} as JSON) is still accepted by
+# decode_frame() so old publishers keep working during the migration.
+
+import base64
+import binascii
+import json
+import math
+import struct
+import time
+from dataclasses import dataclass, field
+
+FRAME_MAGIC = b"EF"
+FRAME_VERSION = 1
+
+# Media types that fit in the one-byte header field. Unknown types are sent as
+# application/octet-stream.
+MEDIA_TYPES = ("application/octet-stream", "image/jpeg", "image/png")
+
+_HEADER = struct.Struct(">2sBBdQB")
+_BOX_COUNT = struct.Struct(">H")
+_META_LEN = struct.Struct(">I")
+
+
+class FrameDecodeError(ValueError):
+    """Raised when a payload is neither a valid binary frame nor a legacy JSON frame."""
+
+
+@dataclass
+class Frame:
+    """A single camera frame plus the metadata carried alongside it."""
+    image: bytes
+    media_type: str = "image/jpeg"
+    camera_id: str = ""
+    timestamp: float = 0.0
+    sequence: int = 0
+    boxes: list = field(default_factory=list)  # [(x, y, w, h), ...] in image pixels
+    meta: dict = field(default_factory=dict)
+    legacy: bool = False  # True when decoded from the old JSON format
+    crops: list = field(default_factory=list)  # [((x, y, w, h), jpeg bytes), ...], box in image pixels
+
+    @property
+    def frame_id(self):
+        """Pipeline-wide id of this frame; see make_frame_id()."""
+        return make_frame_id(self.camera_id, self.sequence, self.timestamp)
+
+    @property
+    def published_at(self):
+        """Time the camera published the frame, or None if it did not say."""
+        return self.meta.get("published_at")
+
+
+def make_frame_id(camera_id, sequence, timestamp):
+    """
+    Builds the id that identifies a frame across all services.
+
+    It is derived from fields every frame already carries, so the camera service,
+    LLM service and gateway agree on it without sending it separately. The capture
+    time (in milliseconds) keeps ids unique when a camera restarts its sequence.
+    """
+    return f"{camera_id or 'default'}-{sequence}-{int(timestamp * 1000)}"
+
+
+def encode_frame(image, camera_id="", sequence=0, timestamp=None,
+                 media_type="image/jpeg", boxes=(), meta=None, crops=()):
+    """
+    Packs an image and its metadata into the binary frame envelope.
+
+    Args:
+        image: Encoded image bytes (bytes, bytearray or memoryview).
+        camera_id: Identifier of the source camera (at most 255 UTF-8 bytes).
+        sequence: Per-camera frame counter.
+        timestamp: Capture time in seconds since the epoch. Defaults to now.
+        media_type: MIME type of `image`.
+        boxes: Iterable of (x, y, w, h) detection boxes in image pixels.
+        meta: Optional dict of extra JSON-serialisable metadata.
+        crops: Iterable of ((x, y, w, h), image bytes) face crops appended after the image.
+
+    Returns:
+        The encoded payload as bytes.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    try:
+        media_code = MEDIA_TYPES.index(media_type)
+    except ValueError:
+        media_code = 0
+
+    camera_bytes = camera_id.encode("utf-8")
+    if len(camera_bytes) > 255:
+        raise ValueError("camera_id must be at most 255 bytes when UTF-8 encoded")
+
+    box_values = []
+    for box in boxes:
+        box_values.extend(max(0, min(int(v), 0xFFFF)) for v in box[:4])
+    box_count = len(box_values) // 4
+
+    crops = list(crops)
+    if crops:
+        meta = dict(meta or {}, image_size=len(image),
+                    crops=[{"box": [int(v) for v in box[:4]], "size": len(data)} for box, data in crops])
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8") if meta else b""
+
+    parts = [
+        _HEADER.pack(FRAME_MAGIC, FRAME_VERSION, media_code, float(timestamp),
+                     int(sequence), len(camera_bytes)),
+        camera_bytes,
+        _BOX_COUNT.pack(box_count),
+        struct.pack(f">{len(box_values)}H", *box_values),
+        _META_LEN.pack(len(meta_bytes)),
+        meta_bytes,
+        image,
+    ]
+    parts.extend(data for _, data in crops)
+    return b"".join(parts)
+
+
+def encode_frame_json(image, media_type="image/jpeg", **metadata):
+    """
+    Encodes a frame in the legacy JSON format ({"image": <base64>, "type": ...}).
+
+    Extra keyword arguments are added to the JSON object as-is, so consumers
+    that only know the old format simply ignore them.
+    """
+    payload_dict = {
+        "image": base64.b64encode(image).decode("utf-8"),
+        "type": media_type,
+    }
+    payload_dict.update(metadata)
+    return json.dumps(payload_dict).encode("utf-8")
+
+
+def is_binary_frame(payload):
+    """Returns True if `payload` starts with the binary frame magic."""
+    return bytes(payload[:2]) == FRAME_MAGIC
+
+
+def peek_camera_id(payload):
+    """
+    Returns the camera id of a binary frame without decoding the rest of it.
+
+    Legacy JSON frames are not parsed (that would cost a full decode); they return "".
+    """
+    if not is_binary_frame(payload) or len(payload) < _HEADER.size:
+        return ""
+    camera_len = _HEADER.unpack_from(payload, 0)[-1]
+    return bytes(payload[_HEADER.size:_HEADER.size + camera_len]).decode("utf-8", errors="replace")
+
+
+def peek_meta(payload):
+    """
+    Returns the metadata of a binary frame without copying the image or crops.
+
+    Legacy JSON frames and malformed headers return {}.
+    """
+    if not is_binary_frame(payload):
+        return {}
+    try:
+        camera_len = _HEADER.unpack_from(payload, 0)[-1]
+        offset = _HEADER.size + camera_len
+        (box_count,) = _BOX_COUNT.unpack_from(payload, offset)
+        offset += _BOX_COUNT.size + box_count * 8
+        (meta_len,) = _META_LEN.unpack_from(payload, offset)
+        offset += _META_LEN.size
+        meta = json.loads(bytes(payload[offset:offset + meta_len])) if meta_len else {}
+    except (struct.error, UnicodeDecodeError, json.JSONDecodeError):
+        return {}
+    return meta if isinstance(meta, dict) else {}
+
+
+def decode_frame(payload):
+    """
+    Decodes a frame payload received from MQTT.
+
+    Accepts both the binary envelope and the legacy JSON format.
+
+    Args:
+        payload: The raw MQTT message payload.
+
+    Returns:
+        A Frame instance.
+
+    Raises:
+        FrameDecodeError: If the payload cannot be decoded as a frame.
+    """
+    if is_binary_frame(payload):
+        return _decode_binary(payload)
+    return _decode_json(payload)
+
+
+def _decode_binary(payload):
+    view = memoryview(payload)
+    try:
+        magic, version, media_code, timestamp, sequence, camera_len = _HEADER.unpack_from(view, 0)
+        if version != FRAME_VERSION:
+            raise FrameDecodeError(f"Unsupported frame version {version}")
+        offset = _HEADER.size
+
+        camera_id = bytes(view[offset:offset + camera_len]).decode("utf-8")
+        offset += camera_len
+
+        (box_count,) = _BOX_COUNT.unpack_from(view, offset)
+        offset += _BOX_COUNT.size
+        box_values = struct.unpack_from(f">{box_count * 4}H", view, offset)
+        offset += box_count * 8
+        boxes = [tuple(box_values[i:i + 4]) for i in range(0, len(box_values), 4)]
+
+        (meta_len,) = _META_LEN.unpack_from(view, offset)
+        offset += _META_LEN.size
+        meta = json.loads(bytes(view[offset:offset + meta_len])) if meta_len else {}
+        offset += meta_len
+    except (struct.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise FrameDecodeError(f"Malformed binary frame: {e}") from e
+
+    if offset > len(view):
+        raise FrameDecodeError("Truncated binary frame")
+    if not isinstance(meta, dict):
+        raise FrameDecodeError("Frame metadata is not a JSON object")
+    if not math.isfinite(timestamp):
+        # frame_id needs the capture time in milliseconds
+        raise FrameDecodeError(f"Invalid frame timestamp {timestamp}")
+
+    image_end = len(view)
+    crops = []
+    if meta.get("crops"):
+        try:
+            image_end = offset + int(meta["image_size"])
+            crop_offset = image_end
+            for crop in meta["crops"]:
+                size = int(crop["size"])
+                crops.append((tuple(crop["box"]), bytes(view[crop_offset:crop_offset + size])))
+                crop_offset += size
+        except (KeyError, TypeError, ValueError) as e:
+            raise FrameDecodeError(f"Malformed face crop metadata: {e}") from e
+        if crop_offset != len(view):
+            raise FrameDecodeError("Face crop sizes do not match the payload")
+
+    media_type = MEDIA_TYPES[media_code] if media_code < len(MEDIA_TYPES) else MEDIA_TYPES[0]
+    return Frame(
+        image=bytes(view[offset:image_end]),
+        media_type=media_type,
+        camera_id=camera_id,
+        timestamp=timestamp,
+        sequence=sequence,
+        boxes=boxes,
+        meta=meta,
+        crops=crops,
+    )
+
+
+def _decode_json(payload):
+    try:
+        message_data = json.loads(payload)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise FrameDecodeError(f"Payload is neither a binary frame nor JSON: {e}") from e
+
+    if not isinstance(message_data, dict) or "image" not in message_data:
+        raise FrameDecodeError("JSON payload has no 'image' key")
+
+    try:
+        image = base64.b64decode(message_data["image"])
+    except (binascii.Error, TypeError) as e:
+        raise FrameDecodeError(f"Failed to decode base64 image data: {e}") from e
+
+    try:
+        timestamp = float(message_data.get("timestamp", 0.0))
+        if not math.isfinite(timestamp):
+            raise ValueError(f"invalid timestamp {timestamp}")
+        sequence = int(message_data.get("sequence", 0))
+        boxes = [tuple(b) for b in message_data.get("boxes", [])]
+    except (ValueError, TypeError, OverflowError) as e:
+        raise FrameDecodeError(f"Malformed JSON frame fields: {e}") from e
+
+    known_keys = ("image", "type", "camera_id", "timestamp", "sequence", "boxes")
+    return Frame(
+        image=image,
+        media_type=message_data.get("type", "image/jpeg"),
+        camera_id=str(message_data.get("camera_id", "")),
+        timestamp=timestamp,
+        sequence=sequence,
+        boxes=boxes,
+        meta={k: v for k, v in message_data.items() if k not in known_keys},
+        legacy=True,
+    )
@@ -0,0 +1,107 @@
+# shared/insight_message.py
+#
+# Structured LLM output published on the LLM response topic.
+#
+# The message is a JSON object tying the generated text to the frame it describes,
+# together with the timestamps of each pipeline stage:
+#
+#   text              the generated insight
+#   frame_id          see shared.frame_codec.make_frame_id()
+#   camera_id, sequence
+#   captured_at       camera capture time
+#   published_at      camera publish time
+#   llm_received_at   LLM service received the frame from MQTT
+#   llm_started_at    inference (or cache lookup) started
+#   llm_first_token_at first token generated (streaming mode only)
+#   llm_finished_at   inference finished
+#   inference_seconds llm_finished_at - llm_started_at
+#   ttft_seconds      llm_first_token_at - llm_started_at (streaming mode only)
+#   cached            true if the text came from the result cache
+#   batch_size        number of frames described by the same completion (1 = on its own)
+#   images            face crops shown to a vision model (only present when there were any)
+#   load_tier, model  load-shedding tier and the model file that answered (LLM_ADAPTIVE_LOAD only)
+#
+# In streaming mode, partial results are published first on
+# <llm topic>/partial/<frame_id> as {"frame_id", "index", "delta", "text", "done"},
+# where "text" is everything generated so far. The last partial has done=true, and
+# the complete insight message above follows on the LLM topic itself.
+#
+# All times are seconds since the epoch, taken from each service's own clock.
+# Plain-text payloads from older LLM services are still accepted by decode_insight().
+
+import json
+
+TIMING_FIELDS = ("captured_at", "published_at", "llm_received_at", "llm_started_at", "llm_first_token_at",
+                 "llm_finished_at")
+
+PARTIAL_SEGMENT = "partial"
+
+
+def partial_topic(llm_topic, frame_id):
+    """Returns the topic partial results for a frame are published on."""
+    return f"{llm_topic}/{PARTIAL_SEGMENT}/{frame_id}"
+
+
+def partial_subscription(llm_topic):
+    """Returns the subscription matching the partial results of every frame."""
+    return f"{llm_topic}/{PARTIAL_SEGMENT}/+"
+
+
+def encode_partial(frame_id, index, delta, text, done=False):
+    """
+    Encodes a partial result message.
+
+    Args:
+        frame_id: The frame being described.
+        index: Position of this chunk in the stream, starting at 0.
+        delta: Text generated since the previous chunk.
+        text: All text generated so far.
+        done: True for the last partial message of the stream.
+    """
+    return json.dumps({"frame_id": frame_id, "index": index, "delta": delta, "text": text, "done": done})
+
+
+def encode_insight(text, frame=None, **fields):
+    """
+    Encodes an insight message.
+
+    Args:
+        text: The generated text.
+        frame: The shared.frame_codec.Frame the text describes, if any.
+        **fields: Timing and other fields (see the module comment).
+
+    Returns:
+        The JSON payload as a string.
+    """
+    message = {"text": text}
+    if frame is not None:
+        message.update(
+            frame_id=frame.frame_id,
+            camera_id=frame.camera_id,
+            sequence=frame.sequence,
+            captured_at=frame.timestamp,
+            published_at=frame.published_at,
+        )
+    message.update(fields)
+    return json.dumps(message)
+
+
+def decode_insight(payload):
+    """
+    Decodes an insight message.
+
+    Args:
+        payload: The raw MQTT payload (bytes or str).
+
+    Returns:
+        A dict with at least "text". Plain-text payloads yield {"text": <payload>}.
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode("utf-8", errors="replace")  # Undecodable bytes still yield a text message
+    try:
+        message = json.loads(payload)
+    except json.JSONDecodeError:
+        return {"text": payload}
+    if not isinstance(message, dict) or "text" not in message:
+        return {"text": payload}
+    return message
@@ -0,0 +1,50 @@
+# shared/log.py
+#
+# Leveled and sampled console output for per-message hot paths.
+#
+# The services log with print(). Lines that would be printed for every frame or
+# MQTT message go through this module instead, so a busy pipeline does not spend
+# its time writing to stdout:
+#
+#   debug(message)         printed only with LOG_LEVEL=debug
+#   sampled(key, message)  printed at most once per LOG_SAMPLE_SECONDS for each key,
+#                          with the number of lines skipped since the last one
+#
+# Startup, errors and the periodic 📊 stats lines keep using print().
+
+import os
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower() # "debug" prints every per-message line
+LOG_SAMPLE_SECONDS = float(os.getenv("LOG_SAMPLE_SECONDS", 10)) # Minimum seconds between sampled lines per key
+
+DEBUG = LOG_LEVEL == "debug"
+
+_lock = threading.Lock()
+_last_printed = {}  # key -> (monotonic time printed, lines skipped since)
+
+
+def debug(message):
+    """Prints `message` only when LOG_LEVEL is "debug"."""
+    if DEBUG:
+        print(message)
+
+
+def sampled(key, message):
+    """
+    Prints `message` if nothing was printed for `key` in the last LOG_SAMPLE_SECONDS.
+
+    With LOG_LEVEL=debug every message is printed.
+    """
+    if DEBUG:
+        print(message)
+        return
+    now = time.monotonic()
+    with _lock:
+        printed_at, skipped = _last_printed.get(key, (None, 0))
+        if printed_at is not None and now - printed_at < LOG_SAMPLE_SECONDS:
+            _last_printed[key] = (printed_at, skipped + 1)
+            return
+        _last_printed[key] = (now, 0)
+    print(f"{message} (+{skipped} similar)" if skipped else message)
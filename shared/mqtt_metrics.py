@@ -0,0 +1,121 @@
+# shared/mqtt_metrics.py
+#
+# MQTT traffic metrics: messages and bytes per topic in each direction, publish
+# latency (publish() call until paho reports the message sent, or acknowledged for
+# QoS > 0) and the number of publishes still pending.
+#
+# Topics that embed an id per message (e.g. llm_response/partial/<frame_id>) should
+# be recorded under their subscription pattern, so the number of series stays small.
+
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from shared.metrics import counter, gauge, histogram, SIZE_BUCKETS
+
+MESSAGES_OUT = counter("mqtt_messages_out_total", "MQTT messages published", ("topic",))
+BYTES_OUT = counter("mqtt_bytes_out_total", "MQTT payload bytes published", ("topic",))
+PUBLISH_FAILURES = counter("mqtt_publish_failures_total", "MQTT publishes rejected by the client", ("topic",))
+PUBLISH_SECONDS = histogram("mqtt_publish_seconds", "Seconds from publish() until the message was sent/acked", ("topic",))
+PUBLISH_PENDING = gauge("mqtt_publish_pending", "MQTT publishes not yet sent/acked")
+MESSAGES_IN = counter("mqtt_messages_in_total", "MQTT messages received", ("topic",))
+BYTES_IN = counter("mqtt_bytes_in_total", "MQTT payload bytes received", ("topic",))
+PAYLOAD_BYTES_IN = histogram("mqtt_payload_bytes_in", "Size of received MQTT payloads", ("topic",), SIZE_BUCKETS)
+
+MAX_EARLY_ACKS = 1024  # Acks for mids published without the tracker would otherwise pile up
+
+
+class PublishTracker:
+    """
+    Wraps client.publish() to record traffic and latency. Call on_publish() and
+    on_disconnect() from the paho callbacks.
+    """
+
+    def __init__(self, on_sent=None):
+        """
+        Args:
+            on_sent: Optional callable invoked as on_sent(label, seconds) with the latency of
+                every tracked message, e.g. to adapt the publish rate to the link.
+        """
+        self.on_sent = on_sent
+        # Never held while calling into paho: its callbacks run under paho's own locks
+        self._lock = threading.Lock()
+        self._pending = {}  # mid -> (perf_counter at publish, topic label, qos)
+        self._early = set()  # mids acknowledged before publish() returned
+        PUBLISH_PENDING.set_function(self.pending)
+
+    def publish(self, client, topic, payload, qos=0, retain=False, label=None):
+        """
+        Publishes through `client` and records the message.
+
+        Args:
+            client: The paho client.
+            topic, payload, qos, retain: As for client.publish().
+            label: Topic label for the metrics; defaults to `topic`.
+
+        Returns:
+            The paho MQTTMessageInfo.
+        """
+        label = label or topic
+        size = len(payload) if payload is not None else 0
+        start = time.perf_counter()
+        info = client.publish(topic, payload, qos=qos, retain=retain)
+        # While disconnected, QoS > 0 messages are still queued and sent after reconnecting
+        queued = info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0)
+        if not queued:
+            PUBLISH_FAILURES.inc(topic=label)
+            return info
+        with self._lock:
+            # on_publish may already have run, on this thread or the network thread
+            acked = info.mid in self._early
+            if acked:
+                self._early.discard(info.mid)
+            else:
+                self._pending[info.mid] = (start, label, qos)
+        if acked:
+            self._record_sent(label, time.perf_counter() - start)
+        MESSAGES_OUT.inc(topic=label)
+        BYTES_OUT.inc(size, topic=label)
+        return info
+
+    def on_publish(self, mid):
+        """Records the latency of the message `mid`. Call from the client's on_publish callback."""
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                if len(self._early) >= MAX_EARLY_ACKS:
+                    self._early.clear()
+                self._early.add(mid)
+                return
+        start, label, _ = entry
+        self._record_sent(label, time.perf_counter() - start)
+
+    def on_disconnect(self):
+        """
+        Forgets QoS 0 messages that were still unsent. paho drops them when the connection
+        is lost without calling on_publish; QoS > 0 messages are resent after reconnecting.
+        Call from the client's on_disconnect callback.
+        """
+        with self._lock:
+            lost = [mid for mid, (_, _, qos) in self._pending.items() if qos == 0]
+            labels = [self._pending.pop(mid)[1] for mid in lost]
+        for label in labels:
+            PUBLISH_FAILURES.inc(topic=label)
+
+    def pending(self):
+        """Returns the number of tracked messages not yet sent (or acknowledged, for QoS > 0)."""
+        return len(self._pending)
+
+    def _record_sent(self, label, seconds):
+        PUBLISH_SECONDS.observe(seconds, topic=label)
+        if self.on_sent is not None:
+            self.on_sent(label, seconds)
+
+
+def record_received(topic, payload):
+    """Records an incoming message under the topic label `topic`."""
+    size = len(payload)
+    MESSAGES_IN.inc(topic=topic)
+    BYTES_IN.inc(size, topic=topic)
+    PAYLOAD_BYTES_IN.observe(size, topic=topic)
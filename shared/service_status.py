@@ -0,0 +1,55 @@
+# shared/service_status.py
+#
+# Readiness messages published by a service on its status topic (e.g. llm/status).
+#
+# The message is retained, so a client subscribing later immediately gets the
+# service's current state:
+#
+#   service     name of the publishing service, e.g. "llm_service"
+#   state       "loading", "ready", "failed" or "offline"
+#   since       time the service entered this state
+#   ...         state-specific fields, e.g. the load-time breakdown once ready
+#
+# "offline" is also registered as the MQTT last will, so the broker publishes it
+# when the service disappears without disconnecting.
+
+import json
+import time
+
+STATE_LOADING = "loading"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+STATE_OFFLINE = "offline"
+
+
+def encode_status(service, state, **fields):
+    """
+    Encodes a status message.
+
+    Args:
+        service: Name of the publishing service.
+        state: One of the STATE_* values.
+        **fields: Extra JSON-serialisable fields.
+    """
+    message = {"service": service, "state": state, "since": time.time()}
+    message.update(fields)
+    return json.dumps(message)
+
+
+def decode_status(payload):
+    """
+    Decodes a status message.
+
+    Returns:
+        The message as a dict, or None if the payload is empty (retained message cleared)
+        or not a status message.
+    """
+    if not payload:
+        return None
+    try:
+        message = json.loads(payload)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    if not isinstance(message, dict) or "state" not in message:
+        return None
+    return message
@@ -0,0 +1,12 @@
+# shared/stats.py
+#
+# Small statistics helpers for the services' rolling stats and controllers.
+
+
+def percentile(values, pct):
+    """Returns the `pct` percentile (0-100) of `values`, or 0.0 for an empty sequence."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,30 @@
+# shared/topics.py
+#
+# MQTT topic naming shared by all services.
+#
+# Each camera publishes frames to camera/<camera_id>/feed. The original single-camera
+# topic (camera/feed) is still subscribed to by the consumers for older publishers.
+# The LLM service announces its readiness on a retained status topic (see
+# shared/service_status.py).
+
+CAMERA_FEED_TOPIC_TEMPLATE = "camera/{camera_id}/feed"
+CAMERA_FEED_SUBSCRIPTION = "camera/+/feed"
+LLM_STATUS_TOPIC = "llm/status"
+
+
+def camera_feed_topic(camera_id):
+    """Returns the MQTT topic a camera publishes its frames to."""
+    return CAMERA_FEED_TOPIC_TEMPLATE.format(camera_id=camera_id)
+
+
+def camera_id_from_topic(topic):
+    """
+    Extracts the camera id from a camera/<camera_id>/feed topic.
+
+    Returns:
+        The camera id, or "" if the topic does not follow the per-camera pattern.
+    """
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == "camera" and parts[2] == "feed":
+        return parts[1]
+    return ""